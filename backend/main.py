@@ -1,19 +1,30 @@
-from fastapi import FastAPI, HTTPException, Query, Header, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, Query, Header, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import Optional, Dict, Any, List
 from pathlib import Path
-from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
 import json
 import uuid
 import base64
-import shutil
+import io
 import hashlib
+import zlib
+import sqlite3
+import threading
+import re
+import shlex
+import difflib
 import os
-from datetime import datetime
+from datetime import datetime, timezone
 import asyncio
 import logging
 import time
+import copy
+import contextlib
+import struct
+import socket
+from collections import deque, OrderedDict
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
@@ -24,41 +35,148 @@ try:
 except Exception:
     aioredis = None
 
+# Optional faster JSON encoder for broadcast frames
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+# Optional Pillow for thumbnail validation and downscaled variants
+try:
+    from PIL import Image
+except Exception:
+    Image = None
+
+# flock for room leases between worker processes (not available on Windows)
+try:
+    import fcntl
+except Exception:
+    fcntl = None
+
+import storage
+from storage import (
+    BLOBS_DIR, CHECKPOINTS_DIR, DATA_DIR, OPS_DIR, PROJECTS_DIR, STORAGE_BACKEND, VERSIONS_DIR,
+    _BLOB_LOCK, _STORAGE_POOL, _file_stamp, atomic_write_json, blob_path, canonical_json,
+    drop_journal_index, load_json_safe, open_storage, put_blob, read_blob, run_storage,
+)
+
 # ---------------------
-# Day 21: Metrics and Atomic Write Utilities
+# Day 21: Metrics
 # ---------------------
 METRICS = {
   "active_connections": 0,
   "ops_total": 0,
-  "last_snapshot_ts": 0.0,
   "batches_total": 0,
+  "cursor_batches_total": 0,
+  "versions_created_total": 0,
+  "versions_skipped_total": 0,
+  "versions_keyframe_total": 0,
+  "versions_delta_total": 0,
+  "version_bytes_written_total": 0,
+  "version_reconstructs_total": 0,
+  "version_reconstruct_seconds_sum": 0.0,
+  "version_reconstruct_depth_max": 0,
+  "auth_tokens_pruned_total": 0,
+  "thumbnails_stored_total": 0,
+  "thumbnails_rejected_total": 0,
+  "thumbnails_refitted_total": 0,
+  "thumbnail_variants_built_total": 0,
+  "thumbnail_variant_seconds_sum": 0.0,
+  "http_not_modified_total": 0,
+  "project_cache_hits_total": 0,
+  "project_cache_misses_total": 0,
+  "project_cache_evictions_total": 0,
+  "event_loop_lag_seconds_last": 0.0,
+  "event_loop_lag_seconds_max": 0.0,
+  "event_loop_lag_seconds_sum": 0.0,
+  "event_loop_lag_samples_total": 0,
+  "version_retention_runs_total": 0,
+  "version_retention_seconds_last": 0.0,
+  "versions_pruned_total": 0,
+  "version_bytes_freed_total": 0,
+  "blobs_collected_total": 0,
+  "blob_bytes_freed_total": 0,
+  "resumes_total": 0,
+  "resume_frames_replayed_total": 0,
+  "resume_snapshot_fallbacks_total": 0,
+  "snapshot_bytes_sent_total": 0,
+  "cursor_updates_coalesced_total": 0,
+  "persist_flushes_total": 0,
+  "persist_flush_seconds_sum": 0.0,
+  "persist_flush_seconds_last": 0.0,
+  "persist_coalesced_writes_total": 0,
+  "persist_bytes_written_total": 0,
+  "checkpoints_total": 0,
+  "broadcast_send_timeouts_total": 0,
+  "send_queue_dropped_total": 0,
+  "send_queue_snapshots_total": 0,
+  "send_queue_evictions_total": 0,
+  "broadcast_encodes_total": 0,
+  "broadcast_encode_seconds_sum": 0.0,
+  "room_leases_acquired_total": 0,
+  "room_leases_released_total": 0,
+  "room_relay_clients": 0,
+  "room_relay_connections_total": 0,
+  "room_relay_calls_total": 0,
 }
 
-def atomic_write_json(path, obj):
-    """Writes JSON content to a path atomically using tempfile + os.replace."""
-    import json, tempfile, os
-    dirpath = os.path.dirname(path)
-    
-    # Ensure directory exists before creating temp file
-    if not os.path.exists(dirpath):
-        os.makedirs(dirpath)
-        
-    with tempfile.NamedTemporaryFile("w", dir=dirpath, delete=False, encoding="utf-8") as tf:
-        json.dump(obj, tf, indent=2)
-        tf.flush()
-        os.fsync(tf.fileno())
-    os.replace(tf.name, path)
-
-    # Update metric for snapshot save
-    if path.name.endswith(".json"):
-        METRICS["last_snapshot_ts"] = time.time()
-
 # ---------------------
 # Day 21: Collaboration Constants
 # ---------------------
 PING_INTERVAL = 20  # sec
 PING_TIMEOUT = 10   # sec
 BATCH_INTERVAL = 0.05 # 50ms
+# Cursor/presence updates are coalesced per user and flushed as one
+# cursors_batch message per tick. Rooms can override the rate (see
+# PUT /projects/{id}/collab-settings) within the min/max bounds.
+CURSOR_TICK_HZ = float(os.getenv("CURSOR_TICK_HZ", "30"))
+CURSOR_TICK_HZ_MIN = 1.0
+CURSOR_TICK_HZ_MAX = 60.0
+CURSOR_TICK_OVERRIDES: Dict[str, float] = {}
+# Layout-changing frames (ops_batch, undo, redo, snapshot) carry a per-room
+# sequence number. The last RESUME_BUFFER_SIZE of them are kept so a client
+# reconnecting with ?since=<seq>&epoch=<epoch> gets only what it missed;
+# larger gaps fall back to a (optionally deflate-compressed) snapshot.
+RESUME_BUFFER_SIZE = int(os.getenv("RESUME_BUFFER_SIZE", "512"))
+# Per-client timeout for a single send; a client that cannot take a frame in
+# this long is disconnected.
+BROADCAST_SEND_TIMEOUT = float(os.getenv("BROADCAST_SEND_TIMEOUT", "2.0"))
+# Each connection has its own bounded outbound queue drained by a writer task.
+# When it is full, the overflow policy steps are tried in order:
+#   drop_cursors - discard queued cursor updates
+#   snapshot     - discard queued ops and send one fresh snapshot instead
+#   disconnect   - evict the client (it will reconnect and resync)
+SEND_QUEUE_MAX = int(os.getenv("SEND_QUEUE_MAX", "256"))
+SEND_OVERFLOW_POLICY = [p.strip() for p in os.getenv("SEND_OVERFLOW_POLICY", "drop_cursors,snapshot,disconnect").split(",") if p.strip()]
+
+# Write-behind persistence: dirty room layouts are flushed to disk at most
+# every PERSIST_FLUSH_INTERVAL seconds, or sooner once PERSIST_FLUSH_MAX_OPS
+# ops have accumulated. Ops are durable in the journal before they are acked.
+PERSIST_FLUSH_INTERVAL = float(os.getenv("PERSIST_FLUSH_INTERVAL", "1.0"))
+PERSIST_FLUSH_MAX_OPS = int(os.getenv("PERSIST_FLUSH_MAX_OPS", "50"))
+
+# Rooms checkpoint their state every CHECKPOINT_EVERY_OPS journal records; the
+# journal is compacted behind a checkpoint once its prefix exceeds COMPACT_MIN_BYTES.
+CHECKPOINT_EVERY_OPS = int(os.getenv("CHECKPOINT_EVERY_OPS", "200"))
+COMPACT_MIN_BYTES = int(os.getenv("COMPACT_MIN_BYTES", str(1024 * 1024)))
+# Thumbnails: uploads over THUMBNAIL_MAX_BYTES or THUMBNAIL_MAX_DIMENSION
+# pixels on a side are rejected. THUMBNAIL_SIZES are the variants served to
+# listings ("<name>:<longest edge>").
+THUMBNAIL_MAX_BYTES = int(os.getenv("THUMBNAIL_MAX_BYTES", str(2 * 1024 * 1024)))
+THUMBNAIL_MAX_DIMENSION = int(os.getenv("THUMBNAIL_MAX_DIMENSION", "4096"))
+THUMBNAIL_SIZES = {
+    name.strip(): int(edge)
+    for name, _, edge in (p.partition(":") for p in os.getenv("THUMBNAIL_SIZES", "small:160,medium:480,large:1024").split(","))
+    if name.strip()
+}
+# Parsed project documents kept in memory, bounded by their file sizes.
+PROJECT_CACHE_MAX_BYTES = int(os.getenv("PROJECT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Event-loop lag is sampled every LOOP_LAG_INTERVAL seconds and logged when
+# it exceeds LOOP_LAG_WARN_SECONDS.
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+LOOP_LAG_WARN_SECONDS = float(os.getenv("LOOP_LAG_WARN_SECONDS", "0.5"))
+# Undo/redo history kept per room; older entries fall out of the window.
+UNDO_HISTORY_LIMIT = int(os.getenv("UNDO_HISTORY_LIMIT", "200"))
 
 app = FastAPI(title="DreamHouse Backend Day21 (Stability + Metrics)")
 
@@ -71,20 +189,26 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-BASE_DIR = Path(__file__).parent
-DATA_DIR = BASE_DIR / "data"
-PROJECTS_DIR = DATA_DIR / "projects"
-OPS_DIR = DATA_DIR / "ops"
-VERSIONS_DIR = DATA_DIR / "versions"
+THUMBNAILS_DIR = DATA_DIR / "thumbnails"
 PROJECTS_DIR.mkdir(parents=True, exist_ok=True)
 OPS_DIR.mkdir(parents=True, exist_ok=True)
 VERSIONS_DIR.mkdir(parents=True, exist_ok=True)
+CHECKPOINTS_DIR.mkdir(parents=True, exist_ok=True)
+BLOBS_DIR.mkdir(parents=True, exist_ok=True)
+THUMBNAILS_DIR.mkdir(parents=True, exist_ok=True)
 DATA_DIR.mkdir(parents=True, exist_ok=True)
 
-USERS_FILE = DATA_DIR / "users.json"
-TOKENS_FILE = DATA_DIR / "tokens.json"
+# SQLite index of project metadata and search terms, derived from the
+# project files and rebuilt from them if missing or out of date.
+INDEX_DB_PATH = Path(os.getenv("INDEX_DB_PATH", str(DATA_DIR / "index.db")))
+STORAGE = open_storage(STORAGE_BACKEND)
+TOKENS = STORAGE.token_store()
+USERS = STORAGE.user_store()
+TOKEN_PRUNE_INTERVAL = int(os.getenv("TOKEN_PRUNE_INTERVAL", "600"))
 
 REDIS_URL = os.getenv("REDIS_URL")
+# Tags messages this process publishes so its subscriber can skip them.
+PROCESS_ID = uuid.uuid4().hex
 REDIS = None
 if REDIS_URL and aioredis:
     try:
@@ -93,20 +217,24 @@ if REDIS_URL and aioredis:
         print("Failed to connect to redis:", e)
         REDIS = None
 
-# ---------------------
-# JSON helpers
-# ---------------------
-def load_json_safe(path: Path):
-    if not path.exists():
-        return {}
-    try:
-        return json.loads(path.read_text(encoding="utf-8"))
-    except Exception:
-        return {}
-
-def write_json_safe(path: Path, data):
-    # Day 21: Use atomic write for config files
-    atomic_write_json(path, data)
+# Room ownership when uvicorn runs several workers. With "file", each live
+# room is leased to exactly one worker through flock on DATA_DIR/leases; the
+# other workers relay their clients and room calls to it over a Unix socket,
+# and the lease passes to another worker when the owner exits or dies. With
+# "off" every worker serves rooms itself, which is only safe with one worker.
+ROOM_LEASES_MODE = os.getenv("ROOM_LEASES", "file" if fcntl else "off").lower()
+if ROOM_LEASES_MODE == "file" and fcntl is None:
+    logging.warning("ROOM_LEASES=file needs flock, which this platform lacks; serving rooms in-process")
+    ROOM_LEASES_MODE = "off"
+elif ROOM_LEASES_MODE not in ("file", "off"):
+    logging.warning(f"Unknown ROOM_LEASES={ROOM_LEASES_MODE!r}, using 'off'")
+    ROOM_LEASES_MODE = "off"
+LEASES_DIR = DATA_DIR / "leases"
+WORKERS_DIR = DATA_DIR / "workers"
+# How often a worker retries while a room changes hands (owner address not
+# yet written, or the owner just died)
+ROOM_CLAIM_ATTEMPTS = int(os.getenv("ROOM_CLAIM_ATTEMPTS", "30"))
+ROOM_CLAIM_RETRY_SECONDS = 0.1
 
 # ---------------------
 # Auth helpers
@@ -115,211 +243,1242 @@ def hash_password(username: str, password: str) -> str:
     return hashlib.sha256(f"{username}|{password}".encode("utf-8")).hexdigest()
 
 def save_token(token: str, username: str):
-    tokens = load_json_safe(TOKENS_FILE)
-    tokens[token] = {"username": username, "created": datetime.utcnow().isoformat()}
-    write_json_safe(TOKENS_FILE, tokens)
+    TOKENS.add(token, username)
 
 def delete_token(token: str):
-    tokens = load_json_safe(TOKENS_FILE)
-    if token in tokens:
-        del tokens[token]
-        write_json_safe(TOKENS_FILE, tokens)
+    TOKENS.remove(token)
 
 def get_username_for_token(token: str) -> Optional[str]:
-    tokens = load_json_safe(TOKENS_FILE)
-    info = tokens.get(token)
-    return info.get("username") if info else None
+    return TOKENS.username(token)
 
 def get_user_by_username(username: str) -> Optional[Dict[str,Any]]:
-    users = load_json_safe(USERS_FILE)
-    return users.get(username)
+    return USERS.get(username)
 
 def create_user(username: str, password: str):
-    users = load_json_safe(USERS_FILE)
-    if username in users:
-        raise ValueError("user exists")
-    users[username] = {"password_hash": hash_password(username, password), "created": datetime.utcnow().isoformat()}
-    write_json_safe(USERS_FILE, users)
+    USERS.create(username, {"password_hash": hash_password(username, password), "created": datetime.utcnow().isoformat()})
 
 # ---------------------
-# Project file helpers
+# Thumbnails
 # ---------------------
-def save_thumbnail(pid: str, thumbnail_b64: str) -> Optional[str]:
-    if not thumbnail_b64:
-        return None
+# A project's thumbnail is validated, stored in the blob store and described
+# by thumbnails/<pid>.json: {"source", "width", "height", "bytes",
+# "variants": {size: digest}}. Variants are built on the storage pool when
+# Pillow is installed; until then (or without it) every size serves the
+# original. The PNG beside the project file is kept for versions.
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+_THUMB_LOCK = threading.Lock()
+
+def _thumbnail_record_path(pid: str) -> Path:
+    return THUMBNAILS_DIR / f"{pid}.json"
+
+def load_thumbnail_record(pid: str) -> dict:
+    return load_json_safe(_thumbnail_record_path(pid))
+
+def _reject_thumbnail(status: int, detail: str) -> HTTPException:
+    METRICS["thumbnails_rejected_total"] += 1
+    return HTTPException(status_code=status, detail=detail)
+
+def decode_thumbnail(data_url: str) -> bytes:
+    """Decodes a base64 thumbnail (optionally a data URL), checking its size before decoding."""
+    header, _, b64 = data_url.rpartition(",")
+    if header and "image/png" not in header:
+        raise _reject_thumbnail(415, "Thumbnail must be a PNG image")
+    if len(b64) * 3 // 4 > THUMBNAIL_MAX_BYTES:
+        raise _reject_thumbnail(413, f"Thumbnail is larger than {THUMBNAIL_MAX_BYTES} bytes")
     try:
-        header, b64 = (thumbnail_b64.split(",", 1) if "," in thumbnail_b64 else ("", thumbnail_b64))
-        data = base64.b64decode(b64)
-        png_path = PROJECTS_DIR / f"{pid}.png"
-        with open(png_path, "wb") as pf:
-            pf.write(data)
-        return f"{pid}.png"
-    
+        data = base64.b64decode(b64, validate=True)
+    except Exception:
+        raise _reject_thumbnail(400, "Thumbnail is not valid base64")
+    validate_thumbnail(data)
+    return data
+
+def thumbnail_for_save(data_url: str) -> tuple:
+    """(PNG bytes, None) for a thumbnail sent along with a project save, or
+    (None, why it was dropped).
+
+    A bad screenshot must not cost the user the save itself. With Pillow an
+    oversized or non-PNG image is re-encoded as a PNG no larger than the
+    biggest thumbnail size; without it such a thumbnail is dropped.
+    """
+    try:
+        return decode_thumbnail(data_url), None
+    except HTTPException as e:
+        problem = e.detail
+    if Image is None:
+        return None, problem
+    try:
+        with Image.open(io.BytesIO(base64.b64decode(data_url.rpartition(",")[2], validate=True))) as img:
+            img.load()
+            img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+        edge = min(max(THUMBNAIL_SIZES.values(), default=THUMBNAIL_MAX_DIMENSION), THUMBNAIL_MAX_DIMENSION)
+        img.thumbnail((edge, edge))
+        buf = io.BytesIO()
+        img.save(buf, "PNG", optimize=True)
+        data = buf.getvalue()
+        validate_thumbnail(data)
+    except HTTPException as e:
+        return None, e.detail
+    except Exception:
+        return None, problem
+    METRICS["thumbnails_refitted_total"] += 1
+    return data, None
+
+def validate_thumbnail(data: bytes) -> tuple:
+    """Checks size, PNG header and dimensions (and, with Pillow, the image data). Returns (width, height)."""
+    if len(data) > THUMBNAIL_MAX_BYTES:
+        raise _reject_thumbnail(413, f"Thumbnail is larger than {THUMBNAIL_MAX_BYTES} bytes")
+    if not data.startswith(PNG_SIGNATURE) or data[12:16] != b"IHDR":
+        raise _reject_thumbnail(415, "Thumbnail must be a PNG image")
+    width, height = int.from_bytes(data[16:20], "big"), int.from_bytes(data[20:24], "big")
+    if not (0 < width <= THUMBNAIL_MAX_DIMENSION and 0 < height <= THUMBNAIL_MAX_DIMENSION):
+        raise _reject_thumbnail(400, f"Thumbnail must be at most {THUMBNAIL_MAX_DIMENSION}px on each side")
+    if Image is not None:
+        try:
+            with Image.open(io.BytesIO(data)) as img:
+                img.verify()
+        except Exception:
+            raise _reject_thumbnail(400, "Thumbnail is not a valid PNG image")
+    return width, height
+
+def store_thumbnail(pid: str, data: bytes) -> str:
+    """Validates and stores a project's thumbnail, queueing its variants. Returns the content hash."""
+    width, height = validate_thumbnail(data)
+    digest = put_blob(data)
+    with _THUMB_LOCK:
+        old = load_thumbnail_record(pid)
+        record = {
+            "source": digest,
+            "width": width,
+            "height": height,
+            "bytes": len(data),
+            # Re-uploading the same image keeps the variants already built
+            "variants": old.get("variants", {}) if old.get("source") == digest else {},
+            "updated": datetime.utcnow().isoformat(),
+        }
+        atomic_write_json(_thumbnail_record_path(pid), record)
+        png_path = project_png_path(pid)
+        if not (png_path.exists() and png_path.stat().st_size == len(data) and png_path.read_bytes() == data):
+            tmp = png_path.with_suffix(".png.tmp")
+            tmp.write_bytes(data)
+            os.replace(tmp, png_path)
+    index_set_thumbnail(pid, thumbnail_ref(record))
+    METRICS["thumbnails_stored_total"] += 1
+    if Image is not None and not record["variants"]:
+        _STORAGE_POOL.submit(build_thumbnail_variants, pid, digest)
+    return digest
+
+def build_thumbnail_variants(pid: str, digest: str):
+    """Downscales a stored thumbnail to each of THUMBNAIL_SIZES (never upscaling)."""
+    started = time.perf_counter()
+    variants = {}
+    try:
+        with Image.open(blob_path(digest)) as img:
+            img.load()
+            for name, edge in THUMBNAIL_SIZES.items():
+                if max(img.size) <= edge:
+                    variants[name] = digest
+                    continue
+                scaled = img.copy()
+                scaled.thumbnail((edge, edge))
+                buf = io.BytesIO()
+                scaled.save(buf, "PNG")
+                variants[name] = put_blob(buf.getvalue())
     except Exception as e:
-        print("Failed to decode/save thumbnail:", e)
+        logging.error(f"[{pid}] Failed to build thumbnail variants: {e}")
+        return
+    with _THUMB_LOCK:
+        record = load_thumbnail_record(pid)
+        if record.get("source") != digest:
+            # Replaced while this one was being scaled
+            return
+        record["variants"] = variants
+        atomic_write_json(_thumbnail_record_path(pid), record)
+    index_set_thumbnail(pid, thumbnail_ref(record))
+    METRICS["thumbnail_variants_built_total"] += len(variants)
+    METRICS["thumbnail_variant_seconds_sum"] += time.perf_counter() - started
+
+def thumbnail_ref(record: dict) -> Optional[str]:
+    """Digest listings link to: the small variant once built, else the original."""
+    if not record:
         return None
+    return record.get("variants", {}).get("small") or record.get("source")
 
-def write_project_file(pid: str, name: str, layout: Dict[str,Any], owner: Optional[str] = None, thumb_filename: Optional[str] = None):
+def thumbnail_digest(pid: str, size: Optional[str] = None) -> Optional[str]:
+    record = load_thumbnail_record(pid)
+    if not record:
+        return None
+    return record.get("variants", {}).get(size) or record.get("source")
+
+def delete_thumbnail(pid: str):
+    # The blobs are collected by the next GC sweep
+    with _THUMB_LOCK:
+        for path in (_thumbnail_record_path(pid), project_png_path(pid)):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+def migrate_legacy_thumbnails() -> int:
+    """Stores project PNGs saved before thumbnail records existed. Returns how many were stored."""
+    stored = 0
+    for png in PROJECTS_DIR.glob("*.png"):
+        pid = png.stem
+        if _thumbnail_record_path(pid).exists():
+            continue
+        try:
+            store_thumbnail(pid, png.read_bytes())
+            stored += 1
+        except HTTPException as e:
+            logging.warning(f"[{pid}] Legacy thumbnail not stored: {e.detail}")
+    return stored
+
+# ---------------------
+# Conditional GET helpers
+# ---------------------
+# Content-addressed or immutable reads (blobs, versions) use a strong ETag
+# and are cacheable forever; reads of files that change in place use a weak
+# ETag from mtime and size, with no-cache so clients always revalidate.
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE = "no-cache"
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    bare = etag[2:] if etag.startswith("W/") else etag
+    return "*" in tags or bare in tags or f"W/{bare}" in tags
+
+def stamp_etag(*stamps: Optional[list]) -> Optional[str]:
+    """Weak ETag from storage stamps (None for an absent one), or None if the first is absent."""
+    if not stamps or stamps[0] is None:
+        return None
+    return 'W/"' + "-".join(".".join(f"{v:x}" for v in s) if s else "0" for s in stamps) + '"'
+
+def stat_etag(*paths: Path) -> Optional[str]:
+    """Weak ETag from the mtime and size of files (missing ones count as absent)."""
+    return stamp_etag(*(_file_stamp(p) for p in paths))
+
+def not_modified(if_none_match: Optional[str], etag: str, cache_control: str) -> Optional[Response]:
+    """A 304 response if the client's copy is current, else None."""
+    if not etag_matches(if_none_match, etag):
+        return None
+    METRICS["http_not_modified_total"] += 1
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": cache_control})
+
+def blob_response(digest: str, media_type: str, cache_control: str, if_none_match: Optional[str] = None) -> Response:
+    """Serves a blob with its digest as ETag, or 304 if the client already has it."""
+    etag = f'"{digest}"'
+    return not_modified(if_none_match, etag, cache_control) or FileResponse(
+        path=str(blob_path(digest)), media_type=media_type, headers={"ETag": etag, "Cache-Control": cache_control})
+
+# ---------------------
+# Project document cache
+# ---------------------
+# Parsed project documents, most recently used last, evicted oldest first
+# once their stored sizes exceed PROJECT_CACHE_MAX_BYTES. Every hit is
+# checked against the document's storage stamp (mtime, size and inode of the
+# file, or update time, size and revision of the row), so a document replaced
+# behind our back (another process, a restore, a hand edit) is re-read.
+# Documents handed out are shared: callers must copy before mutating.
+class ProjectCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()  # pid -> (stamp, doc, size)
+        self.lock = threading.Lock()
+
+    def get(self, pid: str) -> dict:
+        """The parsed project document, or {} if it is missing or unreadable."""
+        stamp = STORAGE.project_stamp(pid)
+        if stamp is None:
+            self.invalidate(pid)
+            return {}
+        with self.lock:
+            entry = self.entries.get(pid)
+            if entry and entry[0] == stamp:
+                self.entries.move_to_end(pid)
+                METRICS["project_cache_hits_total"] += 1
+                return entry[1]
+        METRICS["project_cache_misses_total"] += 1
+        try:
+            doc = json.loads(STORAGE.read_project(pid) or b"{}")
+        except Exception:
+            doc = {}
+        if doc:
+            # Only cache it if the document did not change while it was being read
+            if STORAGE.project_stamp(pid) == stamp:
+                self.put(pid, stamp, doc)
+        return doc
+
+    def put(self, pid: str, stamp: list, doc: dict):
+        size = stamp[1]
+        with self.lock:
+            old = self.entries.pop(pid, None)
+            if old:
+                self.bytes -= old[2]
+            if size > self.max_bytes:
+                return
+            self.entries[pid] = (stamp, doc, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, _, evicted) = self.entries.popitem(last=False)
+                self.bytes -= evicted
+                METRICS["project_cache_evictions_total"] += 1
+
+    def invalidate(self, pid: str):
+        with self.lock:
+            old = self.entries.pop(pid, None)
+            if old:
+                self.bytes -= old[2]
+
+PROJECT_CACHE = ProjectCache(PROJECT_CACHE_MAX_BYTES)
+
+def load_project_doc(pid: str) -> dict:
+    """Parsed project document through the cache. Do not mutate the result."""
+    return PROJECT_CACHE.get(pid)
+
+# ---------------------
+# Project file helpers
+# ---------------------
+def project_document(pid: str, name: str, layout: Dict[str,Any], owner: Optional[str] = None, thumb_filename: Optional[str] = None) -> dict:
     out = {"id": pid, "name": name, "layout": layout}
     if owner:
         out["owner"] = owner
     if thumb_filename:
         out["thumbnail"] = thumb_filename
-    path = PROJECTS_DIR / f"{pid}.json"
-    
-    # Day 21: Use atomic write for project file
-    atomic_write_json(path, out)
     return out
 
-def _project_file_path(project_id: str) -> Path:
-    return PROJECTS_DIR / f"{project_id}.json"
+def project_written(pid: str, doc: dict, stamp: list):
+    """Updates the cache and search index after a project document was stored."""
+    # The caller keeps its layout (a live room mutates it in place), so the
+    # cache gets its own copy
+    PROJECT_CACHE.put(pid, stamp, copy.deepcopy(doc))
+    index_project(pid, doc.get("name"), doc.get("owner"), doc.get("layout", {}), stamp[0] / 1e9)
 
-def load_project_layout(project_id: str) -> dict:
-    path = _project_file_path(project_id)
-    if path.exists():
-        try:
-            j = load_json_safe(path)
-            return j.get("layout", {"rooms": [], "meta": {}})
-        except Exception:
-            return {"rooms": [], 
-"meta": {}}
-    return {"rooms": [], "meta": {}}
+def store_project_document(pid: str, doc: dict) -> int:
+    """Writes a project document through STORAGE. Returns its stored size."""
+    stamp = STORAGE.write_project(pid, doc)
+    project_written(pid, doc, stamp)
+    return stamp[1]
 
-def persist_project_layout(project_id: str, layout: dict):
-    path = _project_file_path(project_id)
-    if path.exists():
-        try:
-            existing = load_json_safe(path)
-            name = existing.get("name", project_id)
-            owner = existing.get("owner")
-        except Exception:
-            name = project_id
-  
-            owner = None
-    else:
-        name = project_id
-        owner = None
-    write_project_file(project_id, name, layout, owner=owner, thumb_filename=None)
+def write_project_file(pid: str, name: str, layout: Dict[str,Any], owner: Optional[str] = None, thumb_filename: Optional[str] = None):
+    out = project_document(pid, name, layout, owner=owner, thumb_filename=thumb_filename)
+    store_project_document(pid, out)
+    return out
 
 # ---------------------
-# Ops journal helpers (JSONL)
+# Project metadata and search index (SQLite)
 # ---------------------
-def append_op_record(project_id: str, record: dict):
-    ops_dir = OPS_DIR
-    ops_dir.mkdir(parents=True, exist_ok=True)
-    fpath = ops_dir / f"{project_id}.log"
-    
-    # Day 21: Increment total ops metric
-    METRICS["ops_total"] += 1
-    
+# One row per project file so listing and filtering never open layout files,
+# plus an inverted index of weighted terms (project name, room names, mood,
+# meta notes/description) and per-project facets for structured filters.
+# Every write path goes through write_project_file/delete_project, which keep
+# the rows current; a missing or stale index is rebuilt from the files once.
+INDEX_SCHEMA_VERSION = 3
+_INDEX_LOCK = threading.Lock()
+_INDEX_DB: Optional[sqlite3.Connection] = None
+
+# Term weights per field, summed into a project's score for each query term
+SEARCH_FIELD_WEIGHTS = {"name": 3.0, "room": 2.0, "mood": 2.0, "notes": 1.0, "description": 1.0, "id": 0.5}
+# Structured filters: `bedrooms>=3`, `rooms<8`, `mood:eco`, `has:Kitchen`, `owner:bob`
+SEARCH_NUMERIC_FACETS = {"bedrooms": "bedrooms", "bathrooms": "bathrooms", "rooms": "room_count"}
+_SEARCH_OPS = {":": "=", "=": "=", ">=": ">=", "<=": "<=", ">": ">", "<": "<"}
+_FILTER_RE = re.compile(r"^(\w+)(>=|<=|>|<|=|:)(.+)$")
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+def _search_tokens(text: Any) -> List[str]:
+    return _TOKEN_RE.findall(str(text or "").lower())
+
+def room_type(name: Any) -> str:
+    """Room name without its number: "Bedroom 2" -> "bedroom"."""
+    return " ".join(t for t in _search_tokens(name) if not t.isdigit())
+
+def _layout_index_rows(pid: str, name: Optional[str], layout: Any) -> tuple:
+    """Returns (facets, terms, room types) for a project's layout."""
+    layout = layout if isinstance(layout, dict) else {}
+    rooms = [r for r in layout.get("rooms") or [] if isinstance(r, dict)]
+    meta = layout.get("meta") if isinstance(layout.get("meta"), dict) else {}
+    types = [room_type(r.get("name")) for r in rooms]
+
+    weights: Dict[str, float] = {}
+    def add(field: str, value: Any):
+        for token in _search_tokens(value):
+            weights[token] = weights.get(token, 0.0) + SEARCH_FIELD_WEIGHTS[field]
+    add("name", name)
+    add("id", pid)
+    for r in rooms:
+        add("room", r.get("name"))
+    add("mood", meta.get("mood"))
+    notes = meta.get("notes")
+    for note in (notes if isinstance(notes, list) else [notes]):
+        add("notes", note)
+    add("description", meta.get("description"))
+
+    bedrooms = sum(1 for t in types if "bedroom" in t.split())
+    if not rooms and isinstance(meta.get("bedrooms"), int):
+        bedrooms = meta["bedrooms"]
+    facets = {
+        "bedrooms": bedrooms,
+        "bathrooms": sum(1 for t in types if "bathroom" in t.split()),
+        "room_count": len(rooms),
+        "mood": str(meta.get("mood") or "").lower() or None,
+    }
+    return facets, weights, sorted(set(t for t in types if t))
+
+def _index_write(db: sqlite3.Connection, pid: str, name: Optional[str], owner: Optional[str], layout: Any, mtime: float):
+    facets, weights, types = _layout_index_rows(pid, name, layout)
+    # Digest of the listing thumbnail; "" for a PNG not yet stored as one
+    thumb = thumbnail_ref(load_thumbnail_record(pid))
+    if thumb is None and (PROJECTS_DIR / f"{pid}.png").exists():
+        thumb = ""
+    db.execute(
+        "INSERT OR REPLACE INTO projects (id, name, owner, mtime, thumbnail, bedrooms, bathrooms, room_count, mood) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (pid, name, owner, mtime, thumb, facets["bedrooms"], facets["bathrooms"], facets["room_count"], facets["mood"]),
+    )
+    db.execute("DELETE FROM project_terms WHERE project_id = ?", (pid,))
+    db.executemany("INSERT INTO project_terms (term, project_id, weight) VALUES (?, ?, ?)", [(t, pid, w) for t, w in weights.items()])
+    db.execute("DELETE FROM project_rooms WHERE project_id = ?", (pid,))
+    db.executemany("INSERT INTO project_rooms (project_id, room_type) VALUES (?, ?)", [(pid, t) for t in types])
+
+def _rebuild_project_index(db: sqlite3.Connection):
+    count = 0
+    with db:
+        db.execute("DELETE FROM projects")
+        db.execute("DELETE FROM project_terms")
+        db.execute("DELETE FROM project_rooms")
+        for pid in STORAGE.project_ids():
+            stamp = STORAGE.project_stamp(pid)
+            if stamp is None:
+                continue
+            try:
+                j = json.loads(STORAGE.read_project(pid) or b"{}")
+            except Exception:
+                j = {}
+            _index_write(db, j.get("id") or pid, j.get("name"), j.get("owner"), j.get("layout", {}), stamp[0] / 1e9)
+            count += 1
+        db.execute(f"PRAGMA user_version = {INDEX_SCHEMA_VERSION}")
+    logging.info(f"Rebuilt project index with {count} projects.")
+
+def _index_db() -> sqlite3.Connection:
+    """Opens the index on first use. Callers must hold _INDEX_LOCK."""
+    global _INDEX_DB
+    if _INDEX_DB is None:
+        db = sqlite3.connect(str(INDEX_DB_PATH), check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        version = db.execute("PRAGMA user_version").fetchone()[0]
+        if version != INDEX_SCHEMA_VERSION:
+            # Derived data only: recreate with the current schema
+            for table in ("projects", "project_terms", "project_rooms"):
+                db.execute(f"DROP TABLE IF EXISTS {table}")
+        db.execute("""CREATE TABLE IF NOT EXISTS projects (
+            id TEXT PRIMARY KEY,
+            name TEXT,
+            owner TEXT,
+            mtime REAL NOT NULL,
+            thumbnail TEXT,
+            bedrooms INTEGER NOT NULL DEFAULT 0,
+            bathrooms INTEGER NOT NULL DEFAULT 0,
+            room_count INTEGER NOT NULL DEFAULT 0,
+            mood TEXT
+        )""")
+        db.execute("CREATE INDEX IF NOT EXISTS projects_by_mtime ON projects (mtime DESC)")
+        db.execute("CREATE INDEX IF NOT EXISTS projects_by_owner ON projects (owner, mtime DESC)")
+        db.execute("CREATE TABLE IF NOT EXISTS project_terms (term TEXT NOT NULL, project_id TEXT NOT NULL, weight REAL NOT NULL, PRIMARY KEY (term, project_id)) WITHOUT ROWID")
+        db.execute("CREATE INDEX IF NOT EXISTS project_terms_by_project ON project_terms (project_id)")
+        db.execute("CREATE TABLE IF NOT EXISTS project_rooms (room_type TEXT NOT NULL, project_id TEXT NOT NULL, PRIMARY KEY (room_type, project_id)) WITHOUT ROWID")
+        db.execute("CREATE INDEX IF NOT EXISTS project_rooms_by_project ON project_rooms (project_id)")
+        count = db.execute("SELECT COUNT(*) FROM projects").fetchone()[0]
+        if version != INDEX_SCHEMA_VERSION or count != len(STORAGE.project_ids()):
+            _rebuild_project_index(db)
+        _INDEX_DB = db
+    return _INDEX_DB
+
+def index_project(pid: str, name: Optional[str], owner: Optional[str], layout: Any, mtime: float):
+    with _INDEX_LOCK:
+        db = _index_db()
+        with db:
+            _index_write(db, pid, name, owner, layout, mtime)
+
+def index_set_thumbnail(pid: str, thumbnail: Optional[str]):
+    with _INDEX_LOCK:
+        db = _index_db()
+        with db:
+            db.execute("UPDATE projects SET thumbnail = ? WHERE id = ?", (thumbnail, pid))
+
+def unindex_project(pid: str):
+    with _INDEX_LOCK:
+        db = _index_db()
+        with db:
+            db.execute("DELETE FROM projects WHERE id = ?", (pid,))
+            db.execute("DELETE FROM project_terms WHERE project_id = ?", (pid,))
+            db.execute("DELETE FROM project_rooms WHERE project_id = ?", (pid,))
+
+def parse_search_query(q: Optional[str]) -> tuple:
+    """Splits a search string into free-text terms and (field, op, value) filters.
+
+    The last term is matched as a prefix so results follow the user as they type.
+    """
     try:
-        with open(fpath, "a", encoding="utf-8") as fh:
-          
-            fh.write(json.dumps(record) + "\n")
-    except Exception as e:
-        print("Failed to append op record:", e)
+        parts = shlex.split(q or "")
+    except ValueError:
+        parts = (q or "").split()
+    terms, filters = [], []
+    for part in parts:
+        m = _FILTER_RE.match(part)
+        if m:
+            field, op, value = m.group(1).lower(), _SEARCH_OPS[m.group(2)], m.group(3)
+            if field in SEARCH_NUMERIC_FACETS and value.isdigit():
+                filters.append((field, op, int(value)))
+                continue
+            if field in ("mood", "has", "owner") and op == "=":
+                filters.append((field, op, value))
+                continue
+        terms.extend(_search_tokens(part))
+    return terms, filters
+
+def query_project_index(owner: Optional[str] = None, q: Optional[str] = None, limit: int = 20, offset: int = 0):
+    """Returns (rows, total) for one page of projects.
+
+    Rows are (id, name, owner, mtime, thumbnail, score). With search terms
+    every term must match and results are ranked by summed term weight;
+    otherwise they are newest first.
+    """
+    terms, filters = parse_search_query(q)
+    where, params = [], []
+    if owner is not None:
+        where.append("p.owner = ?")
+        params.append(owner)
+    for field, op, value in filters:
+        if field in SEARCH_NUMERIC_FACETS:
+            where.append(f"p.{SEARCH_NUMERIC_FACETS[field]} {op} ?")
+            params.append(value)
+        elif field == "mood":
+            where.append("p.mood = ?")
+            params.append(value.lower())
+        elif field == "owner":
+            where.append("p.owner = ?")
+            params.append(value)
+        elif field == "has":
+            where.append("EXISTS (SELECT 1 FROM project_rooms r WHERE r.project_id = p.id AND r.room_type = ?)")
+            params.append(room_type(value))
+    clause = " AND ".join(where) or "1"
+
+    if not terms:
+        sql = f"SELECT p.id, p.name, p.owner, p.mtime, p.thumbnail, 0.0 FROM projects p WHERE {clause} ORDER BY p.mtime DESC"
+        count_sql = f"SELECT COUNT(*) FROM projects p WHERE {clause}"
+    else:
+        # Each query term is tested on its own, so one term row can satisfy
+        # several of them ("bedroom bed"). Repeated terms are dropped, and so
+        # is a prefix term already required as a whole word.
+        prefix = terms[-1]
+        exact = list(dict.fromkeys(terms[:-1]))
+        conds, term_params = [], []
+        for term in exact:
+            conds.append("t.term = ?")
+            term_params.append(term)
+        if prefix not in exact:
+            conds.append("(t.term >= ? AND t.term < ?)")
+            term_params += [prefix, prefix + "\uffff"]
+        matched = f"""SELECT p.id, p.name, p.owner, p.mtime, p.thumbnail, SUM(t.weight) AS score
+            FROM project_terms t JOIN projects p ON p.id = t.project_id
+            WHERE ({' OR '.join(conds)}) AND {clause}
+            GROUP BY p.id HAVING {' AND '.join(f'MAX({c})' for c in conds)}"""
+        sql = f"{matched} ORDER BY score DESC, p.mtime DESC"
+        count_sql = f"SELECT COUNT(*) FROM ({matched})"
+        params = term_params + params + term_params
+    with _INDEX_LOCK:
+        db = _index_db()
+        total = db.execute(count_sql, params).fetchone()[0]
+        rows = db.execute(f"{sql} LIMIT ? OFFSET ?", params + [limit, offset]).fetchall()
+    return rows, total
+
+def load_project_layout(project_id: str) -> dict:
+    # Rooms edit their layout in place: hand out a copy of the cached one
+    j = load_project_doc(project_id)
+    if "layout" in j:
+        return copy.deepcopy(j["layout"])
+    return {"rooms": [], "meta": {}}
+
+def project_layout_document(project_id: str, layout: dict) -> Optional[dict]:
+    """The project document with a new layout, keeping its name and owner.
+
+    None if the project no longer exists: a room flushing after its project
+    was deleted must not write an ownerless copy back.
+    """
+    existing = load_project_doc(project_id)
+    if not existing:
+        return None
+    return project_document(project_id, existing.get("name", project_id), layout, owner=existing.get("owner"))
+
+# Open journals: OpsJournal with the filesystem backend, SQLiteJournal with sqlite
+JOURNALS: Dict[str, Any] = {}
+
+def get_journal(project_id: str):
+    journal = JOURNALS.get(project_id)
+    if journal is None:
+        journal = JOURNALS[project_id] = STORAGE.open_journal(project_id, project_layout_document, project_written)
+    return journal
+
+async def close_journal(project_id: str):
+    journal = JOURNALS.pop(project_id, None)
+    if journal:
+        await journal.close()
+
+def append_op_record(project_id: str, record: dict) -> asyncio.Future:
+    """Queues a journal record for the project.
+
+    Call this while holding room["lock"], right after the record's effect has
+    been applied to room["layout"], so the journal order matches the order in
+    which the layout changed. Await the returned future before acking.
+    """
+    # Day 21: Increment total ops metric
+    if "op" in record:
+        METRICS["ops_total"] += 1
+    return get_journal(project_id).append(record)
 
-def replay_ops(project_id: str) -> list:
-    fpath = OPS_DIR / f"{project_id}.log"
-    ops = []
-    if not fpath.exists():
-        return ops
+def _record_time(record: dict, default: float) -> float:
+    ts = record.get("ts")
     try:
-        with open(fpath, "r", encoding="utf-8") as fh:
-            for line in fh:
-           
-                line = line.strip()
-                if not line:
-                    continue
-                try:
-                    ops.append(json.loads(line))
-                except Exception:
-  
-                    continue
-    except Exception as e:
-        print("Failed to replay ops:", e)
-    return ops
+        if isinstance(ts, (int, float)):
+            return float(ts)
+        t = datetime.fromisoformat(ts)
+        return (t if t.tzinfo else t.replace(tzinfo=timezone.utc)).timestamp()
+    except Exception:
+        return default
 
 # ---------------------
-# Version helpers
+# Checkpoints
+# ---------------------
+# A checkpoint is a snapshot of a room's history state (layout and undo/redo
+# stacks) plus the journal position it corresponds to. Rooms
+# load the newest checkpoint and replay only the journal records after it.
+# Checkpoints taken when every change had been broadcast also record the
+# room's resume epoch/seq, so clients can resume across a clean restart.
+def write_checkpoint(project_id: str, state: dict, offset: int, last_op_id: Optional[str]):
+    STORAGE.write_checkpoint(project_id, {
+        "project_id": project_id,
+        "offset": offset,
+        "last_op_id": last_op_id,
+        "created": datetime.utcnow().isoformat(),
+        **state,
+    })
+    METRICS["checkpoints_total"] += 1
+
+def load_checkpoint(project_id: str) -> Optional[dict]:
+    cp = STORAGE.load_checkpoint(project_id)
+    return cp if cp and "layout" in cp else None
+
+def delete_checkpoint(project_id: str):
+    STORAGE.delete_checkpoint(project_id)
+
+def reset_checkpoint(project_id: str, layout: dict):
+    """Starts a fresh history at the current end of the journal.
+
+    Used when the project file is replaced while its room is closed (REST
+    update, version revert) so the next room load starts from that layout.
+    A live room is reset by reset_room instead.
+    """
+    if project_id in PROJECT_ROOMS:
+        return
+    last = STORAGE.last_op(project_id)
+    state = {"layout": layout, "undo_stack": [], "redo_stack": []}
+    write_checkpoint(project_id, state, STORAGE.journal_end(project_id), last.get("opId") if last else None)
+
+def load_room_state(project_id: str) -> dict:
+    """Restores a room's layout and undo/redo history from checkpoint + journal tail."""
+    cp = load_checkpoint(project_id)
+    if cp is None:
+        # First open since checkpoints were introduced: start history at the
+        # current end of the journal instead of replaying all of it.
+        layout = load_project_layout(project_id)
+        state = {"layout": layout, "undo_stack": [], "redo_stack": []}
+        last = STORAGE.last_op(project_id)
+        write_checkpoint(project_id, state, STORAGE.journal_end(project_id), last.get("opId") if last else None)
+        state["layout"] = RoomLayout(layout)
+        state["undo_stack"] = deque(maxlen=UNDO_HISTORY_LIMIT)
+        state["redo_stack"] = deque(maxlen=UNDO_HISTORY_LIMIT)
+        state["last_op_id"] = last.get("opId") if last else None
+        state["epoch"], state["seq"] = uuid.uuid4().hex, 0
+        return state
+
+    undo_stack = cp.get("undo_stack") or []
+    if "base" in cp and any("inverse" not in rec for rec in undo_stack):
+        # Checkpoint written before ops carried inverses: replay the history
+        # once from its base layout to capture them.
+        layout = RoomLayout(cp["base"])
+        for rec in undo_stack:
+            apply_op_record(layout, rec)
+    else:
+        layout = RoomLayout(cp["layout"])
+    state = {
+        "layout": layout,
+        "undo_stack": deque(undo_stack, maxlen=UNDO_HISTORY_LIMIT),
+        "redo_stack": deque(cp.get("redo_stack") or [], maxlen=UNDO_HISTORY_LIMIT),
+        "last_op_id": cp.get("last_op_id"),
+        "epoch": cp.get("epoch"),
+        "seq": int(cp.get("seq") or 0),
+    }
+    for rec in STORAGE.ops_since_checkpoint(project_id, cp):
+        # Clients cannot have seen these as sequenced frames: start a new epoch
+        state["epoch"] = None
+        if rec.get("opId"):
+            state["last_op_id"] = rec["opId"]
+        if "undo" in rec:
+            if state["undo_stack"] and state["undo_stack"][-1].get("opId") == rec["undo"]:
+                op_record = state["undo_stack"].pop()
+                undo_op_record(state["layout"], op_record)
+                state["redo_stack"].append(op_record)
+        elif "redo" in rec:
+            if state["redo_stack"] and state["redo_stack"][-1].get("opId") == rec["redo"]:
+                op_record = state["redo_stack"].pop()
+                apply_op_record(state["layout"], op_record)
+                state["undo_stack"].append(op_record)
+        elif rec.get("op"):
+            apply_op_record(state["layout"], rec)
+            state["undo_stack"].append(rec)
+            state["redo_stack"].clear()
+    if not state["epoch"]:
+        state["epoch"], state["seq"] = uuid.uuid4().hex, 0
+    return state
+
+async def checkpoint_room(room: dict):
+    """Writes a checkpoint for a live room and compacts the journal behind it.
+
+    Callers must hold room["_flush_lock"] so checkpoints and compactions of the
+    same room never interleave.
+    """
+    project_id = room["id"]
+    async with room["lock"]:
+        state = copy.deepcopy({
+            "layout": room["layout"].to_dict(),
+            "undo_stack": list(room["undo_stack"]),
+            "redo_stack": list(room["redo_stack"]),
+        })
+        offset = room["_journal_offset"]
+        last_op_id = room["_last_op_id"]
+        room["_ops_since_checkpoint"] = 0
+        # Only a state every client has been sent may be resumed from
+        if room["_undelivered"] == 0:
+            state["epoch"], state["seq"] = room["epoch"], room["seq"]
+        room["_checkpoint_seq"] = state.get("seq")
+    journal = get_journal(project_id)
+    await run_storage(write_checkpoint, project_id, state, offset - journal.base, last_op_id, key=project_id)
+    if offset - journal.base >= COMPACT_MIN_BYTES:
+        moved = await journal.compact(offset)
+        if moved:
+            logging.info(f"[{project_id}] Compacted {moved} journal bytes into a segment.")
+
+# ---------------------
+# Structural JSON diffs
 # ---------------------
-def project_json_path(pid: str) -> Path:
-    return PROJECTS_DIR / f"{pid}.json"
+# A patch turns one JSON value into another:
+#   {"$set": value}                          replace the value
+#   {"$obj": {key: patch}, "$del": [keys]}   patch/remove dict keys
+#   {"$list": [["=", n], ["-", n], ["+", [items]]]}  keep/drop/insert runs
+# None means "unchanged". List runs are matched on whole elements, so an
+# edited room costs one "-"/"+" pair rather than a rewrite of the list.
+def json_diff(a: Any, b: Any) -> Optional[dict]:
+    if a == b:
+        return None
+    if isinstance(a, dict) and isinstance(b, dict):
+        patch: Dict[str, Any] = {}
+        sub = {}
+        for k, v in b.items():
+            p = json_diff(a[k], v) if k in a else {"$set": v}
+            if p is not None:
+                sub[k] = p
+        if sub:
+            patch["$obj"] = sub
+        removed = [k for k in a if k not in b]
+        if removed:
+            patch["$del"] = removed
+        return patch
+    if isinstance(a, list) and isinstance(b, list):
+        keys_a = [canonical_json(x) for x in a]
+        keys_b = [canonical_json(x) for x in b]
+        runs: List[list] = []
+        for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, keys_a, keys_b, autojunk=False).get_opcodes():
+            if tag == "equal":
+                runs.append(["=", i2 - i1])
+                continue
+            if i2 > i1:
+                runs.append(["-", i2 - i1])
+            if j2 > j1:
+                runs.append(["+", b[j1:j2]])
+        return {"$list": runs}
+    return {"$set": b}
+
+def json_patch(a: Any, patch: Optional[dict]) -> Any:
+    if patch is None:
+        return a
+    if "$set" in patch:
+        return copy.deepcopy(patch["$set"])
+    if "$list" in patch:
+        out, pos = [], 0
+        for op, arg in patch["$list"]:
+            if op == "=":
+                out.extend(a[pos:pos + arg])
+                pos += arg
+            elif op == "-":
+                pos += arg
+            else:
+                out.extend(copy.deepcopy(arg))
+        return out
+    out = dict(a) if isinstance(a, dict) else {}
+    for k in patch.get("$del", []):
+        out.pop(k, None)
+    for k, p in patch.get("$obj", {}).items():
+        out[k] = json_patch(out.get(k), p)
+    return out
 
+# ---------------------
+# Version helpers
+# ---------------------
+# Version layouts are stored as keyframes (a layout blob) or as a structural
+# delta against the previous version. A keyframe is forced every
+# VERSION_KEYFRAME_INTERVAL versions, so rebuilding any version reads at most
+# that many records.
+VERSION_KEYFRAME_INTERVAL = max(1, int(os.getenv("VERSION_KEYFRAME_INTERVAL", "10")))
+# Retention tiers as "<age>:<keep one per>" (or "all"), youngest first:
+# the default keeps every version for an hour, one per hour for a day and
+# one per day for 30 days; older versions are removed. Pinned versions and
+# the newest one are always kept. An empty value disables retention.
+VERSION_RETENTION = os.getenv("VERSION_RETENTION", "1h:all,1d:1h,30d:1d")
+VERSION_RETENTION_INTERVAL = int(os.getenv("VERSION_RETENTION_INTERVAL", "3600"))
+# Unreferenced blobs younger than this are left alone (a version may be
+# about to reference them).
+BLOB_GC_GRACE_SECONDS = int(os.getenv("BLOB_GC_GRACE_SECONDS", "3600"))
 def project_png_path(pid: str) -> Path:
     return PROJECTS_DIR / f"{pid}.png"
 
-def ensure_versions_dir_for_project(pid: str) -> Path:
-    d = VERSIONS_DIR / pid
-    d.mkdir(parents=True, exist_ok=True)
-    return d
+# Newest version per project: its id, content hash, delta chain length and
+# the stamps of the project document and PNG it was taken from. Kept as the
+# project's HEAD version document and cached here, along with the newest
+# layout itself. Only the worker owning the project's room writes versions,
+# and it drops these when it takes the room's lease.
+VERSION_HEADS: Dict[str, dict] = {}
+_HEAD_LAYOUTS: Dict[str, tuple] = {}
+# Serializes writers of a project's version directory within the owning
+# worker (new versions, pins and retention)
+_VERSION_LOCKS: Dict[str, threading.RLock] = {}
+
+def version_lock(pid: str) -> threading.RLock:
+    return _VERSION_LOCKS.setdefault(pid, threading.RLock())
+
+def load_version_head(pid: str) -> Optional[dict]:
+    if pid not in VERSION_HEADS:
+        head = STORAGE.read_version_doc(pid, "HEAD")
+        if not head:
+            return None
+        VERSION_HEADS[pid] = head
+    return VERSION_HEADS[pid]
+
+def save_version_head(pid: str, head: dict):
+    STORAGE.write_version_doc(pid, "HEAD", head)
+    VERSION_HEADS[pid] = head
 
 def create_version_from_project(pid: str) -> Optional[str]:
-    jpath = project_json_path(pid)
-    if not jpath.exists():
-        return None
-    ver_id = uuid.uuid4().hex
-    ver_dir = ensure_versions_dir_for_project(pid)
-    
-    # Read data safely (should use atomic_read if available, but for consistency)
-    data = load_json_safe(jpath)
-    
-    version_meta = {"id": ver_id, "created": datetime.utcnow().isoformat(), "name": data.get("name")}
-    vjson_path = ver_dir / f"{ver_id}.json"
-    
-    # Day 21: Use atomic write for version files
-    atomic_write_json(vjson_path, {"meta": version_meta, "project": data})
-    
-    png_path = project_png_path(pid)
-    if png_path.exists():
-  
-        shutil.copyfile(png_path, ver_dir / f"{ver_id}.png")
-    return ver_id
+    """Records the project's current state as a version, unless it is unchanged.
 
-def list_versions_for_project(pid: str):
-    ver_dir = VERSIONS_DIR / pid
-    if not ver_dir.exists():
-        return []
-    items = []
-    for f in sorted(ver_dir.glob("*.json"), key=lambda p: p.stat().st_mtime, reverse=True):
-        try:
-            j = json.loads(f.read_text(encoding="utf-8"))
-            meta = j.get("meta", {})
-       
-            vid = meta.get("id") or f.stem
-            created = meta.get("created") or datetime.fromtimestamp(f.stat().st_mtime).isoformat()
-            has_thumb = (ver_dir / f"{vid}.png").exists()
-            items.append({"version": vid, "created": created, "name": meta.get("name"), "thumbnail": has_thumb})
-        except Exception:
-            continue
-    return items
+    Returns the new version id, or the id of the newest version when the
+    project is identical to it (nothing is written in that case).
+    """
+    with version_lock(pid):
+        png_path = project_png_path(pid)
+        stamps = [STORAGE.project_stamp(pid), _file_stamp(png_path)]
+        if stamps[0] is None:
+            return None
+        head = load_version_head(pid)
+        if head and head.get("stamps") == stamps:
+            # Files untouched since the last version: no need to even read them
+            METRICS["versions_skipped_total"] += 1
+            return head["id"]
+
+        data = load_project_doc(pid)
+        layout = data.get("layout", {})
+        layout_bytes = canonical_json(layout)
+        layout_hash = hashlib.sha256(layout_bytes).hexdigest()
+        thumb_blob = put_blob(png_path.read_bytes()) if stamps[1] else None
+        project = {k: v for k, v in data.items() if k != "layout"}
+        content_hash = hashlib.sha256(canonical_json({"project": project, "layout": layout_hash, "thumbnail": thumb_blob})).hexdigest()
+        if head and head.get("content_hash") == content_hash:
+            METRICS["versions_skipped_total"] += 1
+            save_version_head(pid, {**head, "stamps": stamps})
+            return head["id"]
+
+        ver_id = uuid.uuid4().hex
+        version_meta = {
+            "id": ver_id,
+            "created": datetime.utcnow().isoformat(),
+            "name": data.get("name"),
+            "content_hash": content_hash,
+            "layout_hash": layout_hash,
+            "thumbnail_blob": thumb_blob,
+        }
+        chain = 0
+        if head and head.get("chain", 0) + 1 < VERSION_KEYFRAME_INTERVAL:
+            base = head_layout(pid)
+            delta = json_diff(base, layout) if base is not None else None
+            # Fall back to a keyframe when the diff would not be much smaller
+            if delta is not None and len(canonical_json(delta)) * 2 < len(layout_bytes):
+                version_meta["delta_base"] = head["id"]
+                version_meta["delta"] = delta
+                chain = head.get("chain", 0) + 1
+        if not chain:
+            version_meta["layout_blob"] = put_blob(layout_bytes)
+        size = STORAGE.write_version(pid, ver_id, {"meta": version_meta, "project": project})
+        append_version_manifest(pid, {
+            "id": ver_id,
+            "created": version_meta["created"],
+            "name": version_meta["name"],
+            "thumbnail": thumb_blob is not None,
+            "size": size,
+            "parent": head["id"] if head else None,
+            "kind": "delta" if chain else "keyframe",
+        })
+        save_version_head(pid, {"id": ver_id, "content_hash": content_hash, "chain": chain, "stamps": stamps})
+        _HEAD_LAYOUTS[pid] = (ver_id, layout)
+        METRICS["versions_created_total"] += 1
+        METRICS["versions_delta_total" if chain else "versions_keyframe_total"] += 1
+        METRICS["version_bytes_written_total"] += size
+        return ver_id
+
+def head_layout(pid: str) -> Optional[dict]:
+    """Layout of the project's newest version, from cache or rebuilt from disk."""
+    head = load_version_head(pid)
+    if not head:
+        return None
+    cached = _HEAD_LAYOUTS.get(pid)
+    if cached and cached[0] == head["id"]:
+        return cached[1]
+    layout = load_version_layout(pid, head["id"])
+    if layout is not None:
+        _HEAD_LAYOUTS[pid] = (head["id"], layout)
+    return layout
+
+def load_version_layout(pid: str, vid: str, meta: Optional[dict] = None) -> Optional[dict]:
+    """Rebuilds a version's layout from its nearest keyframe.
+
+    Follows delta_base links back to a keyframe (or a legacy version holding
+    its layout inline), then applies the deltas forward. Returns None if the
+    version, a record on its chain or the keyframe's blob is missing.
+    """
+    started = time.perf_counter()
+    deltas = []
+    while True:
+        if meta is None:
+            data = STORAGE.read_version(pid, vid)
+            if not data:
+                return None
+            meta = data.get("meta", {})
+            inline = data.get("project", {}).get("layout")
+        else:
+            inline = None
+        if meta.get("layout_blob"):
+            try:
+                layout = json.loads(read_blob(meta["layout_blob"]))
+            except FileNotFoundError:
+                return None
+            break
+        if "delta_base" not in meta:
+            layout = inline if inline is not None else {}
+            break
+        deltas.append(meta["delta"])
+        vid, meta = meta["delta_base"], None
+    for delta in reversed(deltas):
+        layout = json_patch(layout, delta)
+    METRICS["version_reconstructs_total"] += 1
+    METRICS["version_reconstruct_seconds_sum"] += time.perf_counter() - started
+    METRICS["version_reconstruct_depth_max"] = max(METRICS["version_reconstruct_depth_max"], len(deltas))
+    return layout
+
+def version_thumbnail_path(pid: str, vid: str, meta: Optional[dict] = None) -> Optional[Path]:
+    """Thumbnail of a version: its blob, or the PNG copy older versions kept beside them."""
+    if meta is None:
+        meta = STORAGE.read_version(pid, vid).get("meta", {})
+    if meta.get("thumbnail_blob"):
+        return blob_path(meta["thumbnail_blob"])
+    legacy = VERSIONS_DIR / pid / f"{vid}.png"
+    return legacy if legacy.exists() else None
+
+# Per-project version manifest: one entry per version, oldest first, so
+# listing history never opens the version records themselves. An entry is
+# appended whenever a version is created; projects with older versions get
+# theirs built from the records the first time it is needed.
+def build_version_manifest(pid: str) -> List[dict]:
+    entries = []
+    for vid, record, size, mtime in STORAGE.version_records(pid):
+        meta = record.get("meta", {})
+        vid = meta.get("id") or vid
+        created = meta.get("created") or datetime.fromtimestamp(mtime).isoformat()
+        entries.append({
+            "id": vid,
+            "created": created,
+            "name": meta.get("name"),
+            "thumbnail": version_thumbnail_path(pid, vid, meta) is not None,
+            "size": size,
+            "parent": meta.get("delta_base") or (entries[-1]["id"] if entries else None),
+            "kind": "delta" if "delta_base" in meta else "keyframe",
+        })
+    STORAGE.write_manifest(pid, entries)
+    logging.info(f"[{pid}] Built version manifest ({len(entries)} versions).")
+    return entries
+
+def load_version_manifest(pid: str) -> List[dict]:
+    """All versions of a project, oldest first."""
+    entries = STORAGE.load_manifest(pid)
+    return build_version_manifest(pid) if entries is None else entries
+
+def append_version_manifest(pid: str, entry: dict):
+    # A manifest built just now from the records already lists this version
+    if any(e.get("id") == entry["id"] for e in load_version_manifest(pid)):
+        return
+    STORAGE.append_manifest(pid, entry)
+
+def list_versions_for_project(pid: str, offset: int = 0, limit: Optional[int] = None):
+    """Returns (items, total): a page of versions, newest first, read from the manifest."""
+    entries = load_version_manifest(pid)
+    pins = load_version_pins(pid)
+    total = len(entries)
+    end = max(0, total - offset)
+    start = 0 if limit is None else max(0, end - limit)
+    items = [{
+        "version": e["id"],
+        "created": e.get("created"),
+        "name": e.get("name"),
+        "thumbnail": bool(e.get("thumbnail")),
+        "size": e.get("size"),
+        "parent": e.get("parent"),
+        "kind": e.get("kind"),
+        "pinned": e["id"] in pins,
+    } for e in reversed(entries[start:end])]
+    return items, total
 
 def get_version_json(pid: str, vid: str):
-    vjson = VERSIONS_DIR / pid / f"{vid}.json"
-    if not vjson.exists():
+    """Returns {"meta", "project"} with the layout rebuilt from keyframe and deltas."""
+    data = STORAGE.read_version(pid, vid)
+    if not data:
+        return None
+    meta = data.get("meta", {})
+    if "project" in data and (meta.get("layout_blob") or "delta_base" in meta):
+        layout = load_version_layout(pid, vid, meta)
+        if layout is None:
+            raise HTTPException(status_code=409, detail="Version cannot be rebuilt: its history is incomplete")
+        data["project"]["layout"] = layout
+        meta.pop("delta", None)
+    return data
+
+def revert_project_to_version(pid: str, vid: str, owner: Optional[str]=None) -> Optional[dict]:
+    """Rewrites the project from a version. Returns the restored layout, or None."""
+    data = get_version_json(pid, vid)
+    if not data:
         return None
-    # Fix: Use load_json_safe for consistency
-    return load_json_safe(vjson)
-
-def revert_project_to_version(pid: str, vid: str, owner: Optional[str]=None):
-    vjson = VERSIONS_DIR / pid / f"{vid}.json"
-    if not vjson.exists():
-        return False
-    data = load_json_safe(vjson)
     project_data = data.get("project")
     if not project_data:
-        return False
+        return None
     
     # Use write_project_file which handles atomic write
     if owner:
         project_data["owner"] = owner
     write_project_file(pid, project_data.get("name", pid), project_data.get("layout", {}), owner=project_data.get("owner"))
+    reset_checkpoint(pid, project_data.get("layout", {}))
 
-    vthumb = VERSIONS_DIR / pid / f"{vid}.png"
-    if vthumb.exists():
-        dst = project_png_path(pid)
-        shutil.copyfile(vthumb, dst)
-    return True
+    vthumb = version_thumbnail_path(pid, vid, data.get("meta", {}))
+    if vthumb:
+        try:
+            store_thumbnail(pid, vthumb.read_bytes())
+        except HTTPException as e:
+            logging.warning(f"[{pid}] Version {vid} thumbnail not restored: {e.detail}")
+    return project_data.get("layout", {})
+
+# ---------------------
+# Version retention
+# ---------------------
+_DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+
+def parse_duration(text: str) -> int:
+    text = text.strip().lower()
+    if text[-1:] in _DURATION_UNITS:
+        return int(float(text[:-1]) * _DURATION_UNITS[text[-1]])
+    return int(float(text))
+
+def parse_retention_tiers(spec: str) -> List[tuple]:
+    """"1h:all,1d:1h" -> [(3600, 0), (86400, 3600)]: (max age, keep one per; 0 = all)."""
+    tiers = []
+    for part in spec.split(","):
+        if not part.strip():
+            continue
+        age, _, every = part.partition(":")
+        every = every.strip().lower()
+        tiers.append((parse_duration(age), 0 if every in ("", "all") else parse_duration(every)))
+    return sorted(tiers)
+
+VERSION_RETENTION_TIERS = parse_retention_tiers(VERSION_RETENTION)
+
+def load_version_pins(pid: str) -> set:
+    return set(STORAGE.read_version_doc(pid, "PINS") or [])
+
+def set_version_pinned(pid: str, vid: str, pinned: bool):
+    with version_lock(pid):
+        pins = load_version_pins(pid)
+        if pinned:
+            pins.add(vid)
+        else:
+            pins.discard(vid)
+        STORAGE.write_version_doc(pid, "PINS", sorted(pins))
+
+def _version_timestamp(entry: dict) -> Optional[float]:
+    try:
+        created = datetime.fromisoformat(entry["created"])
+    except Exception:
+        return None
+    if created.tzinfo is None:
+        created = created.replace(tzinfo=timezone.utc)
+    return created.timestamp()
+
+def select_versions_to_keep(entries: List[dict], tiers: List[tuple], keep: set, now: float) -> set:
+    """Adds to `keep` the versions the tiers retain: the newest in each bucket of each tier."""
+    keep = set(keep)
+    buckets = set()
+    for e in reversed(entries):
+        ts = _version_timestamp(e)
+        if ts is None:
+            keep.add(e["id"])
+            continue
+        for max_age, every in tiers:
+            if now - ts < max_age:
+                bucket = (max_age, int(ts // every) if every else e["id"])
+                if bucket not in buckets:
+                    buckets.add(bucket)
+                    keep.add(e["id"])
+                break
+    return keep
+
+def prune_project_versions(pid: str, now: Optional[float] = None) -> tuple:
+    """Applies the retention tiers to one project. Returns (versions removed, bytes freed).
+
+    Versions kept whose delta base is removed are re-based onto their nearest
+    kept ancestor (or become keyframes) before anything is deleted, so every
+    remaining version can still be rebuilt.
+    """
+    if not VERSION_RETENTION_TIERS:
+        return 0, 0
+    now = time.time() if now is None else now
+    with version_lock(pid):
+        entries = load_version_manifest(pid)
+        if not entries:
+            return 0, 0
+        # The newest version is always kept (older projects have no HEAD file)
+        pinned = load_version_pins(pid) | {entries[-1]["id"]}
+        head = load_version_head(pid)
+        if head:
+            pinned.add(head["id"])
+        keep = select_versions_to_keep(entries, VERSION_RETENTION_TIERS, pinned, now)
+        doomed = {e["id"] for e in entries if e["id"] not in keep}
+        if not doomed:
+            return 0, 0
+        records = {vid: STORAGE.read_version(pid, vid) for vid in doomed}
+        by_id = {e["id"]: e for e in entries}
+
+        def kept_base(vid: Optional[str]) -> Optional[str]:
+            while vid in doomed:
+                vid = records[vid].get("meta", {}).get("delta_base")
+            return vid
+
+        for e in entries:
+            if e["id"] in doomed or e.get("kind") != "delta":
+                continue
+            data = STORAGE.read_version(pid, e["id"])
+            meta = data.get("meta", {})
+            if meta.get("delta_base") not in doomed:
+                continue
+            layout = load_version_layout(pid, e["id"], meta)
+            if layout is None:
+                logging.error(f"[{pid}] Version {e['id']} cannot be rebuilt; left as it is")
+                continue
+            base = kept_base(meta.pop("delta_base"))
+            meta.pop("delta", None)
+            delta = json_diff(load_version_layout(pid, base), layout) if base else None
+            layout_bytes = canonical_json(layout)
+            if delta is not None and len(canonical_json(delta)) * 2 < len(layout_bytes):
+                meta["delta_base"], meta["delta"] = base, delta
+            else:
+                meta["layout_blob"] = put_blob(layout_bytes)
+            size = STORAGE.write_version(pid, e["id"], {"meta": meta, "project": data.get("project", {})})
+            e.update(kind="delta" if "delta_base" in meta else "keyframe", size=size)
+
+        kept = []
+        for e in entries:
+            if e["id"] in doomed:
+                continue
+            parent = e.get("parent")
+            while parent in doomed:
+                parent = by_id[parent].get("parent")
+            kept.append({**e, "parent": parent})
+        STORAGE.write_manifest(pid, kept)
+        freed = sum(STORAGE.delete_version(pid, vid) for vid in doomed)
+    return len(doomed), freed
+
+def collect_unreferenced_blobs(grace: int = BLOB_GC_GRACE_SECONDS) -> tuple:
+    """Removes blobs no version or thumbnail references. Returns (blobs removed, bytes freed)."""
+    referenced = set()
+    for _, _, record in STORAGE.iter_versions():
+        meta = record.get("meta", {})
+        referenced.update(d for d in (meta.get("layout_blob"), meta.get("thumbnail_blob")) if d)
+    for record_path in THUMBNAILS_DIR.glob("*.json"):
+        record = load_json_safe(record_path)
+        referenced.update(d for d in [record.get("source"), *record.get("variants", {}).values()] if d)
+    cutoff = time.time() - grace
+    removed = freed = 0
+    for path in BLOBS_DIR.glob("*/*"):
+        if path.name in referenced or path.suffix == ".tmp":
+            continue
+        with _BLOB_LOCK:
+            try:
+                st = path.stat()
+                if st.st_mtime >= cutoff:
+                    continue
+                path.unlink()
+            except FileNotFoundError:
+                continue
+        removed += 1
+        freed += st.st_size
+    return removed, freed
+
+async def run_version_retention() -> dict:
+    """One retention pass over every project, then a blob GC if anything was removed.
+
+    Each project is pruned by the worker that owns its room, the only one
+    that writes its versions.
+    """
+    started = time.perf_counter()
+    pruned = freed = 0
+    for pid in await run_storage(STORAGE.version_projects):
+        try:
+            result = await room_call(pid, "prune_versions")
+        except Exception as e:
+            logging.error(f"[{pid}] Version retention failed: {e}")
+            continue
+        n, size = result["versions_pruned"], result["version_bytes_freed"]
+        if n:
+            logging.info(f"[{pid}] Retention removed {n} versions ({size} bytes).")
+        pruned += n
+        freed += size
+    blobs = blob_bytes = 0
+    if pruned:
+        blobs, blob_bytes = await run_storage(collect_unreferenced_blobs)
+    METRICS["version_retention_runs_total"] += 1
+    METRICS["versions_pruned_total"] += pruned
+    METRICS["version_bytes_freed_total"] += freed
+    METRICS["blobs_collected_total"] += blobs
+    METRICS["blob_bytes_freed_total"] += blob_bytes
+    METRICS["version_retention_seconds_last"] = time.perf_counter() - started
+    return {"versions_pruned": pruned, "version_bytes_freed": freed, "blobs_removed": blobs, "blob_bytes_freed": blob_bytes}
+
+async def prune_room_versions(project_id: str) -> dict:
+    n, size = await run_storage(prune_project_versions, project_id, key=project_id)
+    return {"versions_pruned": n, "version_bytes_freed": size}
 
 # ---------------------
 # Models
@@ -343,6 +1502,9 @@ class SaveProjectRequest(BaseModel):
     layout: Dict[str, Any]
     thumbnail: Optional[str] = None
 
+class CollabSettingsRequest(BaseModel):
+    cursor_tick_hz: float
+
 # ---------------------
 # Auth wrappers
 # ---------------------
@@ -381,6 +1543,8 @@ async def healthz():
             ok["redis"] = "disabled"
     except Exception as e:
         ok["redis"] = f"error: {e}"
+    ok["storage"] = STORAGE.name
+    ok["room_leases"] = ROOM_LEASES_MODE
     return ok
 
 # Day 21: Metrics endpoint
@@ -389,6 +1553,8 @@ def get_metrics():
     """
     Returns Prometheus-compatible metrics.
     """
+    cache_hits = METRICS["project_cache_hits_total"]
+    cache_reads = cache_hits + METRICS["project_cache_misses_total"]
     lines = [
       f"# HELP dream_active_connections Number of currently open WebSocket connections.",
       f"# TYPE dream_active_connections gauge",
@@ -402,12 +1568,241 @@ def get_metrics():
       f"# TYPE dream_batches_total counter",
       f"dream_batches_total {METRICS['batches_total']}",
       
+      f"# HELP dream_resumes_total Reconnects served from the resume buffer instead of a snapshot.",
+      f"# TYPE dream_resumes_total counter",
+      f"dream_resumes_total {METRICS['resumes_total']}",
+      f"# HELP dream_resume_frames_replayed_total Missed frames replayed to resuming clients.",
+      f"# TYPE dream_resume_frames_replayed_total counter",
+      f"dream_resume_frames_replayed_total {METRICS['resume_frames_replayed_total']}",
+      f"# HELP dream_resume_snapshot_fallbacks_total Resume attempts that needed a full snapshot.",
+      f"# TYPE dream_resume_snapshot_fallbacks_total counter",
+      f"dream_resume_snapshot_fallbacks_total {METRICS['resume_snapshot_fallbacks_total']}",
+      f"# HELP dream_snapshot_bytes_sent_total Bytes of connect/resync snapshots sent (after compression).",
+      f"# TYPE dream_snapshot_bytes_sent_total counter",
+      f"dream_snapshot_bytes_sent_total {METRICS['snapshot_bytes_sent_total']}",
+      f"# HELP dream_versions_created_total Project versions written.",
+      f"# TYPE dream_versions_created_total counter",
+      f"dream_versions_created_total {METRICS['versions_created_total']}",
+      f"# HELP dream_versions_skipped_total Version requests skipped because nothing changed.",
+      f"# TYPE dream_versions_skipped_total counter",
+      f"dream_versions_skipped_total {METRICS['versions_skipped_total']}",
+      f"# HELP dream_versions_stored_total Versions written, by how their layout is stored.",
+      f"# TYPE dream_versions_stored_total counter",
+      f'dream_versions_stored_total{{kind="keyframe"}} {METRICS["versions_keyframe_total"]}',
+      f'dream_versions_stored_total{{kind="delta"}} {METRICS["versions_delta_total"]}',
+      f"# HELP dream_version_bytes_written_total Bytes of version records written (deltas inline, keyframes by reference).",
+      f"# TYPE dream_version_bytes_written_total counter",
+      f"dream_version_bytes_written_total {METRICS['version_bytes_written_total']}",
+      f"# HELP dream_version_reconstruct_seconds Time spent rebuilding version layouts from keyframes.",
+      f"# TYPE dream_version_reconstruct_seconds summary",
+      f"dream_version_reconstruct_seconds_sum {METRICS['version_reconstruct_seconds_sum']}",
+      f"dream_version_reconstruct_seconds_count {METRICS['version_reconstructs_total']}",
+      f"# HELP dream_version_reconstruct_depth_max Longest delta chain applied in one rebuild.",
+      f"# TYPE dream_version_reconstruct_depth_max gauge",
+      f"dream_version_reconstruct_depth_max {METRICS['version_reconstruct_depth_max']}",
+      f"# HELP dream_blob_bytes_written_total Bytes of new content written to the blob store.",
+      f"# TYPE dream_blob_bytes_written_total counter",
+      f"dream_blob_bytes_written_total {storage.METRICS['blob_bytes_written_total']}",
+      f"# HELP dream_version_retention_runs_total Retention passes over the versions directory.",
+      f"# TYPE dream_version_retention_runs_total counter",
+      f"dream_version_retention_runs_total {METRICS['version_retention_runs_total']}",
+      f"# HELP dream_version_retention_seconds_last Duration of the last retention pass.",
+      f"# TYPE dream_version_retention_seconds_last gauge",
+      f"dream_version_retention_seconds_last {METRICS['version_retention_seconds_last']}",
+      f"# HELP dream_versions_pruned_total Versions removed by retention.",
+      f"# TYPE dream_versions_pruned_total counter",
+      f"dream_versions_pruned_total {METRICS['versions_pruned_total']}",
+      f"# HELP dream_version_bytes_freed_total Bytes of version records removed by retention.",
+      f"# TYPE dream_version_bytes_freed_total counter",
+      f"dream_version_bytes_freed_total {METRICS['version_bytes_freed_total']}",
+      f"# HELP dream_blobs_collected_total Unreferenced blobs removed after retention.",
+      f"# TYPE dream_blobs_collected_total counter",
+      f"dream_blobs_collected_total {METRICS['blobs_collected_total']}",
+      f"# HELP dream_blob_bytes_freed_total Bytes of unreferenced blobs removed.",
+      f"# TYPE dream_blob_bytes_freed_total counter",
+      f"dream_blob_bytes_freed_total {METRICS['blob_bytes_freed_total']}",
+      f"# HELP dream_auth_tokens_active Auth tokens currently held in the token store.",
+      f"# TYPE dream_auth_tokens_active gauge",
+      f"dream_auth_tokens_active {TOKENS.count()}",
+
+      f"# HELP dream_storage_backend_info Storage backend in use (STORAGE_BACKEND).",
+      f"# TYPE dream_storage_backend_info gauge",
+      f'dream_storage_backend_info{{backend="{STORAGE.name}"}} 1',
+
+      f"# HELP dream_rooms_owned Rooms this worker holds in memory (and, with ROOM_LEASES=file, the lease of).",
+      f"# TYPE dream_rooms_owned gauge",
+      f"dream_rooms_owned {len(PROJECT_ROOMS)}",
+
+      f"# HELP dream_room_leases_acquired_total Room leases taken by this worker.",
+      f"# TYPE dream_room_leases_acquired_total counter",
+      f"dream_room_leases_acquired_total {METRICS['room_leases_acquired_total']}",
+
+      f"# HELP dream_room_leases_released_total Room leases handed back by this worker.",
+      f"# TYPE dream_room_leases_released_total counter",
+      f"dream_room_leases_released_total {METRICS['room_leases_released_total']}",
+
+      f"# HELP dream_room_relay_clients Clients of this worker currently relayed to another worker's room.",
+      f"# TYPE dream_room_relay_clients gauge",
+      f"dream_room_relay_clients {METRICS['room_relay_clients']}",
+
+      f"# HELP dream_room_relay_connections_total Clients relayed to another worker's room.",
+      f"# TYPE dream_room_relay_connections_total counter",
+      f"dream_room_relay_connections_total {METRICS['room_relay_connections_total']}",
+
+      f"# HELP dream_room_relay_calls_total Room calls (undo, redo, rollback, settings) relayed to another worker.",
+      f"# TYPE dream_room_relay_calls_total counter",
+      f"dream_room_relay_calls_total {METRICS['room_relay_calls_total']}",
+
+      f"# HELP dream_auth_tokens_pruned_total Expired auth tokens removed by the prune loop.",
+      f"# TYPE dream_auth_tokens_pruned_total counter",
+      f"dream_auth_tokens_pruned_total {METRICS['auth_tokens_pruned_total']}",
+      f"# HELP dream_cursor_batches_total cursors_batch messages broadcast.",
+      f"# TYPE dream_cursor_batches_total counter",
+      f"dream_cursor_batches_total {METRICS['cursor_batches_total']}",
+      f"# HELP dream_cursor_updates_coalesced_total Cursor/presence updates superseded before their tick.",
+      f"# TYPE dream_cursor_updates_coalesced_total counter",
+      f"dream_cursor_updates_coalesced_total {METRICS['cursor_updates_coalesced_total']}",
+      
+      f"# HELP dream_thumbnails_stored_total Project thumbnails validated and stored.",
+      f"# TYPE dream_thumbnails_stored_total counter",
+      f"dream_thumbnails_stored_total {METRICS['thumbnails_stored_total']}",
+      f"# HELP dream_thumbnails_rejected_total Thumbnail uploads rejected by size or format checks.",
+      f"# TYPE dream_thumbnails_rejected_total counter",
+      f"dream_thumbnails_rejected_total {METRICS['thumbnails_rejected_total']}",
+      f"# HELP dream_thumbnails_refitted_total Thumbnails sent with a save that were re-encoded or downscaled to pass the checks.",
+      f"# TYPE dream_thumbnails_refitted_total counter",
+      f"dream_thumbnails_refitted_total {METRICS['thumbnails_refitted_total']}",
+      f"# HELP dream_thumbnail_variants_built_total Downscaled thumbnail variants built.",
+      f"# TYPE dream_thumbnail_variants_built_total counter",
+      f"dream_thumbnail_variants_built_total {METRICS['thumbnail_variants_built_total']}",
+      f"# HELP dream_thumbnail_variant_seconds_sum Time spent building thumbnail variants.",
+      f"# TYPE dream_thumbnail_variant_seconds_sum counter",
+      f"dream_thumbnail_variant_seconds_sum {METRICS['thumbnail_variant_seconds_sum']}",
+      f"# HELP dream_http_not_modified_total Conditional requests answered with 304 Not Modified.",
+      f"# TYPE dream_http_not_modified_total counter",
+      f"dream_http_not_modified_total {METRICS['http_not_modified_total']}",
+      f"# HELP dream_project_cache_hits_total Project document reads served from the cache.",
+      f"# TYPE dream_project_cache_hits_total counter",
+      f"dream_project_cache_hits_total {METRICS['project_cache_hits_total']}",
+      f"# HELP dream_project_cache_misses_total Project document reads that parsed the file.",
+      f"# TYPE dream_project_cache_misses_total counter",
+      f"dream_project_cache_misses_total {METRICS['project_cache_misses_total']}",
+      f"# HELP dream_project_cache_hit_ratio Share of project document reads served from the cache.",
+      f"# TYPE dream_project_cache_hit_ratio gauge",
+      f"dream_project_cache_hit_ratio {cache_hits / cache_reads if cache_reads else 0.0:.4f}",
+      f"# HELP dream_project_cache_evictions_total Project documents evicted to stay within PROJECT_CACHE_MAX_BYTES.",
+      f"# TYPE dream_project_cache_evictions_total counter",
+      f"dream_project_cache_evictions_total {METRICS['project_cache_evictions_total']}",
+      f"# HELP dream_project_cache_bytes On-disk size of the cached project documents.",
+      f"# TYPE dream_project_cache_bytes gauge",
+      f"dream_project_cache_bytes {PROJECT_CACHE.bytes}",
+      f"# HELP dream_storage_calls_total Blocking storage calls run on the storage pool.",
+      f"# TYPE dream_storage_calls_total counter",
+      f"dream_storage_calls_total {storage.METRICS['storage_calls_total']}",
+      f"# HELP dream_storage_calls_pending Storage calls queued or running.",
+      f"# TYPE dream_storage_calls_pending gauge",
+      f"dream_storage_calls_pending {storage.METRICS['storage_calls_pending']}",
+      f"# HELP dream_storage_wait_seconds_sum Time storage calls spent waiting for a worker.",
+      f"# TYPE dream_storage_wait_seconds_sum counter",
+      f"dream_storage_wait_seconds_sum {storage.METRICS['storage_wait_seconds_sum']}",
+      f"# HELP dream_storage_call_seconds_sum Time storage calls spent running.",
+      f"# TYPE dream_storage_call_seconds_sum counter",
+      f"dream_storage_call_seconds_sum {storage.METRICS['storage_call_seconds_sum']}",
+      f"# HELP dream_event_loop_lag_seconds How late the event loop woke from a timed sleep.",
+      f"# TYPE dream_event_loop_lag_seconds summary",
+      f"dream_event_loop_lag_seconds_sum {METRICS['event_loop_lag_seconds_sum']}",
+      f"dream_event_loop_lag_seconds_count {METRICS['event_loop_lag_samples_total']}",
+      f"# HELP dream_event_loop_lag_seconds_last Most recent event-loop lag sample.",
+      f"# TYPE dream_event_loop_lag_seconds_last gauge",
+      f"dream_event_loop_lag_seconds_last {METRICS['event_loop_lag_seconds_last']}",
+      f"# HELP dream_event_loop_lag_seconds_max Largest event-loop lag sample since start.",
+      f"# TYPE dream_event_loop_lag_seconds_max gauge",
+      f"dream_event_loop_lag_seconds_max {METRICS['event_loop_lag_seconds_max']}",
       f"# HELP dream_last_snapshot_ts Timestamp of the last project snapshot/version save.",
       f"# TYPE dream_last_snapshot_ts gauge",
-      f"dream_last_snapshot_ts {METRICS['last_snapshot_ts']}",
+      f"dream_last_snapshot_ts {storage.METRICS['last_snapshot_ts']}",
+
+      f"# HELP dream_persist_flushes_total Total number of write-behind layout flushes.",
+      f"# TYPE dream_persist_flushes_total counter",
+      f"dream_persist_flushes_total {METRICS['persist_flushes_total']}",
+
+      f"# HELP dream_persist_flush_seconds Time spent writing layout flushes to disk.",
+      f"# TYPE dream_persist_flush_seconds summary",
+      f"dream_persist_flush_seconds_sum {METRICS['persist_flush_seconds_sum']}",
+      f"dream_persist_flush_seconds_count {METRICS['persist_flushes_total']}",
+
+      f"# HELP dream_persist_flush_seconds_last Duration of the most recent layout flush.",
+      f"# TYPE dream_persist_flush_seconds_last gauge",
+      f"dream_persist_flush_seconds_last {METRICS['persist_flush_seconds_last']}",
+
+      f"# HELP dream_persist_coalesced_writes_total Layout writes avoided by coalescing dirty ops into one flush.",
+      f"# TYPE dream_persist_coalesced_writes_total counter",
+      f"dream_persist_coalesced_writes_total {METRICS['persist_coalesced_writes_total']}",
+
+      f"# HELP dream_persist_bytes_written_total Bytes written to project files by layout flushes.",
+      f"# TYPE dream_persist_bytes_written_total counter",
+      f"dream_persist_bytes_written_total {METRICS['persist_bytes_written_total']}",
+
+      f"# HELP dream_journal_batches_total Write batches appended to ops journals.",
+      f"# TYPE dream_journal_batches_total counter",
+      f"dream_journal_batches_total {storage.METRICS['journal_batches_total']}",
+
+      f"# HELP dream_journal_fsyncs_total fsync calls issued by ops journals.",
+      f"# TYPE dream_journal_fsyncs_total counter",
+      f"dream_journal_fsyncs_total {storage.METRICS['journal_fsyncs_total']}",
+
+      f"# HELP dream_journal_write_seconds_sum Time spent in journal writes and fsyncs.",
+      f"# TYPE dream_journal_write_seconds_sum counter",
+      f"dream_journal_write_seconds_sum {storage.METRICS['journal_write_seconds_sum']}",
+
+      f"# HELP dream_journal_compactions_total Journal prefixes rotated into segment files.",
+      f"# TYPE dream_journal_compactions_total counter",
+      f"dream_journal_compactions_total {storage.METRICS['journal_compactions_total']}",
+
+      f"# HELP dream_checkpoints_total Room checkpoints written.",
+      f"# TYPE dream_checkpoints_total counter",
+      f"dream_checkpoints_total {METRICS['checkpoints_total']}",
+
+      f"# HELP dream_broadcast_send_timeouts_total Local broadcast sends that exceeded BROADCAST_SEND_TIMEOUT.",
+      f"# TYPE dream_broadcast_send_timeouts_total counter",
+      f"dream_broadcast_send_timeouts_total {METRICS['broadcast_send_timeouts_total']}",
+
+      f"# HELP dream_send_queue_dropped_total Frames dropped from full client send queues.",
+      f"# TYPE dream_send_queue_dropped_total counter",
+      f"dream_send_queue_dropped_total {METRICS['send_queue_dropped_total']}",
+
+      f"# HELP dream_send_queue_snapshots_total Times queued ops were collapsed into a snapshot.",
+      f"# TYPE dream_send_queue_snapshots_total counter",
+      f"dream_send_queue_snapshots_total {METRICS['send_queue_snapshots_total']}",
+
+      f"# HELP dream_send_queue_evictions_total Slow clients disconnected by the overflow policy or a send timeout.",
+      f"# TYPE dream_send_queue_evictions_total counter",
+      f"dream_send_queue_evictions_total {METRICS['send_queue_evictions_total']}",
+
+      f"# HELP dream_broadcast_encode_seconds Time spent encoding broadcast frames (once per message).",
+      f"# TYPE dream_broadcast_encode_seconds summary",
+      f"dream_broadcast_encode_seconds_sum {METRICS['broadcast_encode_seconds_sum']}",
+      f"dream_broadcast_encode_seconds_count {METRICS['broadcast_encodes_total']}",
     ]
+    # Per room rather than per client: user ids would make one series per
+    # connection, and neither label value is under the server's control
+    depths = {}
+    for project_id, room in list(PROJECT_ROOMS.items()):
+        depths[project_id] = [len(c["outbox"]) for c in list(room["connections"].values()) if c.get("outbox") is not None]
+    lines.append("# HELP dream_room_send_queue_frames Frames waiting in the send queues of a room's clients.")
+    lines.append("# TYPE dream_room_send_queue_frames gauge")
+    for project_id, room_depths in depths.items():
+        lines.append(f'dream_room_send_queue_frames{{project="{prometheus_label(project_id)}"}} {sum(room_depths)}')
+    lines.append("# HELP dream_room_send_queue_depth_max Deepest client send queue in a room.")
+    lines.append("# TYPE dream_room_send_queue_depth_max gauge")
+    for project_id, room_depths in depths.items():
+        lines.append(f'dream_room_send_queue_depth_max{{project="{prometheus_label(project_id)}"}} {max(room_depths, default=0)}')
     return "\n".join(lines)
 
+def prometheus_label(value: Any) -> str:
+    """A label value escaped for the Prometheus text format."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
 
 @app.post("/register")
 def register(req: RegisterRequest):
@@ -417,8 +1812,7 @@ def register(req: RegisterRequest):
         raise HTTPException(status_code=400, detail="username and password required")
     if len(uname) < 3 or len(pwd) < 3:
         raise HTTPException(status_code=400, detail="username and password must be >= 3 chars")
-    users = load_json_safe(USERS_FILE)
-    if uname in users:
+    if get_user_by_username(uname):
         raise HTTPException(status_code=409, detail="user already exists")
     try:
         create_user(uname, pwd)
@@ -474,128 +1868,200 @@ def list_projects(
     mine: Optional[bool] = Query(False),
     authorization: Optional[str] = Header(None)
 ):
-    files = sorted(PROJECTS_DIR.glob("*.json"), key=lambda p: p.stat().st_mtime, reverse=True)
-    items = []
-    for f in files:
-        
-        try:
-            j = load_json_safe(f)
-            pid = j.get("id")
-            name = j.get("name")
-            owner = j.get("owner")
-            if q:
-                ql = q.lower()
-             
-                if not (ql in (name or "").lower() or ql in (pid or "").lower() or ql in json.dumps(j.get("layout", "")).lower()):
-                    continue
-            items.append({
-                "id": pid,
-                "name": name,
-              
-                "owner": owner,
-                "thumbnail": (PROJECTS_DIR / f"{pid}.png").exists(),
-                "thumbnail_url": f"/projects/{pid}/thumbnail" if (PROJECTS_DIR / f"{pid}.png").exists() else None,
-                "updated": datetime.fromtimestamp(f.stat().st_mtime).isoformat()
-            })
-        except Exception:
-            continue
-
+    owner = None
     if mine:
-        username = username_from_auth_header(authorization)
-        if not username:
+        owner = username_from_auth_header(authorization)
+        if not owner:
             raise HTTPException(status_code=401, detail="Unauthorized (mine=true requires login)")
-        items = [it for it in items if it.get("owner") == username]
 
-    total = len(items)
-    start = (page - 1) * limit
-    end = start + limit
-    page_items = items[start:end]
+    # Served from the metadata index: only the requested page is read.
+    # q takes free text plus filters such as `bedrooms>=3 mood:eco has:Kitchen`.
+    rows, total = query_project_index(owner=owner, q=q, limit=limit, offset=(page - 1) * limit)
+    page_items = []
+    for pid, name, row_owner, mtime, thumb, score in rows:
+        if thumb:
+            # Content-addressed small variant: cacheable forever
+            thumbnail_url = f"/thumbnails/{thumb}"
+        else:
+            thumbnail_url = f"/projects/{pid}/thumbnail?size=small" if thumb is not None else None
+        item = {
+            "id": pid,
+            "name": name,
+            "owner": row_owner,
+            "thumbnail": thumb is not None,
+            "thumbnail_url": thumbnail_url,
+            "updated": datetime.fromtimestamp(mtime).isoformat(),
+        }
+        if score:
+            item["score"] = score
+        page_items.append(item)
     return {"projects": page_items, "page": page, "limit": limit, "total": total}
 
 @app.get("/projects/{project_id}")
-def get_project(project_id: str):
+def get_project(project_id: str, if_none_match: Optional[str] = Header(None)):
  
-    path = PROJECTS_DIR / f"{project_id}.json"
-    if not path.exists():
+    etag = stamp_etag(STORAGE.project_stamp(project_id))
+    if etag is None:
+        raise HTTPException(status_code=404, detail="Project not found")
+    cached = not_modified(if_none_match, etag, REVALIDATE_CACHE)
+    if cached:
+        return cached
+    # The stored document is already JSON: send it as is rather than parse and re-encode
+    content = STORAGE.read_project(project_id)
+    if content is None:
         raise HTTPException(status_code=404, detail="Project not found")
-    return load_json_safe(path)
+    return Response(content=content, media_type="application/json", headers={"ETag": etag, "Cache-Control": REVALIDATE_CACHE})
 
 @app.get("/projects/{project_id}/thumbnail")
-def get_thumbnail(project_id: str):
+def get_thumbnail(
+    project_id: str,
+    size: Optional[str] = Query(None),
+    if_none_match: Optional[str] = Header(None),
+):
+    # The URL is stable while the image changes, so clients revalidate (cheap 304s)
+    digest = thumbnail_digest(project_id, size)
+    if digest and blob_path(digest).exists():
+        return blob_response(digest, "image/png", REVALIDATE_CACHE, if_none_match)
     png_path = PROJECTS_DIR / f"{project_id}.png"
-    if not png_path.exists():
+    etag = stat_etag(png_path)
+    if etag is None:
+        raise HTTPException(status_code=404, detail="Thumbnail not found")
+    return not_modified(if_none_match, etag, REVALIDATE_CACHE) or FileResponse(
+        path=str(png_path), media_type="image/png", filename=png_path.name, headers={"ETag": etag, "Cache-Control": REVALIDATE_CACHE})
+
+@app.put("/projects/{project_id}/thumbnail")
+async def upload_thumbnail(project_id: str, request: Request, authorization: Optional[str] = Header(None)):
+    """Replaces the thumbnail with a raw PNG request body, read in chunks up to THUMBNAIL_MAX_BYTES."""
+    username = await run_storage(require_user, authorization)
+    project = await run_storage(load_project_doc, project_id)
+    if not project:
+        raise HTTPException(status_code=404, detail="Project not found")
+    if project.get("owner") != username:
+        raise HTTPException(status_code=403, detail="Forbidden: you do not own this project")
+    if int(request.headers.get("content-length") or 0) > THUMBNAIL_MAX_BYTES:
+        raise _reject_thumbnail(413, f"Thumbnail is larger than {THUMBNAIL_MAX_BYTES} bytes")
+    chunks, size = [], 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > THUMBNAIL_MAX_BYTES:
+            raise _reject_thumbnail(413, f"Thumbnail is larger than {THUMBNAIL_MAX_BYTES} bytes")
+        chunks.append(chunk)
+    digest = await run_storage(store_thumbnail, project_id, b"".join(chunks), key=project_id)
+    return {"status": "ok", "id": project_id, "thumbnail": digest}
+
+@app.get("/thumbnails/{digest}")
+def get_thumbnail_blob(digest: str, if_none_match: Optional[str] = Header(None)):
+    if not re.fullmatch(r"[0-9a-f]{64}", digest) or not blob_path(digest).exists():
         raise HTTPException(status_code=404, detail="Thumbnail not found")
-    return FileResponse(path=str(png_path), media_type="image/png", filename=png_path.name)
+    return blob_response(digest, "image/png", IMMUTABLE_CACHE, if_none_match)
 
 @app.post("/save-project")
 def save_project(req: SaveProjectRequest, authorization: Optional[str] = Header(None)):
     username = require_user(authorization)
+    thumb, thumb_error = thumbnail_for_save(req.thumbnail) if req.thumbnail else (None, None)
     pid = uuid.uuid4().hex
     thumb_name = None
-    if req.thumbnail:
+    if thumb:
       
-        thumb_name = save_thumbnail(pid, req.thumbnail)
+        store_thumbnail(pid, thumb)
+        thumb_name = f"{pid}.png"
     out = write_project_file(pid, req.name, req.layout, owner=username, thumb_filename=thumb_name)
-    return {"status": "ok", "id": pid}
+    result = {"status": "ok", "id": pid}
+    if thumb_error:
+        result["thumbnail_error"] = thumb_error
+    return result
 
 @app.put("/projects/{project_id}")
-def update_project(project_id: str, req: SaveProjectRequest, authorization: Optional[str] = Header(None)):
-    username = require_user(authorization)
-    path = PROJECTS_DIR / f"{project_id}.json"
-    if not path.exists():
+async def update_project(project_id: str, req: SaveProjectRequest, authorization: Optional[str] = Header(None)):
+    username = await run_storage(require_user, authorization)
+    j = await run_storage(load_project_doc, project_id)
+    if not j:
         raise HTTPException(status_code=404, detail="Project not found")
-    j = load_json_safe(path)
     owner = j.get("owner")
     if owner != username:
         raise HTTPException(status_code=403, detail="Forbidden: you do not own this project")
-  
+    # The room owner writes the project, so a live room takes the new layout
+    # instead of flushing its old one over it
+    return await room_call(project_id, "update", project_name=req.name, layout=req.layout, owner=username, thumbnail=req.thumbnail)
+
+def replace_project(project_id: str, name: str, layout: dict, owner: str, thumbnail: Optional[str]) -> dict:
+    """Versions the project, then overwrites it with a new name, layout and thumbnail."""
+    thumb, thumb_error = thumbnail_for_save(thumbnail) if thumbnail else (None, None)
     create_version_from_project(project_id)
-    thumb_name = None
-    if req.thumbnail:
-        thumb_name = save_thumbnail(project_id, req.thumbnail)
-    out = write_project_file(project_id, req.name, req.layout, owner=username, thumb_filename=thumb_name)
-    return {"status": "updated", "id": project_id}
+    # A dropped thumbnail leaves the current one in place
+    thumb_name = (load_project_doc(project_id) or {}).get("thumbnail")
+    if thumb:
+        store_thumbnail(project_id, thumb)
+        thumb_name = f"{project_id}.png"
+    write_project_file(project_id, name, layout, owner=owner, thumb_filename=thumb_name)
+    reset_checkpoint(project_id, layout)
+    result = {"status": "updated", "id": project_id}
+    if thumb_error:
+        result["thumbnail_error"] = thumb_error
+    return result
+
+async def update_room_project(project_id: str, project_name: str, layout: dict, owner: str, thumbnail: Optional[str] = None) -> dict:
+    room = PROJECT_ROOMS.get(project_id)
+    if room:
+        # The version taken before the update records what clients last saw
+        await flush_room(room)
+    result = await run_storage(replace_project, project_id, project_name, layout, owner, thumbnail, key=project_id)
+    room = PROJECT_ROOMS.get(project_id)
+    if room:
+        await reset_room(room, layout)
+    return result
 
 @app.delete("/projects/{project_id}")
-def delete_project(project_id: str, authorization: Optional[str] = Header(None)):
-    username = require_user(authorization)
-    jpath = PROJECTS_DIR / f"{project_id}.json"
-    if not jpath.exists():
+async def delete_project(project_id: str, authorization: Optional[str] = Header(None)):
+    username = await run_storage(require_user, authorization)
+    j = await run_storage(load_project_doc, project_id)
+    if not j:
         raise HTTPException(status_code=404, detail="Project not found")
-    j = load_json_safe(jpath)
     owner = j.get("owner")
     if owner != username:
  
         raise HTTPException(status_code=403, detail="Forbidden: you do not own this project")
+    # The room owner closes the live room first, so nothing flushes the
+    # project back into existence after it is removed
+    return await room_call(project_id, "delete")
+
+def remove_project_files(project_id: str):
     ppath = PROJECTS_DIR / f"{project_id}.png"
     try:
-        jpath.unlink()
+        STORAGE.delete_project(project_id)
     except Exception as e:
-        return JSONResponse(status_code=500, content={"detail": f"Failed to delete json: {e}"})
+        raise HTTPException(status_code=500, detail=f"Failed to delete json: {e}")
+    PROJECT_CACHE.invalidate(project_id)
+    unindex_project(project_id)
+    delete_checkpoint(project_id)
     if ppath.exists():
         try:
-            ppath.unlink()
+            delete_thumbnail(project_id)
         except Exception as e:
        
-            return JSONResponse(status_code=500, content={"detail": f"Deleted json but failed to delete thumbnail: {e}"})
+            raise HTTPException(status_code=500, detail=f"Deleted json but failed to delete thumbnail: {e}")
+
+async def delete_room_project(project_id: str) -> dict:
+    room = PROJECT_ROOMS.pop(project_id, None)
+    if room:
+        await close_deleted_room(project_id, room)
+    await run_storage(remove_project_files, project_id, key=project_id)
     return {"status": "deleted", "id": project_id}
 
 @app.post("/projects/{project_id}/duplicate")
 def duplicate_project(project_id: str, authorization: Optional[str] = Header(None)):
     username = require_user(authorization)
-    src = PROJECTS_DIR / f"{project_id}.json"
-    if not src.exists():
+    j = load_project_doc(project_id)
+    if not j:
         raise HTTPException(status_code=404, detail="Source project not found")
     try:
-        j = load_json_safe(src)
         new_id = uuid.uuid4().hex
         name = j.get("name", "") + " (copy)"
         layout = j.get("layout", {})
         thumb_name = None
         src_thumb = PROJECTS_DIR / f"{project_id}.png"
         if src_thumb.exists():
-            dst_thumb = PROJECTS_DIR / f"{new_id}.png"
-            shutil.copyfile(src_thumb, dst_thumb)
+            store_thumbnail(new_id, src_thumb.read_bytes())
             thumb_name = f"{new_id}.png"
         write_project_file(new_id, name, layout, owner=username, thumb_filename=thumb_name)
    
@@ -605,131 +2071,224 @@ def duplicate_project(project_id: str, authorization: Optional[str] = Header(Non
 
 # ----- Version endpoints -----
 @app.get("/projects/{project_id}/versions")
-def get_versions(project_id: str):
-    items = list_versions_for_project(project_id)
-    return {"versions": items}
+def get_versions(
+    project_id: str,
+    response: Response,
+    page: int = Query(1, ge=1),
+    limit: int = Query(50, ge=1, le=500),
+    if_none_match: Optional[str] = Header(None),
+):
+    # Served from the version manifest: no version record is opened.
+    etag = stamp_etag(*STORAGE.versions_stamp(project_id))
+    if etag:
+        cached = not_modified(if_none_match, etag, REVALIDATE_CACHE)
+        if cached:
+            return cached
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = REVALIDATE_CACHE
+    items, total = list_versions_for_project(project_id, offset=(page - 1) * limit, limit=limit)
+    return {"versions": items, "page": page, "limit": limit, "total": total}
 
 @app.get("/projects/{project_id}/versions/{version_id}")
-def get_version(project_id: str, version_id: str):
+def get_version(project_id: str, version_id: str, response: Response, if_none_match: Optional[str] = Header(None)):
+    # A version never changes once written: its id is its ETag
+    etag = f'"{version_id}"'
+    if STORAGE.version_exists(project_id, version_id):
+        cached = not_modified(if_none_match, etag, IMMUTABLE_CACHE)
+        if cached:
+            return cached
     j = get_version_json(project_id, version_id)
     if not j:
         raise HTTPException(status_code=404, detail="Version not found")
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = IMMUTABLE_CACHE
     return j
 
 @app.get("/projects/{project_id}/versions/{version_id}/thumbnail")
-def get_version_thumbnail(project_id: str, version_id: str):
-    vpng = VERSIONS_DIR / project_id / f"{version_id}.png"
-    if not vpng.exists():
+def get_version_thumbnail(project_id: str, version_id: str, if_none_match: Optional[str] = Header(None)):
+    vpng = version_thumbnail_path(project_id, version_id)
+    if not vpng or not vpng.exists():
         raise HTTPException(status_code=404, detail="Version thumbnail not found")
-    return FileResponse(path=str(vpng), media_type="image/png", filename=vpng.name)
+    etag = f'"{version_id}"'
+    return not_modified(if_none_match, etag, IMMUTABLE_CACHE) or FileResponse(
+        path=str(vpng), media_type="image/png", filename=f"{version_id}.png", headers={"ETag": etag, "Cache-Control": IMMUTABLE_CACHE})
+
+@app.put("/projects/{project_id}/versions/{version_id}/pin")
+async def pin_version(project_id: str, version_id: str, authorization: Optional[str] = Header(None)):
+    return await _set_pin(project_id, version_id, True, authorization)
+
+@app.delete("/projects/{project_id}/versions/{version_id}/pin")
+async def unpin_version(project_id: str, version_id: str, authorization: Optional[str] = Header(None)):
+    return await _set_pin(project_id, version_id, False, authorization)
+
+async def _set_pin(project_id: str, version_id: str, pinned: bool, authorization: Optional[str]):
+    # Pinned versions are never removed by retention
+    username = await run_storage(require_user, authorization)
+    j = await run_storage(load_project_doc, project_id)
+    if not j:
+        raise HTTPException(status_code=404, detail="Project not found")
+    if j.get("owner") != username:
+        raise HTTPException(status_code=403, detail="Forbidden: not your project")
+    if not await run_storage(STORAGE.version_exists, project_id, version_id):
+        raise HTTPException(status_code=404, detail="Version not found")
+    # Set by the room owner, so retention there never misses a new pin
+    await room_call(project_id, "pin", version_id=version_id, pinned=pinned)
+    return {"status": "pinned" if pinned else "unpinned", "id": project_id, "version": version_id}
+
+async def pin_room_version(project_id: str, version_id: str, pinned: bool) -> dict:
+    await run_storage(set_version_pinned, project_id, version_id, pinned, key=project_id)
+    return {"status": "ok"}
 
 @app.post("/projects/{project_id}/versions/{version_id}/revert")
-def revert_version(project_id: str, version_id: str, authorization: Optional[str] = Header(None)):
-    username = require_user(authorization)
-    jpath = PROJECTS_DIR / f"{project_id}.json"
-    if not jpath.exists():
+async def revert_version(project_id: str, version_id: str, authorization: Optional[str] = Header(None)):
+    username = await run_storage(require_user, authorization)
+    j = await run_storage(load_project_doc, project_id)
+    if not j:
         raise HTTPException(status_code=404, detail="Project not found")
-    j = load_json_safe(jpath)
     owner = j.get("owner")
     if owner != username:
         raise HTTPException(status_code=403, detail="Forbidden: not your project")
-    ok = revert_project_to_version(project_id, 
-        version_id, owner=username)
-    if not ok:
+    return await room_call(project_id, "revert", version_id=version_id, owner=username)
+
+async def revert_room_project(project_id: str, version_id: str, owner: str) -> dict:
+    layout = await run_storage(revert_project_to_version, project_id, version_id, owner, key=project_id)
+    if layout is None:
         raise HTTPException(status_code=500, detail="Failed to revert to version")
+    room = PROJECT_ROOMS.get(project_id)
+    if room:
+        await reset_room(room, layout)
     return {"status": "reverted", "id": project_id, "version": version_id}
 
 @app.post("/projects/{project_id}/undo")
 async def undo_project_op(project_id: str):
+    return await room_call(project_id, "undo")
+
+async def undo_room_op(project_id: str) -> dict:
     room = PROJECT_ROOMS.get(project_id)
-    if not room or not room.get("undo_stack"):
+    if not room:
         raise HTTPException(status_code=400, detail="Nothing to undo")
-    
-    async with room["lock"]:
-        op_to_undo = room["undo_stack"].pop()
-        room.setdefault("redo_stack", []).append(op_to_undo)
-        rebuild_layout_from_ops(project_id, room)
- 
-        persist_project_layout(project_id, room["layout"])
-        logging.info(f"[{project_id}] REST API triggered undo for op: {op_to_undo.get('opId')}")
-        
+    op_to_undo = await move_room_history(room, "undo", "server")
+    await persist_room_change(room)
+
+    await drain_broadcast_queue(room)
     undo_msg = {"type": "undo", "opId": op_to_undo.get("opId"), "from": "server", "ts": datetime.utcnow().isoformat()}
-    await _redis_publish(project_id, undo_msg)
+    await broadcast(project_id, undo_msg)
     return {"status": "ok", "undone_op": op_to_undo}
 
 @app.post("/projects/{project_id}/redo")
 async def redo_project_op(project_id: str):
+    return await room_call(project_id, "redo")
+
+async def redo_room_op(project_id: str) -> dict:
     room = PROJECT_ROOMS.get(project_id)
-    if not room or not room.get("redo_stack"):
+    if not room:
         raise HTTPException(status_code=400, detail="Nothing to redo")
-    
-    async with room["lock"]:
-  
-        op_to_redo = room["redo_stack"].pop()
-        apply_op_to_layout(room["layout"], op_to_redo.get("op"))
-        room.setdefault("undo_stack", []).append(op_to_redo)
-        persist_project_layout(project_id, room["layout"])
-        logging.info(f"[{project_id}] REST API triggered redo for op: {op_to_redo.get('opId')}")
-    
+    op_to_redo = await move_room_history(room, "redo", "server")
+    await persist_room_change(room)
+
+    await drain_broadcast_queue(room)
     redo_msg = {"type": "redo", "opId": op_to_redo.get("opId"), "from": "server", "ts": datetime.utcnow().isoformat()}
-    await _redis_publish(project_id, redo_msg)
+    await broadcast(project_id, redo_msg)
     return {"status": "ok", "redone_op": op_to_redo}
 
+@app.put("/projects/{project_id}/collab-settings")
+async def update_collab_settings(project_id: str, req: CollabSettingsRequest, authorization: Optional[str] = Header(None)):
+    username = await run_storage(require_user, authorization)
+    j = await run_storage(load_project_doc, project_id)
+    if not j:
+        raise HTTPException(status_code=404, detail="Project not found")
+    if j.get("owner") != username:
+        raise HTTPException(status_code=403, detail="Forbidden: you do not own this project")
+    if not (CURSOR_TICK_HZ_MIN <= req.cursor_tick_hz <= CURSOR_TICK_HZ_MAX):
+        raise HTTPException(status_code=400, detail=f"cursor_tick_hz must be between {CURSOR_TICK_HZ_MIN:g} and {CURSOR_TICK_HZ_MAX:g}")
+    CURSOR_TICK_OVERRIDES[project_id] = req.cursor_tick_hz
+    return await room_call(project_id, "cursor_tick", hz=req.cursor_tick_hz)
+
+async def set_room_cursor_tick(project_id: str, hz: float) -> dict:
+    CURSOR_TICK_OVERRIDES[project_id] = hz
+    room = PROJECT_ROOMS.get(project_id)
+    if room:
+        # Picked up by cursor_loop on its next tick
+        room["cursor_tick_hz"] = hz
+    return {"status": "ok", "id": project_id, "cursor_tick_hz": hz}
+
 # Day 20: New Rollback Endpoint
 @app.post("/projects/{project_id}/rollback/{version_id}")
 async def rollback_project(project_id: str, version_id: str):
-    j = get_version_json(project_id, version_id)
+    j = await run_storage(get_version_json, project_id, version_id, key=project_id)
   
     if not j or not j.get("project"):
         raise HTTPException(status_code=404, detail="Version not found")
     
-    layout_to_restore = j["project"]["layout"]
-    
-    room = PROJECT_ROOMS.get(project_id)
-    if not room:
-        room = get_or_create_room(project_id)
+    return await room_call(project_id, "rollback", version_id=version_id, layout=j["project"]["layout"])
 
+async def rollback_room(project_id: str, version_id: str, layout: dict) -> dict:
+    room = await open_room(project_id)
+    await reset_room(room, layout)
+    return {"status": "ok", "version_id": version_id}
+
+async def reset_room(room: dict, layout: dict):
+    """Replaces a live room's layout, drops its history and sends clients the new snapshot."""
     async with room["lock"]:
-        room["layout"] = layout_to_restore
-        room["undo_stack"] = []
-        room["redo_stack"] = []
-        persist_project_layout(project_id, 
-            room["layout"])
+        room["layout"] = RoomLayout(layout)
+        room["undo_stack"].clear()
+        room["redo_stack"].clear()
+        mark_room_dirty(room)
+    # Checkpoint right away: the cleared history must not be rebuilt from
+    # journal records written before the reset.
+    await flush_room(room, checkpoint=True)
     
     # Broadcast snapshot to all clients
     snapshot_msg = {
         "type": "snapshot",
-        "layout": room["layout"],
+        "layout": room["layout"].to_dict(),
         "clients": list(room["clients_meta"].values()),
         "ts": datetime.utcnow().isoformat()
     }
-    await _redis_publish(project_id, snapshot_msg)
-    return {"status": "ok", "version_id": version_id}
+    await broadcast(room["id"], snapshot_msg)
 
 @app.get("/projects/{project_id}/ops/recent")
-async def get_recent_ops(project_id: str, count: int = 10):
-    ops_path = OPS_DIR / f"{project_id}.log"
-    if not ops_path.exists():
-      
-        return {"ops": []}
-    
-    ops = []
-    with open(ops_path, 'r') as f:
-        lines = f.readlines()
-        
-    for line in lines[-count:]:
+async def get_recent_ops(
+    project_id: str,
+    count: int = Query(10, ge=1, le=1000),
+    before: Optional[str] = Query(None),
+):
+    # Pages backwards through history: pass next_before as `before` for older ops.
+    ops = await run_storage(STORAGE.recent_ops, project_id, count, before)
+    if ops is None:
+        raise HTTPException(status_code=404, detail="Op not found")
+    next_before = ops[-1].get("opId") if len(ops) == count else None
+    return {"ops": ops, "next_before": next_before}
+
+@app.get("/projects/{project_id}/ops")
+async def get_ops(
+    project_id: str,
+    since_seq: Optional[int] = Query(None, ge=0),
+    since: Optional[str] = Query(None),
+    limit: int = Query(100, ge=1, le=1000),
+):
+    # Forward reads by journal record number or time (ISO string or epoch
+    # seconds), seeking through the sparse journal index.
+    since_ts = None
+    if since is not None:
         try:
-            ops.append(json.loads(line))
-        except json.JSONDecodeError:
-            continue
-            
-    
-    return {"ops": ops[::-1]}
-
-def rebuild_layout_from_ops(project_id: str, room: dict):
-    room["layout"] = {"rooms": [], "meta": {}}
-    for op_record in room["undo_stack"]:
-        apply_op_to_layout(room["layout"], op_record.get("op"))
+            since_ts = float(since)
+        except ValueError:
+            since_ts = _record_time({"ts": since}, None)
+        if since_ts is None:
+            raise HTTPException(status_code=400, detail="since must be an ISO timestamp or epoch seconds")
+    first, ops = await run_storage(STORAGE.read_ops, project_id, since_seq, since_ts, limit)
+    return {"ops": ops, "from_seq": first, "next_seq": first + len(ops)}
+
+@app.get("/projects/{project_id}/ops/export")
+def export_ops(project_id: str):
+    if not STORAGE.has_journal(project_id):
+        raise HTTPException(status_code=404, detail="No ops recorded for project")
+    return StreamingResponse(
+        STORAGE.export_ops(project_id),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{project_id}-ops.ndjson"'},
+    )
 
 # ---------------------
 # In-memory rooms for WS (multi-room)
@@ -739,28 +2298,83 @@ SUBSCRIBE_TASKS: Dict[str, asyncio.Task] = {}
 AUTOSAVE_INTERVAL_SECONDS = 30
 AUTOSAVE_TASKS = {}
 
-def get_or_create_room(project_id: str) -> Dict[str, Any]:
+async def open_room(project_id: str) -> Dict[str, Any]:
+    """get_or_create_room, with the room's state loaded on the storage pool."""
+    if project_id in PROJECT_ROOMS:
+        return get_or_create_room(project_id)
+    state = await run_storage(load_room_state, project_id, key=project_id)
+    # Another connection may have opened the room while this one was loading
+    return get_or_create_room(project_id, None if project_id in PROJECT_ROOMS else state)
+
+def get_or_create_room(project_id: str, state: Optional[dict] = None) -> Dict[str, Any]:
     if project_id not in PROJECT_ROOMS:
+        if state is None:
+            state = load_room_state(project_id)
         PROJECT_ROOMS[project_id] = {
             # Day 21: Change connections from set to dict for heartbeat tracking
             "connections": {}, # Key: user_id, Value: {"ws": websocket, "last_pong": time.time()}
          
             "clients_meta": {},
-            "layout": load_project_layout(project_id),
+            "layout": state["layout"],
             "lock": asyncio.Lock(),
-            "undo_stack": replay_ops(project_id),
-            "redo_stack": [],
+            "undo_stack": state["undo_stack"],
+            "redo_stack": state["redo_stack"],
             "last_saved_at": time.time(),
             # Day 21: Batch buffer
             "_broadcast_queue": [], 
             "_batcher_task": None,
+            # Latest cursor/presence update per user, flushed by cursor_loop
+            "_cursor_pending": {},
+            "_cursor_task": None,
+            "cursor_tick_hz": CURSOR_TICK_OVERRIDES.get(project_id, CURSOR_TICK_HZ),
+            # Resume: sequence of layout-changing frames and the recent ones
+            "epoch": state["epoch"],
+            "seq": state["seq"],
+            "_resume_buffer": deque(maxlen=RESUME_BUFFER_SIZE),
+            # Journaled changes not yet broadcast, and the seq last checkpointed
+            "_undelivered": 0,
+            "_checkpoint_seq": state["seq"],
+            # Write-behind persistence state
+            "_dirty_ops": 0,
+            "_flush_event": asyncio.Event(),
+            "_flush_lock": asyncio.Lock(),
+            "_flush_task": None,
+            # Journal position the in-memory state corresponds to
+            "_journal_offset": get_journal(project_id).offset,
+            "_last_op_id": state["last_op_id"],
+            "_ops_since_checkpoint": 0,
+            # Ops whose journal write failed, waiting to be reverted newest first
+            "_unjournaled": {},
             "id": project_id # Added for batcher loop reference
         }
-        # Day 21: Start batcher task if it's not running
-        room = PROJECT_ROOMS[project_id]
-        if not room["_batcher_task"]:
-            room["_batcher_task"] = asyncio.create_task(batcher_loop(room))
-    return PROJECT_ROOMS[project_id]
+    # Day 21: Start batcher task if it's not running. Both loops are cancelled
+    # when a room empties, so they are restarted here on the next join.
+    room = PROJECT_ROOMS[project_id]
+    if not room["_batcher_task"] or room["_batcher_task"].done():
+        room["_batcher_task"] = asyncio.create_task(batcher_loop(room))
+    if not room["_flush_task"] or room["_flush_task"].done():
+        room["_flush_task"] = asyncio.create_task(flush_loop(room))
+    if not room["_cursor_task"] or room["_cursor_task"].done():
+        room["_cursor_task"] = asyncio.create_task(cursor_loop(room))
+    return room
+
+async def drain_broadcast_queue(room: dict):
+    """Sends the ops queued for the room as one ops_batch.
+
+    Also called before undo/redo broadcasts so peers never see an undo ahead
+    of the op it reverts.
+    """
+    to_send = room["_broadcast_queue"].copy()
+    room["_broadcast_queue"].clear()
+    if not to_send:
+        return
+
+    batch_msg = {"type":"ops_batch","ops": to_send, "ts": datetime.utcnow().isoformat()}
+
+    # Fan out to local clients; Redis only relays to other processes
+    await broadcast(room["id"], batch_msg)
+
+    METRICS["batches_total"] += 1
 
 # Day 21: Batcher loop (defined here for scope)
 async def batcher_loop(room: dict):
@@ -772,60 +2386,377 @@ async def batcher_loop(room: dict):
             if not room.get("_broadcast_queue"):
                 continue
             
-            to_send = room["_broadcast_queue"].copy()
-            room["_broadcast_queue"].clear()
-            
-            if not to_send:
-                continue
-
-            batch_msg = {"type":"ops_batch","ops": to_send, "ts": datetime.utcnow().isoformat()}
-            
-            # Broadcast aggregated ops via Redis
-            await _redis_publish(project_id, batch_msg)
-            
-            METRICS["batches_total"] += 1
+            await drain_broadcast_queue(room)
 
     except asyncio.CancelledError:
         logging.info(f"[{project_id}] Batcher loop cancelled.")
     except Exception as e:
         logging.error(f"[{project_id}] Batcher loop error: {e}")
     finally:
-        room["_batcher_task"] = None
+        if room.get("_batcher_task") is asyncio.current_task():
+            room["_batcher_task"] = None
+
+def queue_cursor_update(room: dict, user_id: str, cursor: Any = None, meta: Optional[dict] = None, ts: Optional[str] = None):
+    """Records a user's latest cursor/presence; only the newest per tick is sent."""
+    entry = room["_cursor_pending"].get(user_id)
+    if entry is None:
+        entry = room["_cursor_pending"][user_id] = {"userId": user_id}
+    else:
+        METRICS["cursor_updates_coalesced_total"] += 1
+    if cursor is not None:
+        entry["cursor"] = cursor
+    if meta is not None:
+        entry.setdefault("meta", {}).update(meta)
+    entry["ts"] = ts
+
+async def cursor_loop(room: dict):
+    project_id = room["id"]
+    try:
+        while True:
+            await asyncio.sleep(1.0 / room["cursor_tick_hz"])
+
+            if not room["_cursor_pending"]:
+                continue
+
+            pending = room["_cursor_pending"]
+            room["_cursor_pending"] = {}
+
+            batch_msg = {"type": "cursors_batch", "cursors": list(pending.values()), "ts": datetime.utcnow().isoformat()}
+            await broadcast(project_id, batch_msg)
+
+            METRICS["cursor_batches_total"] += 1
+
+    except asyncio.CancelledError:
+        logging.info(f"[{project_id}] Cursor loop cancelled.")
+    except Exception as e:
+        logging.error(f"[{project_id}] Cursor loop error: {e}")
+    finally:
+        if room.get("_cursor_task") is asyncio.current_task():
+            room["_cursor_task"] = None
 
 
+# ---------------------
+# Write-behind layout persistence
+# ---------------------
+def mark_room_dirty(room: dict, ops: int = 1) -> None:
+    """Records that the in-memory layout has diverged from the project file.
+
+    Must be called with room["lock"] held. The flush loop picks the change up
+    on its next tick, or immediately once PERSIST_FLUSH_MAX_OPS is reached.
+    """
+    room["_dirty_ops"] += ops
+    if room["_dirty_ops"] >= PERSIST_FLUSH_MAX_OPS:
+        room["_flush_event"].set()
+
+def journal_room_record(room: dict, record: dict) -> asyncio.Future:
+    """Journals a change that was just applied to the room and marks it dirty.
+
+    Must be called with room["lock"] held, in the same critical section that
+    applied the change, so journal order and checkpoint offsets line up with
+    the in-memory state.
+    """
+    fut = append_op_record(room["id"], record)
+    room["_journal_offset"] = get_journal(room["id"]).offset
+    room["_last_op_id"] = record.get("opId")
+    room["_ops_since_checkpoint"] += 1
+    room["_undelivered"] += 1
+    mark_room_dirty(room)
+    return fut
+
+def revert_unjournaled_op(room: dict, op_record: dict, redo_stack: list, last_op_id: Optional[str]) -> int:
+    """Takes back an op whose journal write failed, so the room never holds
+    a change the journal (and so a checkpoint reload) does not have.
+
+    Must be called with room["lock"] held. `redo_stack` and `last_op_id` are
+    the room's values from before the op was applied. Ops are reverted
+    newest first: one with another failed op still above it (a record from
+    the same journal batch) waits in room["_unjournaled"] until that one has
+    been reverted. Returns the number of ops reverted.
+    """
+    room["_unjournaled"][op_record["opId"]] = (redo_stack, last_op_id)
+    return _revert_unjournaled_ops(room)
+
+def _revert_unjournaled_ops(room: dict) -> int:
+    stack = room["undo_stack"]
+    reverted = 0
+    while stack and stack[-1].get("opId") in room["_unjournaled"]:
+        record = stack.pop()
+        undo_op_record(room["layout"], record)
+        redo_stack, room["_last_op_id"] = room["_unjournaled"].pop(record["opId"])
+        room["redo_stack"].clear()
+        room["redo_stack"].extend(redo_stack)
+        reverted += 1
+    if reverted:
+        _forget_unjournaled(room, reverted)
+    return reverted
+
+def _forget_unjournaled(room: dict, records: int):
+    room["_ops_since_checkpoint"] = max(0, room["_ops_since_checkpoint"] - records)
+    room["_undelivered"] = max(0, room["_undelivered"] - records)
+    room["_journal_offset"] = get_journal(room["id"]).offset
+    mark_room_dirty(room)
+
+def revert_unjournaled_history(room: dict, action: str, op_record: dict, last_op_id: Optional[str]) -> bool:
+    """Takes back an undo or redo of `op_record` whose journal write failed.
+
+    Must be called with room["lock"] held. Only possible while the op is
+    still on top of the stack the move put it on; returns False if the room
+    has moved on since. An op whose own journal write failed and that waited
+    behind this move is reverted along with it.
+    """
+    moved_to, moved_from = ((room["redo_stack"], room["undo_stack"]) if action == "undo"
+                            else (room["undo_stack"], room["redo_stack"]))
+    if not moved_to or moved_to[-1] is not op_record:
+        return False
+    moved_to.pop()
+    (apply_op_record if action == "undo" else undo_op_record)(room["layout"], op_record)
+    moved_from.append(op_record)
+    room["_last_op_id"] = last_op_id
+    _forget_unjournaled(room, 1)
+    _revert_unjournaled_ops(room)
+    return True
+
+async def move_room_history(room: dict, action: str, user_id: str) -> dict:
+    """Undoes or redoes the newest op on the room's undo or redo stack and
+    journals the move. Returns the op.
+
+    Raises HTTPException 400 when there is nothing to move, and 503 when the
+    journal write failed; the move is taken back first, so the room never
+    holds a state a checkpoint reload would not rebuild.
+    """
+    source, target = ("undo_stack", "redo_stack") if action == "undo" else ("redo_stack", "undo_stack")
+    async with room["lock"]:
+        if not room[source]:
+            raise HTTPException(status_code=400, detail=f"Nothing to {action}")
+        op_record = room[source].pop()
+        (undo_op_record if action == "undo" else apply_op_record)(room["layout"], op_record)
+        room[target].append(op_record)
+        last_before = room["_last_op_id"]
+        journaled = journal_room_record(room, history_record(user_id, action, op_record.get("opId")))
+        logging.info(f"[{room['id']}] User {user_id} triggered {action} for op: {op_record.get('opId')}")
+    try:
+        await journaled
+    except Exception as ex:
+        logging.error(f"[{room['id']}] Journaling {action} failed: {ex}")
+        async with room["lock"]:
+            reverted = revert_unjournaled_history(room, action, op_record, last_before)
+        if not reverted:
+            # Other changes landed on top of the move: keep it, and checkpoint
+            # the room so a reload starts from exactly this state
+            try:
+                await flush_room(room, checkpoint=True)
+                return op_record
+            except Exception as cp_ex:
+                logging.error(f"[{room['id']}] Checkpoint after failed {action} failed: {cp_ex}")
+        raise HTTPException(status_code=503, detail=f"{action} could not be journaled")
+    return op_record
+
+def room_needs_checkpoint(room: dict) -> bool:
+    """True if the room has journal records or a resume position not yet checkpointed."""
+    return room["_ops_since_checkpoint"] > 0 or room["_checkpoint_seq"] != room["seq"]
+
+def history_record(user_id: str, action: str, target_op_id: Optional[str]) -> dict:
+    """Journal record for an undo or redo of `target_op_id`."""
+    return {"opId": str(uuid.uuid4()), "from": user_id, "ts": datetime.utcnow().isoformat(), action: target_op_id}
+
+async def flush_room(room: dict, force: bool = False, checkpoint: bool = False) -> bool:
+    """Writes the room layout to disk if it is dirty (or if force is set).
+
+    The layout is copied under room["lock"] and written from a worker thread,
+    so ops keep flowing while the file is rewritten. Flushes for the same room
+    are serialized by room["_flush_lock"] so an older copy never lands last.
+    A checkpoint is taken afterwards once CHECKPOINT_EVERY_OPS journal records
+    have accumulated, or unconditionally when checkpoint is set.
+    """
+    project_id = room["id"]
+    if room.get("_deleted"):
+        return False
+    async with room["_flush_lock"]:
+        layout = None
+        async with room["lock"]:
+            pending = room["_dirty_ops"]
+            if pending or force:
+                layout = copy.deepcopy(room["layout"].to_dict())
+                room["_dirty_ops"] = 0
+                room["_flush_event"].clear()
+
+        if layout is not None:
+            started = time.perf_counter()
+            try:
+                written = await get_journal(project_id).write_layout(layout)
+            except Exception:
+                # Put the ops back so the next tick retries the write.
+                async with room["lock"]:
+                    room["_dirty_ops"] += pending
+                raise
+            elapsed = time.perf_counter() - started
+
+        if checkpoint or room["_ops_since_checkpoint"] >= CHECKPOINT_EVERY_OPS:
+            await checkpoint_room(room)
+
+    if layout is None:
+        return False
+    METRICS["persist_flushes_total"] += 1
+    METRICS["persist_flush_seconds_sum"] += elapsed
+    METRICS["persist_flush_seconds_last"] = elapsed
+    METRICS["persist_coalesced_writes_total"] += max(0, pending - 1)
+    METRICS["persist_bytes_written_total"] += written
+    return True
+
+async def persist_room_change(room: dict) -> None:
+    """Flushes a change made outside a client session (REST undo/redo).
+
+    A room whose clients have all left has no flush loop, so nothing else
+    would write the change to the project file.
+    """
+    task = room.get("_flush_task")
+    if task is None or task.done():
+        await flush_room(room)
+
+async def flush_loop(room: dict):
+    project_id = room["id"]
+    try:
+        while True:
+            try:
+                await asyncio.wait_for(room["_flush_event"].wait(), timeout=PERSIST_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await flush_room(room)
+            except Exception as e:
+                logging.error(f"[{project_id}] Layout flush failed: {e}")
+                await asyncio.sleep(PERSIST_FLUSH_INTERVAL)
+    except asyncio.CancelledError:
+        logging.info(f"[{project_id}] Flush loop cancelled.")
+    finally:
+        if room.get("_flush_task") is asyncio.current_task():
+            room["_flush_task"] = None
+
 # ---------------------
 # Apply op to layout
 # ---------------------
-def apply_op_to_layout(layout: dict, op: dict) -> None:
-    if not layout:
-        layout = {"rooms": [], "meta": {}}
+class RoomLayout:
+    """In-memory room layout with a name -> slot index over its room list.
+
+    Removing a room leaves a None tombstone in its slot so no other slot moves,
+    which keeps add/update/remove O(1). Tombstones are compacted away once they
+    outnumber live rooms; `generation` changes whenever that happens so stale
+    slot numbers held by inverse ops can be detected. to_dict() produces the
+    same {"rooms": [...], "meta": {...}} document clients get in snapshots.
+    """
+
+    def __init__(self, layout: Optional[dict] = None):
+        layout = layout or {}
+        self.extra = {k: v for k, v in layout.items() if k not in ("rooms", "meta")}
+        self.meta = layout.get("meta", {})
+        self.slots: List[Optional[dict]] = list(layout.get("rooms", []))
+        self.generation = 0
+        self._tombstones = 0
+        self._reindex()
+
+    def _reindex(self):
+        self.index: Dict[Any, List[int]] = {}
+        for i, r in enumerate(self.slots):
+            if r is not None:
+                self.index.setdefault(r.get("name"), []).append(i)
+
+    def _compact(self):
+        self.slots = [r for r in self.slots if r is not None]
+        self._tombstones = 0
+        self.generation += 1
+        self._reindex()
+
+    def __contains__(self, name) -> bool:
+        return name in self.index
+
+    def __len__(self) -> int:
+        return len(self.slots) - self._tombstones
+
+    def get(self, name) -> Optional[dict]:
+        slots = self.index.get(name)
+        return self.slots[slots[0]] if slots else None
+
+    def add(self, room: dict):
+        self.index.setdefault(room.get("name"), []).append(len(self.slots))
+        self.slots.append(room)
+
+    def remove(self, name) -> List[list]:
+        """Removes every room with this name; returns [slot, room] pairs."""
+        removed = [[i, self.slots[i]] for i in self.index.pop(name, [])]
+        for i, _ in removed:
+            self.slots[i] = None
+        self._tombstones += len(removed)
+        if self._tombstones > max(32, len(self)):
+            self._compact()
+        return removed
+
+    def restore(self, rooms: List[list], generation: Optional[int]):
+        """Puts removed rooms back in their old slots, or at the end if the
+        slots were compacted away since."""
+        for i, r in rooms:
+            if generation == self.generation and i < len(self.slots) and self.slots[i] is None:
+                self.slots[i] = r
+                self._tombstones -= 1
+                slots = self.index.setdefault(r.get("name"), [])
+                slots.append(i)
+                slots.sort()
+            else:
+                self.add(r)
+
+    def to_dict(self) -> dict:
+        return {**self.extra, "rooms": [r for r in self.slots if r is not None], "meta": self.meta}
+
+def apply_op_to_layout(layout: RoomLayout, op: dict) -> Optional[dict]:
+    """Applies an op to a layout in place.
+
+    Returns the op that reverses it, computed from the state the op replaced,
+    or None if the op changed nothing. `room:restore` is the internal inverse
+    of `room:remove` and puts removed rooms back where they were.
+    """
     kind = op.get("kind")
     if kind == "room:add":
         room = op.get("room", {})
-        if not any(r.get("name") == room.get("name") for r in layout.get("rooms", [])):
-            layout.setdefault("rooms", []).append(room)
+        if room.get("name") not in layout:
+            layout.add(dict(room))
+            return {"kind": "room:remove", "name": room.get("name")}
     elif kind == "room:remove":
         name = op.get("name")
-        layout["rooms"] = [r for r in layout.get("rooms", []) 
-            if r.get("name") != name]
+        removed = layout.remove(name)
+        if removed:
+            return {"kind": "room:restore", "rooms": removed, "generation": layout.generation}
+    elif kind == "room:restore":
+        rooms = op.get("rooms", [])
+        if rooms:
+            layout.restore(rooms, op.get("generation"))
+            return {"kind": "room:remove", "name": rooms[0][1].get("name")}
     elif kind == "room:update":
         updated = op.get("room", {})
         name = updated.get("name")
         if not name:
-            return
-        found = False
-        for i, r in enumerate(layout.get("rooms", [])):
-            if r.get("name") == name:
-         
-                new_room = dict(r)
-                for k, v in updated.items():
-                    new_room[k] = v
-                layout["rooms"][i] = new_room
-                found = True
-             
-                break
-        if not found:
-            layout.setdefault("rooms", []).append(updated)
+            return None
+        r = layout.get(name)
+        if r is None:
+            layout.add(dict(updated))
+            return {"kind": "room:remove", "name": name}
+        unset = op.get("unset", [])
+        prior = {k: r[k] for k in list(updated) + unset if k in r}
+        prior["name"] = name
+        inverse = {"kind": "room:update", "room": prior, "unset": [k for k in updated if k not in r]}
+        r.update(updated)
+        for k in unset:
+            r.pop(k, None)
+        return inverse
+    return None
+
+def apply_op_record(layout: RoomLayout, op_record: dict) -> None:
+    """Applies (or re-applies, for redo) an op record and refreshes its inverse."""
+    op_record["inverse"] = apply_op_to_layout(layout, op_record.get("op") or {})
+
+def undo_op_record(layout: RoomLayout, op_record: dict) -> None:
+    """Reverts an op record by applying the inverse captured when it was applied."""
+    inverse = op_record.get("inverse")
+    if inverse:
+        apply_op_to_layout(layout, inverse)
 
 # ---------------------
 # Redis pub/sub subscriber loop
@@ -842,27 +2773,21 @@ async def _redis_subscriber_loop(project_id: str):
          
                 msg = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
                 if msg and msg.get("type") == "message":
-                    data_raw = msg.get("data")
-                    try:
-                        data = json.loads(data_raw)
-                    except Exception:
+                    # Payloads are "<origin>:<kind>:<frame>"; the frame is forwarded
+                    # to local sockets as-is, without decoding it.
+                    origin, _, rest = (msg.get("data") or "").partition(":")
+                    kind, _, frame = rest.partition(":")
+                    # Local clients already got our own messages from broadcast().
+                    if not frame or origin == PROCESS_ID:
                         continue
                     room = PROJECT_ROOMS.get(project_id)
                     if not room:
            
                         continue
-                    stale = []
-                    
-                    # Day 21: Iterate over connection values (websockets)
-                    for client_data in list(room["connections"].values()):
-                        try:
-                  
-                            await client_data["ws"].send_json(data)
-                        except Exception:
-                            # Use user_id to identify stale connections
-                            stale.append(client_data["ws"])
-                            
-                    # Cleanup logic is primarily handled by ping loop/finally block
+                    if kind == "ops":
+                        # Sequence numbers are per process: restamp relayed frames
+                        frame = record_room_event(room, json.loads(frame))
+                    fanout_local(room, frame, kind)
 
                 await asyncio.sleep(0.01)
             except asyncio.CancelledError:
@@ -880,15 +2805,207 @@ async def _redis_subscriber_loop(project_id: str):
         except Exception:
             pass
 
-async def _redis_publish(project_id: str, message: dict):
+async def _redis_publish(project_id: str, frame: str, kind: str = "control"):
     if not REDIS:
         return
     channel = f"project:{project_id}"
     try:
-        await REDIS.publish(channel, json.dumps(message))
+        await REDIS.publish(channel, f"{PROCESS_ID}:{kind}:{frame}")
     except Exception as e:
         print("redis publish failed:", e)
 
+# ---------------------
+# Broadcast helpers
+# ---------------------
+def encode_frame(message: dict) -> str:
+    """Encodes a message once into the text frame sent to every recipient."""
+    started = time.perf_counter()
+    if orjson is not None:
+        frame = orjson.dumps(message).decode("utf-8")
+    else:
+        frame = json.dumps(message, separators=(",", ":"))
+    METRICS["broadcast_encodes_total"] += 1
+    METRICS["broadcast_encode_seconds_sum"] += time.perf_counter() - started
+    return frame
+
+# Frame kinds drive the overflow policy: "cursor" frames are expendable, "ops"
+# frames can be replaced by a snapshot, everything else is kept.
+FRAME_KINDS = {
+    "cursor_broadcast": "cursor",
+    "cursors_batch": "cursor",
+    "ops_batch": "ops",
+    "undo": "ops",
+    "redo": "ops",
+    "snapshot": "ops",
+}
+
+class ClientOutbox:
+    """Bounded outbound queue and writer task for one WebSocket connection.
+
+    Broadcasts only enqueue frames, so a slow client delays nobody but itself.
+    When the queue is full the SEND_OVERFLOW_POLICY steps are applied in order.
+    """
+
+    def __init__(self, room: dict, user_id: str, ws: WebSocket, maxsize: int = SEND_QUEUE_MAX, compress: bool = False):
+        self.room = room
+        self.user_id = user_id
+        self.ws = ws
+        self.maxsize = maxsize
+        self.compress = compress
+        self.items = deque()
+        self.needs_snapshot = False
+        self.closed = False
+        self._ready = asyncio.Event()
+        self.task = asyncio.create_task(self._run())
+
+    def __len__(self) -> int:
+        return len(self.items) + (1 if self.needs_snapshot else 0)
+
+    def put(self, frame, kind: str = "control") -> bool:
+        if self.closed:
+            return False
+        if kind == "ops" and self.needs_snapshot:
+            # The pending snapshot is built at send time and already covers it.
+            return True
+        if len(self.items) >= self.maxsize and not self._make_room(kind):
+            METRICS["send_queue_dropped_total"] += 1
+            return False
+        self.items.append((kind, frame))
+        self._ready.set()
+        return True
+
+    def _make_room(self, kind: str) -> bool:
+        project_id = self.room["id"]
+        for step in SEND_OVERFLOW_POLICY:
+            if step == "drop_cursors":
+                before = len(self.items)
+                self.items = deque(item for item in self.items if item[0] != "cursor")
+                METRICS["send_queue_dropped_total"] += before - len(self.items)
+                if kind == "cursor":
+                    return len(self.items) < self.maxsize
+            elif step == "snapshot":
+                before = len(self.items)
+                self.items = deque(item for item in self.items if item[0] != "ops")
+                if len(self.items) < before or kind == "ops":
+                    self.needs_snapshot = True
+                    self._ready.set()
+                    METRICS["send_queue_snapshots_total"] += 1
+                    logging.info(f"[{project_id}] Collapsed queued ops for {self.user_id} into a snapshot")
+            elif step == "disconnect":
+                logging.warning(f"[{project_id}] Evicting slow client {self.user_id} (send queue full)")
+                self.evict()
+                return False
+            if len(self.items) < self.maxsize:
+                return True
+        return False
+
+    async def _run(self):
+        try:
+            while True:
+                if self.needs_snapshot:
+                    self.needs_snapshot = False
+                    frame = snapshot_frame(self.room, self.compress)
+                elif self.items:
+                    _, frame = self.items.popleft()
+                else:
+                    self._ready.clear()
+                    await self._ready.wait()
+                    continue
+                send = self.ws.send_bytes if isinstance(frame, bytes) else self.ws.send_text
+                await asyncio.wait_for(send(frame), timeout=BROADCAST_SEND_TIMEOUT)
+        except asyncio.TimeoutError:
+            METRICS["broadcast_send_timeouts_total"] += 1
+            logging.warning(f"[{self.room['id']}] Send to {self.user_id} timed out after {BROADCAST_SEND_TIMEOUT}s")
+            self.evict()
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            # Connection errors are handled by the ping loop / finally block
+            self.closed = True
+
+    def evict(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.items.clear()
+        self.needs_snapshot = False
+        METRICS["send_queue_evictions_total"] += 1
+        if self.task is not asyncio.current_task():
+            self.task.cancel()
+        asyncio.create_task(self._close_ws())
+
+    async def _close_ws(self):
+        try:
+            # 1013 "try again later": the client reconnects and gets a fresh snapshot
+            await asyncio.wait_for(self.ws.close(code=1013), timeout=BROADCAST_SEND_TIMEOUT)
+        except Exception:
+            pass
+
+    def close(self):
+        self.closed = True
+        self.task.cancel()
+
+def fanout_local(room: dict, frame: str, kind: str = "control", exclude: Optional[WebSocket] = None):
+    """Queues an encoded frame on every connection of a room in this process."""
+    for client_data in list(room["connections"].values()):
+        if client_data["ws"] is exclude:
+            continue
+        outbox = client_data.get("outbox")
+        if outbox is not None:
+            outbox.put(frame, kind)
+
+def record_room_event(room: dict, message: dict) -> str:
+    """Stamps a layout-changing message with the room's next seq and keeps it for resumes."""
+    room["seq"] += 1
+    frame = encode_frame({**message, "seq": room["seq"]})
+    room["_resume_buffer"].append((room["seq"], frame))
+    return frame
+
+async def broadcast(project_id: str, message: dict, exclude: Optional[WebSocket] = None):
+    """Delivers a message to the room's local clients and relays it to other processes via Redis.
+
+    The message is encoded once; every socket and the Redis relay get the same frame.
+    """
+    kind = FRAME_KINDS.get(message.get("type"), "control")
+    room = PROJECT_ROOMS.get(project_id)
+    if room and kind == "ops":
+        frame = record_room_event(room, message)
+        if message.get("type") in ("ops_batch", "undo", "redo"):
+            delivered = len(message["ops"]) if message["type"] == "ops_batch" else 1
+            room["_undelivered"] = max(0, room["_undelivered"] - delivered)
+    else:
+        frame = encode_frame(message)
+    if room:
+        fanout_local(room, frame, kind, exclude=exclude)
+    await _redis_publish(project_id, frame, kind)
+
+def snapshot_frame(room: dict, compress: bool = False, **extra):
+    """Full-state snapshot at the room's current seq; deflated bytes if compress is set."""
+    frame = encode_frame({
+        "type": "snapshot",
+        "layout": room["layout"].to_dict(),
+        "clients": list(room["clients_meta"].values()),
+        "epoch": room["epoch"],
+        "seq": room["seq"],
+        **extra,
+        "ts": datetime.utcnow().isoformat(),
+    })
+    if compress:
+        frame = zlib.compress(frame.encode("utf-8"))
+    METRICS["snapshot_bytes_sent_total"] += len(frame)
+    return frame
+
+def resume_frames(room: dict, since: Optional[int], epoch: Optional[str]) -> Optional[List[str]]:
+    """Frames a client that last saw (epoch, since) is missing, or None if it needs a snapshot."""
+    if since is None or epoch != room["epoch"] or since > room["seq"]:
+        return None
+    if since == room["seq"]:
+        return []
+    buffer = room["_resume_buffer"]
+    if not buffer or buffer[0][0] > since + 1:
+        return None
+    return [frame for seq, frame in buffer if seq > since]
+
 # ---------------------
 # Day 20: Autosave Loop
 # ---------------------
@@ -903,24 +3020,20 @@ async def _autosave_loop(project_id: str):
         
    
         if len(room["connections"]) > 0:
-            async with room["lock"]:
-                if now - room.get("last_saved_at", now) >= AUTOSAVE_INTERVAL_SECONDS:
-                    try:
-                        persist_project_layout(project_id, room["layout"])
-           
-                        create_version_from_project(project_id)
-                        room["last_saved_at"] = now
-                        logging.info(f"[{project_id}] Autosaved project and created version.")
-                    except Exception as e:
-         
-                        logging.error(f"[{project_id}] Failed to autosave: {e}")
-                    
-                    # Broadcast confirmation
-                    try:
-                   
-                        await _redis_publish(project_id, {"type": "autosave_confirm", "ts": datetime.utcnow().isoformat()})
-                    except Exception:
-                        pass
+            if now - room.get("last_saved_at", now) >= AUTOSAVE_INTERVAL_SECONDS:
+                try:
+                    await flush_room(room)
+                    await run_storage(create_version_from_project, project_id, key=project_id)
+                    room["last_saved_at"] = now
+                    logging.info(f"[{project_id}] Autosaved project and created version.")
+                except Exception as e:
+                    logging.error(f"[{project_id}] Failed to autosave: {e}")
+
+                # Broadcast confirmation
+                try:
+                    await broadcast(project_id, {"type": "autosave_confirm", "ts": datetime.utcnow().isoformat()})
+                except Exception:
+                    pass
         else:
             # If no connections, no need to keep the autosave loop running
             break
@@ -953,64 +3066,639 @@ async def _presence_cleanup_loop():
            
                         room["clients_meta"].pop(uid, None)
                         left_msg = {"type": "left", "userId": uid, "ts": datetime.utcnow().isoformat()}
-                        
-                        # Day 21: Iterate over connection values (websockets)
-                        for client_data in list(room["connections"].values()):
-                            try:
-  
-                                await client_data["ws"].send_json(left_msg)
-                            except Exception:
-                                # Connection error will be handled by ping loop / finally block
-                                pass
-                        
                         try:
-                            await _redis_publish(project_id, left_msg)
+                            await broadcast(project_id, left_msg)
                         except Exception:
                             pass
             await asyncio.sleep(PRESENCE_CLEAN_INTERVAL)
     except asyncio.CancelledError:
         return
 
+# ---------------------
+# Auth token pruning
+# ---------------------
+async def _token_prune_loop():
+    try:
+        while True:
+            await asyncio.sleep(TOKEN_PRUNE_INTERVAL)
+            lease = await run_storage(acquire_maintenance_lease, False)
+            if lease is None:
+                # Another worker prunes this round
+                continue
+            try:
+                pruned = await run_storage(TOKENS.compact)
+                METRICS["auth_tokens_pruned_total"] += pruned
+                if pruned:
+                    logging.info(f"Pruned {pruned} expired auth tokens.")
+            except Exception as e:
+                logging.error(f"Token prune failed: {e}")
+            finally:
+                release_maintenance_lease(lease)
+    except asyncio.CancelledError:
+        return
+
+# ---------------------
+# Event-loop lag monitor
+# ---------------------
+async def _loop_lag_monitor():
+    """Measures how late the loop wakes from a fixed sleep: time it spent blocked."""
+    try:
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            lag = max(0.0, time.perf_counter() - started - LOOP_LAG_INTERVAL)
+            METRICS["event_loop_lag_seconds_last"] = lag
+            METRICS["event_loop_lag_seconds_max"] = max(METRICS["event_loop_lag_seconds_max"], lag)
+            METRICS["event_loop_lag_seconds_sum"] += lag
+            METRICS["event_loop_lag_samples_total"] += 1
+            if lag > LOOP_LAG_WARN_SECONDS:
+                logging.warning(f"Event loop was blocked for {lag:.3f}s.")
+    except asyncio.CancelledError:
+        return
+
+# ---------------------
+# Version retention loop
+# ---------------------
+async def _version_retention_loop():
+    try:
+        while True:
+            await asyncio.sleep(VERSION_RETENTION_INTERVAL)
+            lease = await run_storage(acquire_maintenance_lease, False)
+            if lease is None:
+                # Another worker runs this pass
+                continue
+            try:
+                report = await run_version_retention()
+                if report["versions_pruned"]:
+                    logging.info(f"Version retention freed {report['version_bytes_freed'] + report['blob_bytes_freed']} bytes: {report}")
+            except Exception as e:
+                logging.error(f"Version retention failed: {e}")
+            finally:
+                release_maintenance_lease(lease)
+    except asyncio.CancelledError:
+        return
+
+async def _migrate_legacy_versions():
+    # Workers take turns: the first one migrates, the rest find nothing left
+    lease = await run_storage(acquire_maintenance_lease, True)
+    try:
+        await _run_legacy_migrations()
+    finally:
+        release_maintenance_lease(lease)
+
+async def _run_legacy_migrations():
+    try:
+        migrated = await run_storage(STORAGE.migrate_legacy)
+        if migrated:
+            logging.info(f"Moved {migrated} legacy versions into the blob store.")
+    except Exception as e:
+        logging.error(f"Legacy version migration failed: {e}")
+    try:
+        stored = await run_storage(migrate_legacy_thumbnails)
+        if stored:
+            logging.info(f"Stored {stored} legacy project thumbnails.")
+    except Exception as e:
+        logging.error(f"Legacy thumbnail migration failed: {e}")
+
 @app.on_event("startup")
 async def _startup_tasks():
     app.state._presence_cleanup_task = asyncio.create_task(_presence_cleanup_loop())
+    app.state._token_prune_task = asyncio.create_task(_token_prune_loop())
+    app.state._loop_lag_task = asyncio.create_task(_loop_lag_monitor())
+    if VERSION_RETENTION_TIERS:
+        app.state._version_retention_task = asyncio.create_task(_version_retention_loop())
+    asyncio.create_task(_migrate_legacy_versions())
+    if ROOM_LEASES is not None:
+        await start_room_relay()
 
 @app.on_event("shutdown")
 async def _shutdown_tasks():
-    task = getattr(app.state, "_presence_cleanup_task", None)
-    if task:
-        task.cancel()
-        try:
-            await task
-        except Exception:
-            pass
+    for name in ("_presence_cleanup_task", "_token_prune_task", "_version_retention_task", "_loop_lag_task"):
+        task = getattr(app.state, name, None)
+        if task:
+            task.cancel()
+            try:
+                await task
+            except Exception:
+                pass
     for task in AUTOSAVE_TASKS.values():
         task.cancel()
     
         try:
             await task
-        except Exception:
+        except (asyncio.CancelledError, Exception):
+            # CancelledError is not an Exception; letting it through would
+            # skip the final room flushes below.
             pass
     
+    if ROOM_LEASES is not None:
+        await stop_room_relay()
+
     # Day 21: Cancel batcher tasks on shutdown
-    for room in PROJECT_ROOMS.values():
+    for room in list(PROJECT_ROOMS.values()):
         if room.get("_batcher_task"):
             room["_batcher_task"].cancel()
             try:
                 await room["_batcher_task"]
-            except Exception:
+            except (asyncio.CancelledError, Exception):
                 pass
+        # Send what is still batched so the final checkpoint can carry the
+        # room's resume position.
+        try:
+            await drain_broadcast_queue(room)
+        except Exception:
+            pass
+        if room.get("_flush_task"):
+            room["_flush_task"].cancel()
+            try:
+                await flush_room(room, checkpoint=room_needs_checkpoint(room))
+            except Exception as e:
+                logging.error(f"[{room['id']}] Final flush on shutdown failed: {e}")
+        if room.get("_cursor_task"):
+            room["_cursor_task"].cancel()
+
+    for project_id in list(JOURNALS):
+        try:
+            await close_journal(project_id)
+        except Exception as e:
+            logging.error(f"[{project_id}] Failed to close ops journal: {e}")
+    if ROOM_LEASES is not None:
+        # Rooms are flushed and checkpointed: other workers may take them now
+        ROOM_LEASES.release_all()
+        RELAY_ADDRESS.unlink(missing_ok=True)
+    STORAGE.close()
 
 
+# ---------------------
+# Room ownership between worker processes
+# ---------------------
+# A room's state (layout, undo history, seq, journal writer) lives in one
+# process only: the one holding the room's lease. Other workers relay their
+# clients to the owner over its Unix socket, frame for frame, and relay room
+# calls (REST undo/redo, rollback, settings) the same way. The owner
+# releases the lease when the room empties; if it dies, the kernel drops its
+# flock, its relayed clients are closed with 1012, and their reconnects
+# claim the room on a live worker, which restores it from checkpoint and
+# journal.
+class RoomLeases:
+    """Per-project leases held as flocks on files in `directory`.
+
+    A lease lasts as long as the lock file stays open in the holder, so it
+    ends with the process however that exits. The holder writes its relay
+    address into the file for the other workers to find.
+    """
+
+    def __init__(self, directory: Path, address: str):
+        self.directory = directory
+        self.address = address
+        self.held: Dict[str, int] = {}
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def acquire(self, pid: str) -> Optional[str]:
+        """Takes the lease if it is free. Returns None if this process holds
+        it, else the holder's address ("" until the holder has written it)."""
+        if pid in self.held:
+            return None
+        fd = os.open(self.directory / f"{pid}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            try:
+                return os.pread(fd, 4096, 0).decode("utf-8", "replace").strip()
+            finally:
+                os.close(fd)
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, self.address.encode("utf-8"), 0)
+        self.held[pid] = fd
+        # Other workers may have appended to the journal or added versions
+        # since this one last looked
+        drop_journal_index(pid)
+        with version_lock(pid):
+            VERSION_HEADS.pop(pid, None)
+            _HEAD_LAYOUTS.pop(pid, None)
+        METRICS["room_leases_acquired_total"] += 1
+        return None
+
+    def release(self, pid: str):
+        fd = self.held.pop(pid, None)
+        if fd is not None:
+            # Closing the file drops the flock
+            os.close(fd)
+            METRICS["room_leases_released_total"] += 1
+
+    def release_all(self):
+        for pid in list(self.held):
+            self.release(pid)
+
+RELAY_ADDRESS = WORKERS_DIR / f"{PROCESS_ID[:16]}.sock"
+ROOM_LEASES = RoomLeases(LEASES_DIR, str(RELAY_ADDRESS)) if ROOM_LEASES_MODE == "file" else None
+
+def acquire_maintenance_lease(wait: bool) -> Optional[int]:
+    """Takes the lease one worker holds while it runs server-wide maintenance
+    (version retention, token pruning, legacy migrations).
+
+    Returns a handle for release_maintenance_lease, or None if another worker
+    holds the lease and `wait` is not set. Without room leases there is only
+    one worker, and the handle is -1.
+    """
+    if ROOM_LEASES is None:
+        return -1
+    fd = os.open(LEASES_DIR / "maintenance.lock", os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+def release_maintenance_lease(lease: Optional[int]):
+    if lease is not None and lease >= 0:
+        os.close(lease)
+# Joins and room calls under way, per project: a busy room is not retired
+ROOM_BUSY: Dict[str, int] = {}
+RELAY_SOCKETS: set = set()
+
+@contextlib.contextmanager
+def room_busy(project_id: str):
+    ROOM_BUSY[project_id] = ROOM_BUSY.get(project_id, 0) + 1
+    try:
+        yield
+    finally:
+        ROOM_BUSY[project_id] -= 1
+        if not ROOM_BUSY[project_id]:
+            del ROOM_BUSY[project_id]
+
+async def claim_room(project_id: str) -> Optional[str]:
+    """None if this process owns the project's room (taking the lease if it
+    is free), else the relay address of the worker that does."""
+    if ROOM_LEASES is None:
+        return None
+    for _ in range(ROOM_CLAIM_ATTEMPTS):
+        if project_id in ROOM_LEASES.held:
+            return None
+        owner = await run_storage(ROOM_LEASES.acquire, project_id, key=project_id)
+        if owner is None or owner:
+            return owner
+        await asyncio.sleep(ROOM_CLAIM_RETRY_SECONDS)
+    raise HTTPException(status_code=503, detail="Room owner unavailable")
+
+async def connect_room_owner(project_id: str, owner: str) -> Optional[tuple]:
+    """Opens a relay stream to the room's owner.
+
+    Returns None if the owner turned out to be gone and this process took
+    the room over instead.
+    """
+    for _ in range(ROOM_CLAIM_ATTEMPTS):
+        try:
+            return await asyncio.open_unix_connection(owner)
+        except OSError:
+            # Stale address: the owner exited and the lease is free or changing hands
+            await asyncio.sleep(ROOM_CLAIM_RETRY_SECONDS)
+            owner = await claim_room(project_id)
+            if owner is None:
+                return None
+    raise HTTPException(status_code=503, detail="Room owner unavailable")
+
+async def release_idle_room(project_id: str):
+    """Hands back the lease of a room nobody is using or about to use."""
+    if ROOM_LEASES is None or ROOM_BUSY.get(project_id) or project_id not in ROOM_LEASES.held:
+        return
+    room = PROJECT_ROOMS.get(project_id)
+    if room is None:
+        ROOM_LEASES.release(project_id)
+    elif not room["connections"]:
+        await retire_room(project_id, room)
+
+async def retire_room(project_id: str, room: dict):
+    """Persists a room whose last client left and stops its tasks.
+
+    With leases the room is also dropped and its lease released, so any
+    worker can take it next. Clients may join during the awaits, so the room
+    is checked again after each.
+    """
+    if room.get("_deleted"):
+        # Already shut down by close_deleted_room; a room opened since for
+        # the same id is not this one's to stop
+        return
+    try:
+        await flush_room(room, checkpoint=room_needs_checkpoint(room))
+    except Exception as ex:
+        print("Failed to persist layout on empty room:", ex)
+    if room["connections"] or ROOM_BUSY.get(project_id):
+        return
+    await stop_room_tasks(project_id, room)
+
+    if ROOM_LEASES is not None and not room["connections"] and not ROOM_BUSY.get(project_id) and PROJECT_ROOMS.get(project_id) is room:
+        del PROJECT_ROOMS[project_id]
+        ROOM_LEASES.release(project_id)
+
+async def close_deleted_room(project_id: str, room: dict):
+    """Shuts down a room whose project is being deleted, already dropped
+    from PROJECT_ROOMS. Its clients are closed with 4404, which tells them
+    not to reconnect."""
+    room["_deleted"] = True
+    for client_data in list(room["connections"].values()):
+        outbox = client_data.get("outbox")
+        if outbox is not None:
+            outbox.close()
+        try:
+            await asyncio.wait_for(client_data["ws"].close(code=4404), timeout=BROADCAST_SEND_TIMEOUT)
+        except Exception:
+            pass
+    await stop_room_tasks(project_id, room)
+
+async def stop_room_tasks(project_id: str, room: dict):
+    if project_id in SUBSCRIBE_TASKS:
+        task = SUBSCRIBE_TASKS.pop(project_id, None)
+        if task:
+            task.cancel()
+    if project_id in AUTOSAVE_TASKS:
+        task = AUTOSAVE_TASKS.pop(project_id, None)
+        if task:
+            task.cancel()
+
+    # Day 21: Cancel batcher task if room is empty
+    if room.get("_batcher_task"):
+        room["_batcher_task"].cancel()
+    if room.get("_cursor_task"):
+        room["_cursor_task"].cancel()
+    room["_cursor_pending"].clear()
+    if room.get("_flush_task"):
+        room["_flush_task"].cancel()
+    try:
+        await close_journal(project_id)
+    except Exception as ex:
+        logging.error(f"[{project_id}] Failed to close ops journal: {ex}")
+
+# Relay streams carry frames of (kind, length, payload): text and binary
+# WebSocket frames, and a close carrying its code.
+RELAY_TEXT, RELAY_BYTES, RELAY_CLOSE = b"T", b"B", b"C"
+_RELAY_HEADER = struct.Struct(">cI")
+
+async def relay_read(reader: asyncio.StreamReader) -> tuple:
+    kind, size = _RELAY_HEADER.unpack(await reader.readexactly(_RELAY_HEADER.size))
+    return kind, await reader.readexactly(size)
+
+def relay_write(writer: asyncio.StreamWriter, kind: bytes, payload: bytes):
+    writer.write(_RELAY_HEADER.pack(kind, len(payload)) + payload)
+
+class RelaySocket:
+    """The owner's end of a relayed client: what serve_room_client needs of a
+    WebSocket, carried as relay frames to the worker holding the real one."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.closed = False
+        self._send_lock = asyncio.Lock()
+
+    async def receive_text(self) -> str:
+        try:
+            kind, payload = await relay_read(self.reader)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            raise WebSocketDisconnect(1006)
+        if kind == RELAY_CLOSE:
+            raise WebSocketDisconnect(int(payload or 1000))
+        return payload.decode("utf-8")
+
+    async def _send(self, kind: bytes, payload: bytes):
+        if self.closed:
+            raise ConnectionError("relay closed")
+        async with self._send_lock:
+            relay_write(self.writer, kind, payload)
+            await self.writer.drain()
+
+    async def send_text(self, text: str):
+        await self._send(RELAY_TEXT, text.encode("utf-8"))
+
+    async def send_bytes(self, data: bytes):
+        await self._send(RELAY_BYTES, data)
+
+    async def close(self, code: int = 1000):
+        try:
+            await self._send(RELAY_CLOSE, str(code).encode("utf-8"))
+        except Exception:
+            pass
+        self.closed = True
+        self.writer.close()
+
+async def proxy_room_client(websocket: WebSocket, link: tuple, hello: dict):
+    """Copies frames between a client of this worker and the room's owner until either side closes."""
+    reader, writer = link
+    METRICS["room_relay_clients"] += 1
+    METRICS["room_relay_connections_total"] += 1
+
+    async def upstream():
+        relay_write(writer, RELAY_TEXT, json.dumps(hello).encode("utf-8"))
+        while True:
+            await writer.drain()
+            relay_write(writer, RELAY_TEXT, (await websocket.receive_text()).encode("utf-8"))
+
+    async def downstream() -> int:
+        while True:
+            kind, payload = await relay_read(reader)
+            if kind == RELAY_CLOSE:
+                return int(payload or 1000)
+            if kind == RELAY_BYTES:
+                await websocket.send_bytes(payload)
+            else:
+                await websocket.send_text(payload.decode("utf-8"))
+
+    up = asyncio.create_task(upstream())
+    down = asyncio.create_task(downstream())
+    try:
+        await asyncio.wait({up, down}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        up.cancel()
+        down.cancel()
+        METRICS["room_relay_clients"] -= 1
+    if down.done() and not down.cancelled():
+        # The owner closed the client, or died (1012 "service restart"): the
+        # client reconnects, and claims the room if its owner is gone.
+        code = down.result() if down.exception() is None else 1012
+        try:
+            await websocket.close(code=code)
+        except Exception:
+            pass
+    else:
+        try:
+            relay_write(writer, RELAY_CLOSE, b"1000")
+            await writer.drain()
+        except Exception:
+            pass
+    if up.done() and not up.cancelled():
+        # Normally the client's WebSocketDisconnect; nothing more to do with it
+        up.exception()
+    writer.close()
+
+ROOM_CALLS = {
+    "undo": undo_room_op,
+    "redo": redo_room_op,
+    "rollback": rollback_room,
+    "update": update_room_project,
+    "revert": revert_room_project,
+    "delete": delete_room_project,
+    "pin": pin_room_version,
+    "prune_versions": prune_room_versions,
+    "cursor_tick": set_room_cursor_tick,
+}
+
+async def room_call(project_id: str, name: str, **args) -> Any:
+    """Runs ROOM_CALLS[name] in the process that owns the project's room.
+
+    Without leases that is always this one. Otherwise the lease is taken
+    here if it is free, and the call is relayed to its holder if not.
+    """
+    local = False
+    try:
+        with room_busy(project_id):
+            owner = await claim_room(project_id)
+            link = await connect_room_owner(project_id, owner) if owner else None
+            if link is None:
+                local = True
+                return await ROOM_CALLS[name](project_id, **args)
+    finally:
+        if local:
+            await release_idle_room(project_id)
+
+    reader, writer = link
+    METRICS["room_relay_calls_total"] += 1
+    try:
+        relay_write(writer, RELAY_TEXT, json.dumps({"project_id": project_id, "call": name, "args": args}).encode("utf-8"))
+        await writer.drain()
+        _, payload = await relay_read(reader)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        raise HTTPException(status_code=503, detail="Room owner went away, try again")
+    finally:
+        writer.close()
+    result = json.loads(payload)
+    if result["status_code"] != 200:
+        raise HTTPException(status_code=result["status_code"], detail=result["body"])
+    return result["body"]
+
+async def handle_relay(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Serves one stream from another worker: a relayed client or a room call."""
+    try:
+        _, payload = await relay_read(reader)
+        hello = json.loads(payload)
+        project_id = hello["project_id"]
+    except Exception:
+        writer.close()
+        return
+
+    if "call" in hello:
+        try:
+            result = {"status_code": 200, "body": await room_call(project_id, hello["call"], **(hello.get("args") or {}))}
+        except HTTPException as e:
+            result = {"status_code": e.status_code, "body": e.detail}
+        except Exception as e:
+            logging.error(f"[{project_id}] Relayed {hello['call']} failed: {e}")
+            result = {"status_code": 500, "body": str(e)}
+        try:
+            relay_write(writer, RELAY_TEXT, json.dumps(result).encode("utf-8"))
+            await writer.drain()
+        finally:
+            writer.close()
+        return
+
+    ws = RelaySocket(reader, writer)
+    RELAY_SOCKETS.add(ws)
+    try:
+        room = username = None
+        with room_busy(project_id):
+            # The lease may have moved on while the other worker was connecting
+            if project_id in ROOM_LEASES.held:
+                try:
+                    username = await client_username(hello.get("token"))
+                    room = await open_room(project_id)
+                except Exception as e:
+                    logging.error(f"[{project_id}] Could not open room: {e}")
+        if room is None:
+            await release_idle_room(project_id)
+            await ws.close(code=1012)
+            return
+        await serve_room_client(ws, room, project_id, username, hello.get("since"), hello.get("epoch"), hello.get("compress"))
+    finally:
+        RELAY_SOCKETS.discard(ws)
+        writer.close()
+
+def sweep_relay_sockets() -> int:
+    """Removes relay sockets left behind by workers that died. Returns how many."""
+    removed = 0
+    for path in WORKERS_DIR.glob("*.sock"):
+        probe = socket.socket(socket.AF_UNIX)
+        try:
+            probe.connect(str(path))
+        except ConnectionRefusedError:
+            path.unlink(missing_ok=True)
+            removed += 1
+        except OSError:
+            pass
+        finally:
+            probe.close()
+    return removed
+
+async def start_room_relay():
+    WORKERS_DIR.mkdir(parents=True, exist_ok=True)
+    removed = await run_storage(sweep_relay_sockets)
+    if removed:
+        logging.info(f"Removed {removed} relay sockets of exited workers.")
+    app.state._relay_server = await asyncio.start_unix_server(handle_relay, path=str(RELAY_ADDRESS))
+    logging.info(f"Room relay listening on {RELAY_ADDRESS}")
+
+async def stop_room_relay():
+    """Stops taking relayed clients and sends the current ones to reconnect elsewhere."""
+    server = getattr(app.state, "_relay_server", None)
+    if server:
+        server.close()
+    for ws in list(RELAY_SOCKETS):
+        await ws.close(code=1012)
+
 # ---------------------
 # WebSocket endpoint for projects
 # ---------------------
 MAX_OP_SIZE = 10_000
 @app.websocket("/ws/projects/{project_id}")
-async def project_ws(websocket: WebSocket, project_id: str, token: Optional[str] = Query(None)):
+async def project_ws(
+    websocket: WebSocket,
+    project_id: str,
+    token: Optional[str] = Query(None),
+    since: Optional[int] = Query(None),
+    epoch: Optional[str] = Query(None),
+    compress: Optional[str] = Query(None),
+):
     await websocket.accept()
-    room = get_or_create_room(project_id)
+    link = room = username = None
+    # Busy until serve_room_client registers the connection, which it does
+    # before its first await, so the room cannot be retired in between.
+    with room_busy(project_id):
+        try:
+            owner = await claim_room(project_id)
+            link = await connect_room_owner(project_id, owner) if owner else None
+            if link is None:
+                username = await client_username(token)
+                room = await open_room(project_id)
+        except Exception as e:
+            logging.error(f"[{project_id}] Could not open room: {e}")
+    if room is not None:
+        await serve_room_client(websocket, room, project_id, username, since, epoch, compress)
+    elif link is not None:
+        await proxy_room_client(websocket, link, {"project_id": project_id, "token": token, "since": since, "epoch": epoch, "compress": compress})
+    else:
+        await release_idle_room(project_id)
+        # 1013 "try again later": the client reconnects with backoff
+        await websocket.close(code=1013)
+
+async def client_username(token: Optional[str]) -> Optional[str]:
+    """The user a WebSocket token belongs to, looked up on the storage pool; None for guests."""
+    return await run_storage(get_username_for_token, token) if token else None
+
+async def serve_room_client(websocket: WebSocket, room: dict, project_id: str, username: Optional[str], since: Optional[int], epoch: Optional[str], compress: Optional[str]):
+    """Runs one client connection on the room this process owns.
 
+    `websocket` is either the client's own socket or a RelaySocket for a
+    client connected to another worker. `username` is None for guests.
+    """
     # Day 21: Metrics: increment active connections
     METRICS["active_connections"] += 1
     
@@ -1021,14 +3709,12 @@ async def project_ws(websocket: WebSocket, project_id: str, token: Optional[str]
     if project_id not in AUTOSAVE_TASKS:
         AUTOSAVE_TASKS[project_id] = asyncio.create_task(_autosave_loop(project_id))
 
-    username = None
-    if token:
-        username = get_username_for_token(token)
     user_id = username or str(uuid.uuid4())
     display_name = username or f"Guest-{user_id[:6]}"
 
     # Day 21: Initialize client connection data with last_pong
-    room["connections"][user_id] = {"ws": websocket, "last_pong": time.time()}
+    outbox = ClientOutbox(room, user_id, websocket, compress=compress == "deflate")
+    room["connections"][user_id] = {"ws": websocket, "last_pong": time.time(), "outbox": outbox}
 
     room["clients_meta"][user_id] = {
         "userId": user_id,
@@ -1038,20 +3724,35 @@ async def project_ws(websocket: WebSocket, project_id: str, token: Optional[str]
         "lastSeen": datetime.utcnow().timestamp(),
     }
 
-    try:
-        # Client list is from clients_meta (presence tracking)
-        await websocket.send_json({"type": "snapshot", "layout": room["layout"], "clients": list(room["clients_meta"].values()), "ts": datetime.utcnow().isoformat()})
-    except Exception as ex:
-        print("Failed to send snapshot:", ex)
+    # Resume or snapshot goes through the outbox ahead of any broadcast, with
+    # no await in between, so the client sees a gap-free sequence.
+    # Client list is from clients_meta (presence tracking); "you" lets the
+    # client skip its own entries in cursors_batch.
+    missed = resume_frames(room, since, epoch)
+    if missed is not None and len(missed) >= outbox.maxsize:
+        missed = None
+    if missed is None:
+        if since is not None:
+            METRICS["resume_snapshot_fallbacks_total"] += 1
+        outbox.put(snapshot_frame(room, outbox.compress, you=user_id))
+    else:
+        METRICS["resumes_total"] += 1
+        METRICS["resume_frames_replayed_total"] += len(missed)
+        outbox.put(encode_frame({"type": "resume", "epoch": room["epoch"], "seq": room["seq"], "missed": len(missed), "clients": list(room["clients_meta"].values()), "you": user_id, "ts": datetime.utcnow().isoformat()}))
+        for frame in missed:
+            outbox.put(frame, "ops")
     
+    def reply(message: dict) -> bool:
+        # Replies share the outbox with broadcasts, so they reach the client
+        # in order with the frames queued before them.
+        return outbox.put(encode_frame(message))
+
     # Day 21: Ping Loop (Heartbeat)
     async def ping_loop():
         try:
             while True:
                 await asyncio.sleep(PING_INTERVAL)
-                try:
-                    await websocket.send_json({"type":"ping", "ts": time.time()})
-                except Exception:
+                if not reply({"type":"ping", "ts": time.time()}):
                     logging.warning(f"[{project_id}] Failed to send ping to {user_id}, closing ws")
                     break
                 
@@ -1068,16 +3769,8 @@ async def project_ws(websocket: WebSocket, project_id: str, token: Optional[str]
     join_msg = {"type": "joined", "userId": user_id, "displayName": display_name, "ts": datetime.utcnow().isoformat()}
     
     # Day 21: Broadcast to other clients (non-stale logic relies on ping loop / finally block)
-    for client_data in list(room["connections"].values()):
-        if client_data["ws"] is websocket:
-            continue
-        try:
-            await client_data["ws"].send_json(join_msg)
-        except Exception:
-            pass
-            
     try:
-        await _redis_publish(project_id, join_msg)
+        await broadcast(project_id, join_msg, exclude=websocket)
     except Exception:
         pass
 
@@ -1086,7 +3779,7 @@ async def project_ws(websocket: WebSocket, project_id: str, token: Optional[str]
       
             raw = await websocket.receive_text()
             if len(raw) > MAX_OP_SIZE:
-                await websocket.send_json({"type":"error","msg":"op too large"})
+                reply({"type":"error","msg":"op too large"})
                 continue
             try:
                 data = json.loads(raw)
@@ -1106,42 +3799,23 @@ async def project_ws(websocket: WebSocket, project_id: str, token: Optional[str]
               
                 except Exception:
                     pass
-                await websocket.send_json({"type": "pong", "ts": datetime.utcnow().isoformat()})
-
-            elif mtype == "presence":
-                meta = data.get("meta", {})
-  
+                reply({"type": "pong", "ts": datetime.utcnow().isoformat()})
+
+            elif mtype in ("presence", "cursor_update"):
+                # Coalesced per user and sent by cursor_loop on the room's tick
+                now = datetime.utcnow()
+                client_meta = room["clients_meta"].setdefault(user_id, {})
+                meta = data.get("meta") if mtype == "presence" else None
+                if meta and not isinstance(meta, dict):
+                    meta = None
                 if meta:
-                    try:
-                        room["clients_meta"].setdefault(user_id, {}).update(meta)
-                    except Exception:
-              
-                        pass
-                room["clients_meta"].setdefault(user_id, {})["lastSeen"] = datetime.utcnow().timestamp()
-
-                
-            elif mtype == "cursor_update":
+                    client_meta.update(meta)
                 cursor = data.get("cursor")
                 if cursor:
-                    room["clients_meta"].setdefault(user_id, {})["cursor"] = cursor
-                room["clients_meta"].setdefault(user_id, {})["lastSeen"] = datetime.utcnow().timestamp()
-                
-                cursor_msg = {"type": "cursor_broadcast", "userId": user_id, "cursor": cursor, "ts": datetime.utcnow().isoformat()}
-                
-                # Day 21: Broadcast cursor updates
-                for client_data in list(room["connections"].values()):
-                    if client_data["ws"] is websocket:
-                        continue
-                    try:
-                        await client_data["ws"].send_json(cursor_msg)
-                    except Exception:
-                        pass # Failure handled by ping loop
-
-                try:
-                    await _redis_publish(project_id, cursor_msg)
-       
-                except Exception:
-                    pass
+                    client_meta["cursor"] = cursor
+                client_meta["lastSeen"] = now.timestamp()
+                if cursor or mtype == "presence":
+                    queue_cursor_update(room, user_id, cursor=cursor or None, meta=(meta or {}) if mtype == "presence" else None, ts=now.isoformat())
 
             elif mtype == "op":
                 op = data.get("op")
@@ -1151,76 +3825,56 @@ async def project_ws(websocket: WebSocket, project_id: str, token: Optional[str]
                 
                 logging.info(f"[{project_id}] User {user_id} performed op: {op.get('kind')} id={op_id}")
                 
-                try:
-  
-                    append_op_record(project_id, op_record)
-                except Exception as ex:
-                    print("append op failed:", ex)
-                
                 async with room["lock"]:
      
-                    apply_op_to_layout(room["layout"], op)
-                    room.setdefault("undo_stack", []).append(op_record)
-                    room["redo_stack"] = []
-                    try:
-                     
-                        persist_project_layout(project_id, room["layout"])
-                    except Exception as ex:
-                        print("persist failed after op:", ex)
+                    # Capture the inverse now so undo never has to replay history.
+                    redo_before, last_before = list(room["redo_stack"]), room["_last_op_id"]
+                    apply_op_record(room["layout"], op_record)
+                    room["undo_stack"].append(op_record)
+                    room["redo_stack"].clear()
+                    # The layout file is rewritten by the flush loop; the op
+                    # only has to reach the journal before it is acked.
+                    journaled = journal_room_record(room, op_record)
+
+                try:
+                    await journaled
+                except Exception as ex:
+                    logging.error(f"[{project_id}] append op failed: {ex}")
+                    async with room["lock"]:
+                        revert_unjournaled_op(room, op_record, redo_before, last_before)
+                    reply({"type": "error", "msg": "op could not be journaled", "opId": op_id})
+                    # The sender applied the op locally: resync it
+                    outbox.put(snapshot_frame(room, outbox.compress, you=user_id))
+                    continue
                 
                 # ACK immediately to sender
-                try:
-             
-                    await websocket.send_json({"type": "ack", "opId": op_id, "status": "persisted", "ts": datetime.utcnow().isoformat()})
-                except Exception:
-                    pass
+                reply({"type": "ack", "opId": op_id, "status": "journaled", "ts": datetime.utcnow().isoformat()})
                 
                 # Day 21: Add op to batch queue instead of immediate broadcast
                 room.setdefault("_broadcast_queue", []).append(op_record)
 
             
-            elif mtype == "undo_request":
-                async with room["lock"]:
-                   
-                    if not room["undo_stack"]:
-                        await websocket.send_json({"type": "error", "msg": "Nothing to undo"})
-                        continue
-                    op_to_undo = room["undo_stack"].pop()
-                    room.setdefault("redo_stack", 
-                        []).append(op_to_undo)
-                    rebuild_layout_from_ops(project_id, room)
-                    persist_project_layout(project_id, room["layout"])
-                    logging.info(f"[{project_id}] User {user_id} triggered undo for op: {op_to_undo.get('opId')}")
-                
-               
-                undo_msg = {"type": "undo", "opId": op_to_undo.get("opId"), "from": user_id, "ts": datetime.utcnow().isoformat()}
-                await _redis_publish(project_id, undo_msg)
+            elif mtype in ("undo_request", "redo_request"):
+                action = mtype[:4]
+                try:
+                    moved = await move_room_history(room, action, user_id)
+                except HTTPException as ex:
+                    reply({"type": "error", "msg": ex.detail})
+                    if ex.status_code != 400:
+                        # Resync the requester with the state the room kept
+                        outbox.put(snapshot_frame(room, outbox.compress, you=user_id))
+                    continue
 
-            elif mtype == "redo_request":
-                async with room["lock"]:
-                    if not room["redo_stack"]:
-                 
-                        await websocket.send_json({"type": "error", "msg": "Nothing to redo"})
-                        continue
-                    op_to_redo = room["redo_stack"].pop()
-                    apply_op_to_layout(room["layout"], op_to_redo.get("op"))
-                    
-                    room.setdefault("undo_stack", []).append(op_to_redo)
-                    persist_project_layout(project_id, room["layout"])
-                    logging.info(f"[{project_id}] User {user_id} triggered redo for op: {op_to_redo.get('opId')}")
-                
-                redo_msg = {"type": "redo", "opId": op_to_redo.get("opId"), "from": user_id, "ts": datetime.utcnow().isoformat()}
-          
-                await _redis_publish(project_id, redo_msg)
+                await drain_broadcast_queue(room)
+                history_msg = {"type": action, "opId": moved.get("opId"), "from": user_id, "ts": datetime.utcnow().isoformat()}
+                await broadcast(project_id, history_msg)
 
             elif mtype == "save":
-                async with room["lock"]:
-                    try:
-                        persist_project_layout(project_id, room["layout"])
-              
-                        await websocket.send_json({"type": "ack", "what": "save", "ts": datetime.utcnow().isoformat()})
-                    except Exception as ex:
-                        await websocket.send_json({"type": "error", "msg": f"save failed: {ex}"})
+                try:
+                    await flush_room(room, force=True)
+                    reply({"type": "ack", "what": "save", "ts": datetime.utcnow().isoformat()})
+                except Exception as ex:
+                    reply({"type": "error", "msg": f"save failed: {ex}"})
 
             elif mtype == "join":
                 
@@ -1238,16 +3892,16 @@ async def project_ws(websocket: WebSocket, project_id: str, token: Optional[str]
 
             else:
   
-                try:
-                    await websocket.send_json({"type": "error", "msg": f"unknown type {mtype}"})
-                except Exception:
-                    pass
+                reply({"type": "error", "msg": f"unknown type {mtype}"})
 
     except WebSocketDisconnect:
         pass
     finally:
         # Day 21: Cancel ping task on disconnect
         ping_task.cancel()
+        client_data = room["connections"].get(user_id)
+        if client_data and client_data["ws"] is websocket:
+            client_data["outbox"].close()
         
         # Day 21: Remove client from connections and update metrics
         if user_id in room["connections"]:
@@ -1256,43 +3910,19 @@ async def project_ws(websocket: WebSocket, project_id: str, token: Optional[str]
 
         try:
             room["clients_meta"].pop(user_id, None)
+            room["_cursor_pending"].pop(user_id, None)
         except Exception:
             pass
 
         left_msg = {"type": "left", "userId": user_id, "displayName": display_name, "ts": datetime.utcnow().isoformat()}
         
         # Broadcast leave message to remaining clients
-        for client_data in list(room["connections"].values()):
-            try:
-                await client_data["ws"].send_json(left_msg)
-            except Exception:
-                pass
-
         try:
-            await _redis_publish(project_id, left_msg)
+            await broadcast(project_id, left_msg)
         except Exception:
             pass
 
         if len(room["connections"]) == 0:
-            try:
-                persist_project_layout(project_id, room["layout"])
-            except Exception as ex:
-                print("Failed to persist layout on empty room:", ex)
-            
-            # Cancel tasks if the room is empty
-            if project_id in SUBSCRIBE_TASKS:
-                task = SUBSCRIBE_TASKS.pop(project_id, None)
-                if task:
-                    task.cancel()
-            if project_id in AUTOSAVE_TASKS:
-                task = AUTOSAVE_TASKS.pop(project_id, None)
-                if task:
-    
-                    try:
-                        task.cancel()
-                    except Exception:
-                        pass
-            
-            # Day 21: Cancel batcher task if room is empty
-            if room.get("_batcher_task"):
-                 room["_batcher_task"].cancel()
\ No newline at end of file
+            # Shielded: a cancelled handler must not leave the room half
+            # retired, with its lease held and nobody in it
+            await asyncio.shield(retire_room(project_id, room))
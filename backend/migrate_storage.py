@@ -0,0 +1,27 @@
+# backend/migrate_storage.py
+# Copies all server data between storage backends. Run with the server stopped:
+#   python migrate_storage.py --from fs --to sqlite
+# then start the server with STORAGE_BACKEND=sqlite.
+import argparse
+import json
+from pathlib import Path
+
+import storage
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Copy projects, journals, versions, users and tokens between storage backends.")
+    parser.add_argument("--from", dest="src", choices=["fs", "sqlite"], default="fs")
+    parser.add_argument("--to", dest="dst", choices=["fs", "sqlite"], default="sqlite")
+    parser.add_argument("--db", default=str(storage.STORAGE_DB_PATH), help="SQLite database path")
+    args = parser.parse_args()
+    if args.src == args.dst:
+        parser.error("--from and --to must differ")
+
+    src = storage.open_storage(args.src, Path(args.db))
+    dst = storage.open_storage(args.dst, Path(args.db))
+    try:
+        counts = storage.migrate_storage(src, dst)
+    finally:
+        src.close()
+        dst.close()
+    print(json.dumps(counts, indent=2))
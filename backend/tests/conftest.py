@@ -0,0 +1,11 @@
+# backend/tests/conftest.py
+# storage keeps its data under DATA_DIR from import time on: point it at a
+# scratch directory before any test module imports it.
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="dream-tests-"))
+os.environ.setdefault("ROOM_LEASES", "off")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,87 @@
+# backend/tests/test_layout.py
+# RoomLayout and apply_op_to_layout: every op's inverse restores the layout.
+import copy
+
+import main
+
+
+def _rooms(*names):
+    return {"rooms": [{"name": n, "x": i} for i, n in enumerate(names)], "meta": {"mood": "calm"}}
+
+
+def _apply(layout, op):
+    record = {"op": op}
+    main.apply_op_record(layout, record)
+    return record
+
+
+def _check_index(layout):
+    live = {}
+    for i, r in enumerate(layout.slots):
+        if r is not None:
+            live.setdefault(r["name"], []).append(i)
+    assert layout.index == live
+    assert layout._tombstones == layout.slots.count(None)
+
+
+def test_duplicate_names_are_removed_and_restored_together():
+    doc = _rooms("A", "B", "A", "C")
+    layout = main.RoomLayout(copy.deepcopy(doc))
+    assert layout.get("A")["x"] == 0 and len(layout) == 4
+    assert _apply(layout, {"kind": "room:add", "room": {"name": "A"}})["inverse"] is None
+
+    record = _apply(layout, {"kind": "room:remove", "name": "A"})
+    assert [r["name"] for r in layout.to_dict()["rooms"]] == ["B", "C"]
+    _check_index(layout)
+    main.undo_op_record(layout, record)
+    assert layout.to_dict() == doc
+    _check_index(layout)
+
+
+def test_undo_across_a_compaction_restores_every_room():
+    names = [f"R{i}" for i in range(40)]
+    doc = _rooms(*names)
+    layout = main.RoomLayout(copy.deepcopy(doc))
+    history = [_apply(layout, {"kind": "room:remove", "name": n}) for n in names[:32]]
+    assert layout.generation == 0 and layout._tombstones == 32
+    # The 33rd tombstone outnumbers the live rooms: slots are compacted
+    history.append(_apply(layout, {"kind": "room:remove", "name": "R32"}))
+    assert layout.generation == 1 and layout._tombstones == 0 and len(layout.slots) == 7
+    history.append(_apply(layout, {"kind": "room:remove", "name": "R35"}))
+    _check_index(layout)
+
+    # Removed after the compaction: back in its own slot
+    main.undo_op_record(layout, history.pop())
+    assert [r["name"] for r in layout.to_dict()["rooms"]] == names[33:]
+    # Removed before it: the old slot numbers are stale, so rooms go to the end
+    while history:
+        main.undo_op_record(layout, history.pop())
+        _check_index(layout)
+    assert sorted(r["name"] for r in layout.to_dict()["rooms"]) == sorted(names)
+    assert {r["name"]: r for r in layout.to_dict()["rooms"]} == {r["name"]: r for r in doc["rooms"]}
+
+
+def test_update_with_unset_round_trips():
+    doc = {"rooms": [{"name": "A", "color": "red", "w": 4}], "meta": {}}
+    layout = main.RoomLayout(copy.deepcopy(doc))
+    op = {"kind": "room:update", "room": {"name": "A", "w": 5, "label": "den"}, "unset": ["color", "missing"]}
+    record = _apply(layout, op)
+    assert layout.get("A") == {"name": "A", "w": 5, "label": "den"}
+    assert record["inverse"] == {"kind": "room:update", "room": {"name": "A", "w": 4, "color": "red"}, "unset": ["label"]}
+
+    main.undo_op_record(layout, record)
+    assert layout.to_dict() == doc
+    # Redo re-applies the op and captures a fresh inverse
+    main.apply_op_record(layout, record)
+    assert layout.get("A") == {"name": "A", "w": 5, "label": "den"}
+    main.undo_op_record(layout, record)
+    assert layout.to_dict() == doc
+
+
+def test_update_of_a_missing_room_adds_it():
+    layout = main.RoomLayout(_rooms("A"))
+    record = _apply(layout, {"kind": "room:update", "room": {"name": "B", "w": 2}})
+    assert layout.get("B") == {"name": "B", "w": 2}
+    main.undo_op_record(layout, record)
+    assert "B" not in layout and len(layout) == 1
+    assert _apply(layout, {"kind": "room:update", "room": {"w": 2}})["inverse"] is None
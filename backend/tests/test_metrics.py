@@ -0,0 +1,33 @@
+# backend/tests/test_metrics.py
+import json
+import re
+import uuid
+
+from fastapi.testclient import TestClient
+
+import main
+
+client = TestClient(main.app)
+
+# name{label="value",...} number, with label values escaped
+_SAMPLE_RE = re.compile(r'^[a-z_:][a-z0-9_:]*(\{([a-z_]+="([^"\\\n]|\\[\\"n])*",?)*\})? \S+$')
+
+
+def test_prometheus_label_escapes_quotes_backslashes_and_newlines():
+    assert main.prometheus_label('a"b\\c\nd') == 'a\\"b\\\\c\\nd'
+
+
+def test_send_queue_metrics_are_per_room_and_parse():
+    username = f'me"tric\\s-{uuid.uuid4().hex[:6]}'
+    client.post("/register", json={"username": username, "password": "pw-test"})
+    token = client.post("/login", json={"username": username, "password": "pw-test"}).json()["token"]
+    auth = {"Authorization": f"Bearer {token}"}
+    pid = client.post("/save-project", json={"name": "m", "layout": {"rooms": [], "meta": {}}}, headers=auth).json()["id"]
+    with client.websocket_connect(f"/ws/projects/{pid}?token={token}") as ws:
+        ws.receive_json()
+        ws.send_text(json.dumps({"type": "op", "opId": "m1", "op": {"kind": "room:add", "room": {"name": "A"}}}))
+        text = client.get("/metrics").text
+    samples = [line for line in text.splitlines() if line and not line.startswith("#")]
+    assert all(_SAMPLE_RE.match(line) for line in samples), [l for l in samples if not _SAMPLE_RE.match(l)]
+    assert any(line.startswith(f'dream_room_send_queue_frames{{project="{pid}"}}') for line in samples)
+    assert "user=" not in text
@@ -0,0 +1,168 @@
+# backend/tests/test_relay.py
+# Two workers in one test process: separate copies of main, each with its own
+# rooms, room leases and relay socket, sharing DATA_DIR and the lease files.
+import importlib.util
+import json
+import os
+import sys
+import time
+import uuid
+
+import pytest
+from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+
+import main
+import storage
+
+pytestmark = pytest.mark.skipif(main.fcntl is None, reason="room leases need flock")
+
+
+def _load(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _worker(name):
+    # ROOM_LEASES is read at import time; conftest turns it off for main.
+    # Each worker also gets its own storage module (pool, journal indexes),
+    # as a separate process would.
+    previous = os.environ.get("ROOM_LEASES", "off")
+    os.environ["ROOM_LEASES"] = "file"
+    try:
+        sys.modules["storage"] = _load(f"{name}_storage", storage.__file__)
+        return _load(name, main.__file__)
+    finally:
+        os.environ["ROOM_LEASES"] = previous
+        sys.modules["storage"] = storage
+
+
+@pytest.fixture(scope="module")
+def workers():
+    a, b = _worker("relay_worker_a"), _worker("relay_worker_b")
+    with TestClient(a.app) as client_a, TestClient(b.app) as client_b:
+        yield (a, client_a), (b, client_b)
+
+
+def _login(client):
+    username = f"relay-{uuid.uuid4().hex[:8]}"
+    client.post("/register", json={"username": username, "password": "pw-test"})
+    return client.post("/login", json={"username": username, "password": "pw-test"}).json()["token"]
+
+
+@pytest.fixture
+def project(workers):
+    """A project, its owner's token (for worker A) and a second user's (for B).
+
+    Rooms keep one connection per user, so the two workers' clients must be
+    different users."""
+    (_, client_a), _ = workers
+    token_a, token_b = _login(client_a), _login(client_a)
+    auth = {"Authorization": f"Bearer {token_a}"}
+    pid = client_a.post("/save-project", json={"name": "relay", "layout": {"rooms": [{"name": "Hall"}], "meta": {}}}, headers=auth).json()["id"]
+    return pid, token_a, token_b, auth
+
+
+def _until(ws, kind):
+    while True:
+        message = ws.receive_json()
+        if message["type"] == kind:
+            return message
+
+
+def _names(layout):
+    return [r["name"] for r in layout["rooms"]]
+
+
+def _eventually(check, timeout=5.0):
+    # Rooms are retired by the server after the client has gone
+    deadline = time.monotonic() + timeout
+    while not check():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_relayed_client_ops_are_acked_and_broadcast(workers, project):
+    (a, client_a), (b, client_b) = workers
+    pid, token_a, token_b, _ = project
+    with client_a.websocket_connect(f"/ws/projects/{pid}?token={token_a}") as ws_a:
+        _until(ws_a, "snapshot")
+        assert pid in a.ROOM_LEASES.held
+        with client_b.websocket_connect(f"/ws/projects/{pid}?token={token_b}") as ws_b:
+            assert _names(_until(ws_b, "snapshot")["layout"]) == ["Hall"]
+            assert pid not in b.PROJECT_ROOMS and b.METRICS["room_relay_clients"] == 1
+            ws_b.send_text(json.dumps({"type": "op", "opId": "r1", "op": {"kind": "room:add", "room": {"name": "Loft"}}}))
+            assert _until(ws_b, "ack")["opId"] == "r1"
+            batch = _until(ws_a, "ops_batch")
+            assert [o["opId"] for o in batch["ops"]] == ["r1"]
+            assert _names(a.PROJECT_ROOMS[pid]["layout"].to_dict()) == ["Hall", "Loft"]
+        assert _until(ws_a, "left")
+    # The room emptied: the owner retired it and handed back the lease
+    _eventually(lambda: pid not in a.PROJECT_ROOMS and pid not in a.ROOM_LEASES.held)
+
+
+def test_room_calls_are_relayed_to_the_owner(workers, project):
+    (a, client_a), (b, client_b) = workers
+    pid, token_a, _, auth = project
+    with client_a.websocket_connect(f"/ws/projects/{pid}?token={token_a}") as ws_a:
+        _until(ws_a, "snapshot")
+        calls = b.METRICS["room_relay_calls_total"]
+        r = client_b.put(f"/projects/{pid}", json={"name": "moved", "layout": {"rooms": [{"name": "Den"}], "meta": {}}}, headers=auth)
+        assert r.status_code == 200 and r.json()["status"] == "updated"
+        assert b.METRICS["room_relay_calls_total"] == calls + 1
+        assert _names(_until(ws_a, "snapshot")["layout"]) == ["Den"]
+        assert pid not in b.PROJECT_ROOMS
+
+        # Errors come back with the owner's status code
+        r = client_b.post(f"/projects/{pid}/undo")
+        assert r.status_code == 400 and r.json()["detail"] == "Nothing to undo"
+
+
+def test_a_live_worker_takes_over_when_the_owner_dies(workers, project):
+    (a, client_a), (b, client_b) = workers
+    pid, token_a, token_b, _ = project
+    with client_a.websocket_connect(f"/ws/projects/{pid}?token={token_a}") as ws_a:
+        _until(ws_a, "snapshot")
+        with client_b.websocket_connect(f"/ws/projects/{pid}?token={token_b}") as ws_b:
+            _until(ws_b, "snapshot")
+            ws_b.send_text(json.dumps({"type": "op", "opId": "t1", "op": {"kind": "room:add", "room": {"name": "Shed"}}}))
+            _until(ws_b, "ack")
+
+            # The owner "dies": its lease fd is closed and its relay stops
+            os.close(a.ROOM_LEASES.held.pop(pid))
+            client_a.portal.call(a.stop_room_relay)
+            with pytest.raises(WebSocketDisconnect) as closed:
+                while True:
+                    ws_b.receive_json()
+            assert closed.value.code == 1012
+
+        # The reconnect claims the room and restores it from the journal
+        with client_b.websocket_connect(f"/ws/projects/{pid}?token={token_b}") as ws_b:
+            assert _names(_until(ws_b, "snapshot")["layout"]) == ["Hall", "Shed"]
+            assert pid in b.ROOM_LEASES.held and pid in b.PROJECT_ROOMS
+            assert [r["opId"] for r in b.PROJECT_ROOMS[pid]["undo_stack"]] == ["t1"]
+        _eventually(lambda: pid not in b.ROOM_LEASES.held)
+        ws_a.close()
+    client_a.portal.call(a.start_room_relay)
+
+
+def test_connecting_to_a_dead_owner_claims_the_room(workers, project):
+    (a, client_a), (b, client_b) = workers
+    pid = project[0]
+    fd = os.open(a.LEASES_DIR / f"{pid}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+    a.fcntl.flock(fd, a.fcntl.LOCK_EX)
+    stale = str(a.WORKERS_DIR / "exited-worker.sock")
+    os.pwrite(fd, stale.encode("utf-8"), 0)
+
+    async def connect():
+        assert await b.claim_room(pid) == stale
+        # The dead holder's flock goes away while the connect is retried
+        b.asyncio.get_running_loop().call_later(b.ROOM_CLAIM_RETRY_SECONDS, os.close, fd)
+        return await b.connect_room_owner(pid, stale)
+
+    assert client_b.portal.call(connect) is None
+    assert pid in b.ROOM_LEASES.held
+    client_b.portal.call(b.release_idle_room, pid)
+    assert pid not in b.ROOM_LEASES.held
@@ -0,0 +1,198 @@
+# backend/tests/test_rooms.py
+# REST writes to a project whose room is open go through the room.
+import json
+import uuid
+
+import pytest
+from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+
+import main
+import storage
+
+client = TestClient(main.app)
+
+
+@pytest.fixture(scope="module", autouse=True)
+def _one_event_loop():
+    # Entered, the client runs every request on one event loop, so REST
+    # calls can wait on a room that a websocket test opened
+    with client:
+        yield
+
+
+@pytest.fixture(scope="module")
+def user():
+    username = f"rooms-{uuid.uuid4().hex[:8]}"
+    client.post("/register", json={"username": username, "password": "pw-test"})
+    token = client.post("/login", json={"username": username, "password": "pw-test"}).json()["token"]
+    return token, {"Authorization": f"Bearer {token}"}
+
+
+def _until(ws, kind):
+    while True:
+        message = ws.receive_json()
+        if message["type"] == kind:
+            return message
+
+
+def _names(layout):
+    return [r["name"] for r in layout["rooms"]]
+
+
+def test_update_and_revert_reset_the_live_room(user):
+    token, auth = user
+    pid = client.post("/save-project", json={"name": "live", "layout": {"rooms": [{"name": "Hall"}], "meta": {}}}, headers=auth).json()["id"]
+    with client.websocket_connect(f"/ws/projects/{pid}?token={token}") as ws:
+        _until(ws, "snapshot")
+        ws.send_text(json.dumps({"type": "op", "opId": "k1", "op": {"kind": "room:add", "room": {"name": "Kitchen"}}}))
+        _until(ws, "ack")
+
+        r = client.put(f"/projects/{pid}", json={"name": "updated", "layout": {"rooms": [{"name": "Loft"}], "meta": {}}}, headers=auth)
+        assert r.status_code == 200 and r.json()["status"] == "updated"
+        assert _names(_until(ws, "snapshot")["layout"]) == ["Loft"]
+        room = main.PROJECT_ROOMS[pid]
+        assert not room["undo_stack"] and _names(room["layout"].to_dict()) == ["Loft"]
+
+        # The update versioned the room's layout from before it, ops included
+        versions = client.get(f"/projects/{pid}/versions").json()["versions"]
+        r = client.post(f"/projects/{pid}/versions/{versions[0]['version']}/revert", headers=auth)
+        assert r.status_code == 200
+        assert _names(_until(ws, "snapshot")["layout"]) == ["Hall", "Kitchen"]
+
+    with client.websocket_connect(f"/ws/projects/{pid}?token={token}") as ws:
+        assert _names(_until(ws, "snapshot")["layout"]) == ["Hall", "Kitchen"]
+    doc = main.load_project_doc(pid)
+    assert doc["name"] == "live" and _names(doc["layout"]) == ["Hall", "Kitchen"]
+
+
+def test_update_of_a_closed_room_starts_a_fresh_history(user):
+    token, auth = user
+    pid = client.post("/save-project", json={"name": "closed", "layout": {"rooms": [], "meta": {}}}, headers=auth).json()["id"]
+    with client.websocket_connect(f"/ws/projects/{pid}?token={token}") as ws:
+        _until(ws, "snapshot")
+        ws.send_text(json.dumps({"type": "op", "opId": "b1", "op": {"kind": "room:add", "room": {"name": "Bath"}}}))
+        _until(ws, "ack")
+    client.put(f"/projects/{pid}", json={"name": "closed", "layout": {"rooms": [{"name": "Den"}], "meta": {}}}, headers=auth)
+    with client.websocket_connect(f"/ws/projects/{pid}?token={token}") as ws:
+        assert _names(_until(ws, "snapshot")["layout"]) == ["Den"]
+        assert not main.PROJECT_ROOMS[pid]["undo_stack"]
+
+
+def test_maintenance_lease_is_held_by_one_worker(monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "LEASES_DIR", tmp_path)
+    monkeypatch.setattr(main, "ROOM_LEASES", main.RoomLeases(tmp_path, "worker-a"))
+    lease = main.acquire_maintenance_lease(False)
+    assert lease is not None
+    # A second holder (another worker's open file) is turned away
+    assert main.acquire_maintenance_lease(False) is None
+    main.release_maintenance_lease(lease)
+    lease = main.acquire_maintenance_lease(False)
+    assert lease is not None
+    main.release_maintenance_lease(lease)
+
+
+def test_taking_a_room_lease_drops_cached_version_state(monkeypatch, tmp_path):
+    leases = main.RoomLeases(tmp_path, "worker-a")
+    pid = uuid.uuid4().hex
+    monkeypatch.setitem(main.VERSION_HEADS, pid, {"id": "stale"})
+    monkeypatch.setitem(main._HEAD_LAYOUTS, pid, ("stale", {}))
+    assert leases.acquire(pid) is None
+    try:
+        assert pid not in main.VERSION_HEADS and pid not in main._HEAD_LAYOUTS
+    finally:
+        leases.release_all()
+
+
+@pytest.fixture
+def failing_journal(monkeypatch):
+    """Makes journal writes of records containing any of the given markers fail."""
+    markers = []
+    write = storage.OpsJournal._write
+
+    def _write(self, records, fsync):
+        if any(m in data for data, _, _ in records for m in markers):
+            raise OSError("disk full")
+        return write(self, records, fsync)
+
+    monkeypatch.setattr(storage.OpsJournal, "_write", _write)
+    return markers
+
+
+def _room_state(pid):
+    room = main.PROJECT_ROOMS[pid]
+    return (_names(room["layout"].to_dict()), [r["opId"] for r in room["undo_stack"]], [r["opId"] for r in room["redo_stack"]])
+
+
+def test_failed_undo_and_redo_are_taken_back(user, failing_journal):
+    token, auth = user
+    pid = client.post("/save-project", json={"name": "j", "layout": {"rooms": [], "meta": {}}}, headers=auth).json()["id"]
+    with client.websocket_connect(f"/ws/projects/{pid}?token={token}") as ws:
+        _until(ws, "snapshot")
+        for op_id, name in (("a1", "Attic"), ("b1", "Bath")):
+            ws.send_text(json.dumps({"type": "op", "opId": op_id, "op": {"kind": "room:add", "room": {"name": name}}}))
+            _until(ws, "ack")
+        ws.send_text(json.dumps({"type": "undo_request"}))
+        _until(ws, "undo")
+        before = _room_state(pid)
+        assert before == (["Attic"], ["a1"], ["b1"])
+
+        failing_journal[:] = [b'"undo":', b'"redo":']
+        ws.send_text(json.dumps({"type": "undo_request"}))
+        assert _until(ws, "error")["msg"] == "undo could not be journaled"
+        assert _names(_until(ws, "snapshot")["layout"]) == ["Attic"]
+        assert _room_state(pid) == before
+        ws.send_text(json.dumps({"type": "redo_request"}))
+        assert _until(ws, "error")["msg"] == "redo could not be journaled"
+        _until(ws, "snapshot")
+        assert _room_state(pid) == before
+
+        # The same through the REST endpoints, which answer 503
+        assert client.post(f"/projects/{pid}/undo").status_code == 503
+        assert client.post(f"/projects/{pid}/redo").status_code == 503
+        assert _room_state(pid) == before
+
+        # The connection survived the failures
+        failing_journal.clear()
+        ws.send_text(json.dumps({"type": "redo_request"}))
+        _until(ws, "redo")
+
+    with client.websocket_connect(f"/ws/projects/{pid}?token={token}") as ws:
+        assert _names(_until(ws, "snapshot")["layout"]) == ["Attic", "Bath"]
+        assert _room_state(pid) == (["Attic", "Bath"], ["a1", "b1"], [])
+
+
+def test_failed_op_is_taken_back(user, failing_journal):
+    token, auth = user
+    pid = client.post("/save-project", json={"name": "j", "layout": {"rooms": [], "meta": {}}}, headers=auth).json()["id"]
+    failing_journal.append(b'"bad"')
+    with client.websocket_connect(f"/ws/projects/{pid}?token={token}") as ws:
+        _until(ws, "snapshot")
+        ws.send_text(json.dumps({"type": "op", "opId": "ok", "op": {"kind": "room:add", "room": {"name": "Hall"}}}))
+        _until(ws, "ack")
+        ws.send_text(json.dumps({"type": "op", "opId": "bad", "op": {"kind": "room:add", "room": {"name": "Loft"}}}))
+        assert _until(ws, "error")["opId"] == "bad"
+        assert _names(_until(ws, "snapshot")["layout"]) == ["Hall"]
+        assert _room_state(pid) == (["Hall"], ["ok"], [])
+
+
+def test_delete_closes_the_live_room(user):
+    token, auth = user
+    pid = client.post("/save-project", json={"name": "doomed", "layout": {"rooms": [{"name": "Hall"}], "meta": {}}}, headers=auth).json()["id"]
+    with client.websocket_connect(f"/ws/projects/{pid}?token={token}") as ws:
+        _until(ws, "snapshot")
+        ws.send_text(json.dumps({"type": "op", "opId": "d1", "op": {"kind": "room:add", "room": {"name": "Attic"}}}))
+        _until(ws, "ack")
+
+        r = client.delete(f"/projects/{pid}", headers=auth)
+        assert r.status_code == 200 and r.json()["status"] == "deleted"
+        assert pid not in main.PROJECT_ROOMS
+        with pytest.raises(WebSocketDisconnect) as closed:
+            while True:
+                ws.receive_json()
+        assert closed.value.code == 4404
+
+    # Nothing flushed the room back after its clients went away
+    assert not main.load_project_doc(pid)
+    assert client.get(f"/projects/{pid}").status_code == 404
+    assert client.delete(f"/projects/{pid}", headers=auth).status_code == 404
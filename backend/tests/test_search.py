@@ -0,0 +1,45 @@
+# backend/tests/test_search.py
+import time
+import uuid
+
+import main
+
+
+def _index(name, rooms, mood="eco"):
+    pid = uuid.uuid4().hex
+    layout = {"rooms": [{"name": r} for r in rooms], "meta": {"mood": mood}}
+    main.index_project(pid, name, "searcher", layout, time.time())
+    return pid
+
+
+def _search(q):
+    rows, total = main.query_project_index(owner="searcher", q=q, limit=50)
+    return {row[0] for row in rows}, total
+
+
+def test_every_term_must_match():
+    cottage = _index("Hill cottage", ["Bedroom 1", "Kitchen"])
+    _index("Hill loft", ["Studio"])
+    ids, total = _search("hill kitchen")
+    assert ids == {cottage}
+    assert total == 1
+
+
+def test_repeated_and_overlapping_terms():
+    pid = _index("Overlap", ["Bedroom 1"], mood="calm")
+    for q in ("bedroom", "bedroom bed", "bedroom bedroom", "overlap bedroom overlap"):
+        ids, _ = _search(q)
+        assert pid in ids, q
+
+
+def test_last_term_is_a_prefix():
+    pid = _index("Prefix", ["Bathroom"], mood="calm")
+    assert pid in _search("prefix bath")[0]
+    assert pid not in _search("bath prefix")[0]
+
+
+def test_filters_combine_with_terms():
+    big = _index("Filtered", ["Bedroom 1", "Bedroom 2", "Bedroom 3"], mood="bold")
+    small = _index("Filtered", ["Bedroom 1"], mood="bold")
+    ids, _ = _search("filtered bedrooms>=3 mood:bold")
+    assert big in ids and small not in ids
@@ -0,0 +1,306 @@
+# backend/tests/test_storage.py
+# The same round trips against both storage backends, plus fs -> sqlite migration.
+import asyncio
+import json
+import threading
+import uuid
+
+import pytest
+
+import main
+import storage as storage_layer
+
+
+@pytest.fixture(params=["fs", "sqlite"])
+def storage(request, monkeypatch, tmp_path):
+    store = storage_layer.open_storage(request.param, tmp_path / "storage.db")
+    monkeypatch.setattr(main, "STORAGE", store)
+    yield store
+    store.close()
+
+
+def _op(i, name=None):
+    return {"opId": f"op-{i}-{uuid.uuid4().hex[:6]}", "from": "tester", "ts": f"2026-01-01T00:00:{i:02d}",
+            "op": {"kind": "room:add", "room": {"name": name or f"Room {i}", "x": i}}}
+
+
+def _project(rooms=1):
+    pid = uuid.uuid4().hex
+    main.write_project_file(pid, "storage", {"rooms": [{"name": f"Base {i}"} for i in range(rooms)], "meta": {}}, owner="tester")
+    return pid
+
+
+def test_storage_requires_every_method():
+    class Partial(storage_layer.Storage):
+        def read_project(self, pid):
+            return None
+
+    with pytest.raises(TypeError):
+        Partial()
+
+
+def test_project_round_trip(storage):
+    pid = _project()
+    doc = json.loads(storage.read_project(pid))
+    assert doc["id"] == pid and doc["owner"] == "tester"
+    stamp = storage.project_stamp(pid)
+    main.write_project_file(pid, "renamed", doc["layout"], owner="tester")
+    assert storage.project_stamp(pid) != stamp
+    assert json.loads(storage.read_project(pid))["name"] == "renamed"
+    assert pid in storage.project_ids()
+    assert storage.delete_project(pid)
+    assert storage.read_project(pid) is None and storage.project_stamp(pid) is None
+
+
+def test_journal_round_trip(storage):
+    pid = _project()
+    records = [_op(i) for i in range(5)]
+
+    async def write():
+        journal = storage.open_journal(pid, main.project_layout_document, main.project_written)
+        await asyncio.gather(*(journal.append(r) for r in records))
+        await journal.write_layout({"rooms": [r["op"]["room"] for r in records], "meta": {}})
+        await journal.close()
+
+    asyncio.run(write())
+    assert storage.has_journal(pid)
+    assert storage.last_op(pid)["opId"] == records[-1]["opId"]
+    assert [r["opId"] for r in storage.recent_ops(pid, 2)] == [records[4]["opId"], records[3]["opId"]]
+    older = storage.recent_ops(pid, 10, before=records[2]["opId"])
+    assert [r["opId"] for r in older] == [records[1]["opId"], records[0]["opId"]]
+    exported = [json.loads(line) for chunk in storage.export_ops(pid) for line in chunk.splitlines()]
+    assert [r["opId"] for r in exported] == [r["opId"] for r in records]
+    assert len(json.loads(storage.read_project(pid))["layout"]["rooms"]) == 5
+
+
+def test_checkpoint_and_journal_tail_rebuild_the_room(storage):
+    pid = _project()
+    records = [_op(i) for i in range(5)]
+    storage.import_ops(pid, records[:3])
+    layout = main.RoomLayout({"rooms": [{"name": "Base 0"}], "meta": {}})
+    for r in records[:3]:
+        main.apply_op_record(layout, r)
+    main.write_checkpoint(pid, {"layout": layout.to_dict(), "undo_stack": records[:3], "redo_stack": []},
+                          storage.journal_end(pid), records[2]["opId"])
+    storage.import_ops(pid, records[3:] + [{"opId": "u1", "from": "tester", "ts": "2026-01-01T00:01:00", "undo": records[4]["opId"]}])
+
+    state = main.load_room_state(pid)
+    names = [r["name"] for r in state["layout"].to_dict()["rooms"]]
+    assert names == ["Base 0", "Room 0", "Room 1", "Room 2", "Room 3"]
+    assert [r["opId"] for r in state["undo_stack"]] == [r["opId"] for r in records[:4]]
+    assert [r["opId"] for r in state["redo_stack"]] == [records[4]["opId"]]
+    assert state["last_op_id"] == "u1"
+
+    main.reset_checkpoint(pid, {"rooms": [], "meta": {}})
+    state = main.load_room_state(pid)
+    assert state["layout"].to_dict()["rooms"] == [] and not state["undo_stack"]
+    storage.delete_checkpoint(pid)
+    assert storage.load_checkpoint(pid) is None
+
+
+def test_versions_round_trip(storage, monkeypatch):
+    monkeypatch.setattr(main, "VERSION_KEYFRAME_INTERVAL", 3)
+    pid = _project(rooms=20)
+    ids = []
+    for i in range(4):
+        main.write_project_file(pid, f"v{i}", {"rooms": [{"name": f"Base {j}", "x": i if j == 0 else 0} for j in range(20)], "meta": {}}, owner="tester")
+        ids.append(main.create_version_from_project(pid))
+    items, total = main.list_versions_for_project(pid, limit=2)
+    assert total == 4 and [v["version"] for v in items] == ids[:1:-1]
+    assert [e["kind"] for e in main.load_version_manifest(pid)] == ["keyframe", "delta", "delta", "keyframe"]
+    for i, vid in enumerate(ids):
+        assert storage.version_exists(pid, vid)
+        assert main.get_version_json(pid, vid)["project"]["layout"]["rooms"][0]["x"] == i
+
+    stamp = storage.versions_stamp(pid)
+    main.set_version_pinned(pid, ids[0], True)
+    assert storage.versions_stamp(pid) != stamp
+    assert main.load_version_pins(pid) == {ids[0]}
+    assert storage.read_version_doc(pid, "HEAD")["id"] == ids[-1]
+    assert storage.delete_version(pid, ids[-1]) > 0
+    assert not storage.version_exists(pid, ids[-1])
+
+
+def test_users_and_tokens(storage):
+    users, tokens = storage.user_store(), storage.token_store()
+    name = f"user-{uuid.uuid4().hex[:6]}"
+    users.create(name, {"password_hash": "x"})
+    assert users.get(name)["password_hash"] == "x"
+    with pytest.raises(ValueError):
+        users.create(name, {"password_hash": "y"})
+    token = uuid.uuid4().hex
+    tokens.add(token, name)
+    assert tokens.username(token) == name
+    tokens.remove(token)
+    assert tokens.username(token) is None
+
+
+def test_fs_to_sqlite_migration(monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "VERSION_KEYFRAME_INTERVAL", 3)
+    src = storage_layer.open_storage("fs")
+    monkeypatch.setattr(main, "STORAGE", src)
+    pid = _project(rooms=20)
+    main.create_version_from_project(pid)
+    main.write_project_file(pid, "second", {"rooms": [{"name": f"Base {j}", "x": 1 if j == 0 else 0} for j in range(20)], "meta": {}}, owner="tester")
+    vid = main.create_version_from_project(pid)
+    records = [_op(i) for i in range(4)]
+    src.import_ops(pid, records[:2])
+    main.reset_checkpoint(pid, main.load_project_layout(pid))
+    src.import_ops(pid, records[2:])
+    name = f"user-{uuid.uuid4().hex[:6]}"
+    src.user_store().create(name, {"password_hash": "x"})
+    src.token_store().add("migrated-token", name)
+    before = main.load_room_state(pid)
+
+    dst = storage_layer.open_storage("sqlite", tmp_path / "migrated.db")
+    try:
+        counts = storage_layer.migrate_storage(src, dst)
+        assert counts["projects"] >= 1 and counts["ops"] >= 4 and counts["versions"] >= 2
+        assert json.loads(dst.read_project(pid)) == json.loads(src.read_project(pid))
+        assert [r["opId"] for r in dst.recent_ops(pid, 10)] == [r["opId"] for r in reversed(records)]
+        assert dst.user_store().get(name)["password_hash"] == "x"
+        assert dst.token_store().username("migrated-token") == name
+
+        monkeypatch.setattr(main, "STORAGE", dst)
+        after = main.load_room_state(pid)
+        assert after["layout"].to_dict() == before["layout"].to_dict()
+        assert [r["opId"] for r in after["undo_stack"]] == [r["opId"] for r in records[2:]]
+        assert main.get_version_json(pid, vid)["project"]["layout"]["rooms"][0]["x"] == 1
+        assert [e["id"] for e in main.load_version_manifest(pid)][-1] == vid
+    finally:
+        dst.close()
+
+
+def test_token_log_keeps_every_worker_line_across_compactions(tmp_path):
+    # One TokenStore per "worker": each has its own in-process lock, so only
+    # the lock file keeps appends and compactions apart
+    path = tmp_path / "tokens.log"
+    workers = [storage_layer.TokenStore(path, ttl=3600) for _ in range(4)]
+    expired = storage_layer.TokenStore(path, ttl=-1)
+    expired.add("old", "someone")
+
+    def login(store, n):
+        for i in range(50):
+            store.add(f"t{n}-{i}", f"user{n}")
+            if i % 5 == 0:
+                store.remove(f"t{n}-{i}")
+
+    def prune(store):
+        for _ in range(30):
+            store.compact()
+
+    threads = [threading.Thread(target=login, args=(w, n)) for n, w in enumerate(workers)]
+    threads.append(threading.Thread(target=prune, args=(storage_layer.TokenStore(path, ttl=3600),)))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    fresh = storage_layer.TokenStore(path, ttl=3600)
+    for n in range(4):
+        for i in range(50):
+            assert fresh.username(f"t{n}-{i}") == (None if i % 5 == 0 else f"user{n}")
+    assert fresh.username("old") is None
+
+
+def test_concurrent_registrations_are_all_kept(tmp_path):
+    path = tmp_path / "users.json"
+    stores = [storage_layer.UserStore(path) for _ in range(4)]
+    threads = [threading.Thread(target=lambda s=s, n=n: [s.create(f"u{n}-{i}", {"n": i}) for i in range(25)])
+               for n, s in enumerate(stores)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(storage_layer.UserStore(path).snapshot()) == 100
+
+
+@pytest.fixture
+def fs_journal(monkeypatch):
+    monkeypatch.setattr(main, "STORAGE", storage_layer.open_storage("fs"))
+    monkeypatch.setattr(storage_layer, "JOURNAL_INDEX_EVERY", 2)
+    pid = _project()
+    yield pid
+    storage_layer.JOURNAL_INDEXES.pop(pid, None)
+
+
+def _journal(pid, records, compact_after=None):
+    async def write():
+        journal = storage_layer.OpsJournal(pid, main.STORAGE, main.project_layout_document, main.project_written)
+        for i, r in enumerate(records):
+            await journal.append(r)
+            if i + 1 == compact_after:
+                await journal.compact(journal.offset)
+        await journal.close()
+
+    asyncio.run(write())
+
+
+def _fresh_index(pid):
+    storage_layer.JOURNAL_INDEXES.pop(pid, None)
+    return storage_layer.journal_index(pid)
+
+
+def test_torn_journal_tail_is_cut_before_appending(fs_journal):
+    pid = fs_journal
+    records = [_op(i) for i in range(3)]
+    _journal(pid, records[:2])
+    with open(storage_layer.OPS_DIR / f"{pid}.log", "ab") as fh:
+        fh.write(b'{"opId": "torn", "op": {"ki')
+    _journal(pid, records[2:])
+
+    lines = [json.loads(line) for _, line in storage_layer.iter_journal_lines(pid)]
+    assert [r["opId"] for r in lines] == [r["opId"] for r in records]
+    first, ops = storage_layer.read_ops(pid, since_seq=1)
+    assert first == 1 and [r["opId"] for r in ops] == [r["opId"] for r in records[1:]]
+
+
+def test_journal_index_is_rebuilt_when_it_does_not_match(fs_journal, caplog):
+    pid = fs_journal
+    records = [_op(i) for i in range(6)]
+    _journal(pid, records)
+    good = _fresh_index(pid).entries
+    assert [e[0] for e in good] == [0, 2, 4]
+
+    path = storage_layer.OPS_DIR / f"{pid}.idx"
+    entries = [json.loads(line) for line in path.read_bytes().splitlines()]
+    entries[-1][3] = "not-this-op"
+    path.write_bytes(b"".join(json.dumps(e).encode("utf-8") + b"\n" for e in entries))
+    with caplog.at_level("WARNING"):
+        index = _fresh_index(pid)
+    assert "rebuilding" in caplog.text
+    assert index.entries == good and index.records == 6
+
+
+def test_journal_positions_survive_compaction(fs_journal):
+    pid = fs_journal
+    records = [_op(i) for i in range(7)]
+    _journal(pid, records, compact_after=3)
+    assert len(storage_layer.journal_files(pid)) == 2
+
+    live = storage_layer.journal_index(pid).entries
+    rebuilt = _fresh_index(pid).entries
+    assert live == rebuilt and [e[0] for e in live] == [0, 2, 4, 6]
+    lines = dict(storage_layer.iter_journal_lines(pid))
+    for number, _, pos, op_id in live:
+        assert json.loads(lines[pos])["opId"] == op_id == records[number]["opId"]
+    for since in range(8):
+        first, ops = storage_layer.read_ops(pid, since_seq=since)
+        assert first == since and [r["opId"] for r in ops] == [r["opId"] for r in records[since:]]
+
+
+def test_read_ops_by_number_and_receive_time(storage, monkeypatch):
+    monkeypatch.setattr(storage_layer, "JOURNAL_INDEX_EVERY", 2)
+    pid = _project()
+    # Client clocks are ignored; only the server receive time counts
+    records = [dict(_op(i), ts=f"20{90 - i}-01-01T00:00:00", received=1000.0 + i) for i in range(6)]
+    storage.import_ops(pid, records[:4])
+    storage.import_ops(pid, records[4:])
+
+    first, ops = storage.read_ops(pid, since_seq=3, limit=2)
+    assert first == 3 and [r["opId"] for r in ops] == [r["opId"] for r in records[3:5]]
+    first, ops = storage.read_ops(pid, since_ts=1002.5)
+    assert first == 3 and [r["opId"] for r in ops] == [r["opId"] for r in records[3:]]
+    first, ops = storage.read_ops(pid, since_ts=2000.0)
+    assert first == 6 and ops == []
+    storage_layer.JOURNAL_INDEXES.pop(pid, None)
@@ -0,0 +1,27 @@
+# backend/tests/test_storage_executor.py
+import asyncio
+
+import storage
+
+
+def test_keyed_calls_run_in_order_and_drop_their_lock():
+    done = []
+
+    async def run():
+        await asyncio.gather(*(storage.run_storage(done.append, i, key="executor-test") for i in range(20)))
+
+    asyncio.run(run())
+    assert done == list(range(20))
+    assert "executor-test" not in storage._STORAGE_LOCKS
+    assert "executor-test" not in storage._STORAGE_LOCK_USERS
+
+
+def test_lock_is_dropped_after_a_failing_call():
+    async def run():
+        await storage.run_storage(int, "not a number", key="executor-fail")
+
+    try:
+        asyncio.run(run())
+    except ValueError:
+        pass
+    assert "executor-fail" not in storage._STORAGE_LOCKS
@@ -0,0 +1,77 @@
+# backend/tests/test_thumbnails.py
+import base64
+import io
+import struct
+import uuid
+import zlib
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+client = TestClient(main.app)
+
+
+@pytest.fixture(scope="module")
+def auth():
+    username = f"thumbs-{uuid.uuid4().hex[:8]}"
+    client.post("/register", json={"username": username, "password": "pw-test"})
+    token = client.post("/login", json={"username": username, "password": "pw-test"}).json()["token"]
+    return {"Authorization": f"Bearer {token}"}
+
+
+def _png(width=8, height=8) -> bytes:
+    # A white RGB image, built by hand so the test runs without Pillow
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    rows = b"".join(b"\x00" + b"\xff" * 3 * width for _ in range(height))
+    return (main.PNG_SIGNATURE + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(rows)) + chunk(b"IEND", b""))
+
+
+def _data_url(data: bytes, mime="image/png") -> str:
+    return f"data:{mime};base64," + base64.b64encode(data).decode()
+
+
+def _save(auth, thumbnail):
+    return client.post("/save-project", json={"name": "t", "layout": {"rooms": [{"name": "A"}], "meta": {}}, "thumbnail": thumbnail}, headers=auth)
+
+
+def test_valid_thumbnail_is_stored(auth):
+    res = _save(auth, _data_url(_png()))
+    assert res.status_code == 200 and "thumbnail_error" not in res.json()
+    assert main.load_thumbnail_record(res.json()["id"])["width"] == 8
+
+
+def test_garbage_thumbnail_does_not_block_the_save(auth):
+    res = _save(auth, _data_url(b"not an image"))
+    assert res.status_code == 200
+    body = res.json()
+    assert body["thumbnail_error"]
+    assert client.get(f"/projects/{body['id']}").json()["layout"]["rooms"] == [{"name": "A"}]
+    assert not main.load_thumbnail_record(body["id"])
+
+
+def test_oversized_or_foreign_images_are_refitted(auth, monkeypatch):
+    pytest.importorskip("PIL")
+    monkeypatch.setattr(main, "THUMBNAIL_MAX_DIMENSION", 64)
+    res = _save(auth, _data_url(_png(200, 100)))
+    assert res.status_code == 200 and "thumbnail_error" not in res.json()
+    record = main.load_thumbnail_record(res.json()["id"])
+    assert max(record["width"], record["height"]) <= 64
+
+    from PIL import Image
+    buf = io.BytesIO()
+    Image.new("RGB", (16, 16), "red").save(buf, "JPEG")
+    res = _save(auth, _data_url(buf.getvalue(), "image/jpeg"))
+    assert res.status_code == 200 and "thumbnail_error" not in res.json()
+    assert main.load_thumbnail_record(res.json()["id"])["width"] == 16
+
+
+def test_update_keeps_the_old_thumbnail_when_the_new_one_is_dropped(auth):
+    pid = _save(auth, _data_url(_png())).json()["id"]
+    res = client.put(f"/projects/{pid}", json={"name": "t2", "layout": {"rooms": [], "meta": {}}, "thumbnail": "bad"}, headers=auth)
+    assert res.status_code == 200 and res.json()["thumbnail_error"]
+    doc = client.get(f"/projects/{pid}").json()
+    assert doc["name"] == "t2" and doc["thumbnail"] == f"{pid}.png"
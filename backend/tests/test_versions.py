@@ -0,0 +1,144 @@
+# backend/tests/test_versions.py
+import asyncio
+import os
+import time
+import uuid
+from datetime import datetime, timezone
+
+import pytest
+from fastapi import HTTPException
+
+import main
+import storage
+
+
+def _layout(n, **meta):
+    return {"rooms": [{"name": f"Room {i}", "x": i, "y": i * 2, "w": 4, "h": 3} for i in range(n)], "meta": meta}
+
+
+@pytest.mark.parametrize("a, b", [
+    ({"a": 1}, {"a": 1}),
+    ({"a": 1, "b": 2}, {"a": 1, "c": 3}),
+    ({"a": {"b": [1, 2, 3]}}, {"a": {"b": [1, 3, 4]}}),
+    ([1, 2, 3, 4], [0, 1, 3, 4, 5]),
+    ([{"name": "A", "x": 1}, {"name": "B"}], [{"name": "B"}, {"name": "A", "x": 2}]),
+    ({"a": [1, 2]}, {"a": "text"}),
+    ([], [{"name": "A"}]),
+    ({"rooms": [{"name": "A"}], "meta": {}}, {"meta": {"mood": "eco"}}),
+    (None, {"a": 1}),
+])
+def test_json_diff_patch_round_trip(a, b):
+    patch = main.json_diff(a, b)
+    if a == b:
+        assert patch is None
+    assert main.json_patch(a, patch) == b
+
+
+def test_json_patch_does_not_share_inserted_values():
+    a, b = {"rooms": []}, {"rooms": [{"name": "A"}]}
+    patch = main.json_diff(a, b)
+    out = main.json_patch(a, patch)
+    out["rooms"][0]["name"] = "changed"
+    assert main.json_patch(a, patch) == b
+
+
+def _versioned_project(monkeypatch, count):
+    monkeypatch.setattr(main, "VERSION_KEYFRAME_INTERVAL", 3)
+    pid = uuid.uuid4().hex
+    layouts, ids = [], []
+    for i in range(count):
+        layout = _layout(20 + i, step=i)
+        main.write_project_file(pid, "versions", layout, owner="tester")
+        ids.append(main.create_version_from_project(pid))
+        layouts.append(layout)
+    return pid, ids, layouts
+
+
+def test_versions_rebuild_from_keyframes_and_deltas(monkeypatch):
+    pid, ids, layouts = _versioned_project(monkeypatch, 7)
+    kinds = [e["kind"] for e in main.load_version_manifest(pid)]
+    assert kinds == ["keyframe", "delta", "delta", "keyframe", "delta", "delta", "keyframe"]
+    for vid, layout in zip(ids, layouts):
+        assert main.load_version_layout(pid, vid) == layout
+        assert main.get_version_json(pid, vid)["project"]["layout"] == layout
+
+
+def test_unchanged_project_adds_no_version(monkeypatch):
+    pid, ids, _ = _versioned_project(monkeypatch, 2)
+    assert main.create_version_from_project(pid) == ids[-1]
+    assert len(main.load_version_manifest(pid)) == 2
+
+
+def test_broken_delta_chain_is_reported(monkeypatch):
+    pid, ids, _ = _versioned_project(monkeypatch, 3)
+    main.STORAGE.delete_version(pid, ids[0])
+    assert main.load_version_layout(pid, ids[2]) is None
+    with pytest.raises(HTTPException) as err:
+        main.get_version_json(pid, ids[2])
+    assert err.value.status_code == 409
+    with pytest.raises(HTTPException):
+        main.revert_project_to_version(pid, ids[2], owner="tester")
+    # The project is left as it was
+    assert main.load_project_doc(pid)["layout"]["meta"] == {"step": 2}
+
+
+def test_retention_runs_as_a_room_call_and_keeps_pins(monkeypatch):
+    pid, ids, layouts = _versioned_project(monkeypatch, 4)
+    monkeypatch.setattr(main, "VERSION_RETENTION_TIERS", [(1e-9, 0)])
+    asyncio.run(main.room_call(pid, "pin", version_id=ids[1], pinned=True))
+    result = asyncio.run(main.room_call(pid, "prune_versions"))
+    assert result["versions_pruned"] == 2
+    assert [e["id"] for e in main.load_version_manifest(pid)] == [ids[1], ids[3]]
+    assert main.load_version_layout(pid, ids[3]) == layouts[3]
+
+
+def _entries(ages, now):
+    return [{"id": f"v{age}", "created": datetime.fromtimestamp(now - age, timezone.utc).isoformat()} for age in ages]
+
+
+def test_retention_tiers_keep_the_newest_version_per_bucket():
+    now = 1_800_000_000.0
+    tiers = main.parse_retention_tiers("1h:all,1d:1h,30d:1d")
+    # Oldest first, like the manifest
+    ages = [40 * 86400, 3 * 86400 + 60, 3 * 86400 + 30, 2 * 86400 + 10, 5 * 3600 + 20, 5 * 3600 + 10, 2 * 3600, 600, 300, 5]
+    keep = main.select_versions_to_keep(_entries(ages, now), tiers, set(), now)
+    # Within an hour: everything. Within a day: one per hour. Within 30 days:
+    # one per day. Older than every tier: nothing.
+    assert keep == {"v5", "v300", "v600", "v7200", "v18010", "v172810", "v259230"}
+    assert main.select_versions_to_keep(_entries(ages, now), tiers, {"v3456000"}, now) == keep | {"v3456000"}
+
+
+def test_pruning_keeps_pins_and_rebuilds_what_remains(monkeypatch):
+    pid, ids, layouts = _versioned_project(monkeypatch, 5)
+    monkeypatch.setattr(main, "VERSION_RETENTION_TIERS", [(3600, 0), (1e12, 1e12)])
+    main.set_version_pinned(pid, ids[1], True)
+    # An hour on, every unpinned version but the newest falls into one bucket
+    removed, freed = main.prune_project_versions(pid, now=time.time() + 7200)
+    assert removed == 3 and freed > 0
+    assert [e["id"] for e in main.load_version_manifest(pid)] == [ids[1], ids[4]]
+    for vid in (ids[1], ids[4]):
+        assert main.load_version_layout(pid, vid) == layouts[ids.index(vid)]
+    assert main.prune_project_versions(pid, now=time.time() + 7200) == (0, 0)
+
+
+def _age(path, seconds):
+    old = time.time() - seconds
+    os.utime(path, (old, old))
+
+
+def test_blob_gc_spares_referenced_and_recently_reused_blobs(monkeypatch):
+    pid, ids, _ = _versioned_project(monkeypatch, 1)
+    grace = main.BLOB_GC_GRACE_SECONDS
+    referenced = storage.blob_path(main.STORAGE.read_version(pid, ids[0])["meta"]["layout_blob"])
+    orphan = storage.blob_path(storage.put_blob(f"orphan {uuid.uuid4()}".encode()))
+    reused_data = f"reused {uuid.uuid4()}".encode()
+    reused = storage.blob_path(storage.put_blob(reused_data))
+    for path in (referenced, orphan, reused):
+        _age(path, 2 * grace)
+    # Stored again (by a new version in flight) within the grace window
+    storage.put_blob(reused_data)
+
+    removed, freed = main.collect_unreferenced_blobs(grace)
+    assert removed >= 1 and freed >= len("orphan ")
+    assert not orphan.exists()
+    assert referenced.exists() and reused.exists()
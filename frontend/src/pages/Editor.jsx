@@ -10,6 +10,15 @@ import CollabClient from "../services/collab";
  * Day20 Editor — Presence, Cursors, Autosave, Rollback
  */
 
+// Journal records from /ops/recent are ops ({op: {kind}}) or undo/redo
+// records ({undo: opId} / {redo: opId}); live messages carry a type.
+function recentOpLabel(entry) {
+  if (entry.op?.kind) return entry.op.kind;
+  if (entry.undo) return `undo of ${String(entry.undo).slice(0, 8)}`;
+  if (entry.redo) return `redo of ${String(entry.redo).slice(0, 8)}`;
+  return entry.type || "op";
+}
+
 export default function Editor() {
   const [layout, setLayout] = useState(null);
   const [selected, setSelected] = useState(null);
@@ -208,6 +217,10 @@ export default function Editor() {
         const id = msg.userId;
         setParticipants((prev) => (prev || []).filter((p) => p.userId !== id));
       },
+      onResume: (msg) => {
+        setCollabStatus("connected");
+        setParticipants(msg.clients || []);
+      },
       onOpen: () => setCollabStatus("connected"),
       onReconnect: (delay) => {
         setCollabStatus("connecting");
@@ -386,15 +399,18 @@ export default function Editor() {
     }
 
     try {
+      let res;
       if (projectId) {
-        await api.put(`/projects/${projectId}`, { name, layout, thumbnail }, { headers: { Authorization: `Bearer ${token}` } });
+        res = await api.put(`/projects/${projectId}`, { name, layout, thumbnail }, { headers: { Authorization: `Bearer ${token}` } });
         alert("Project updated.");
       } else {
-        const res = await api.post("/save-project", { name, layout, thumbnail }, { headers: { Authorization: `Bearer ${token}` } });
+        res = await api.post("/save-project", { name, layout, thumbnail }, { headers: { Authorization: `Bearer ${token}` } });
         setProjectId(res.data.id);
         alert("Saved. id: " + res.data.id);
       }
-      if (thumbnail) setThumbnailUrl(thumbnail);
+      // The layout is saved even when the server drops the screenshot
+      if (res.data.thumbnail_error) console.warn("Thumbnail not saved:", res.data.thumbnail_error);
+      else if (thumbnail) setThumbnailUrl(thumbnail);
       setSaved(true);
       setTimeout(() => setSaved(false), 2000);
       if (collabRef.current) collabRef.current.requestSave();
@@ -479,6 +495,17 @@ export default function Editor() {
   };
 
   // ---------- Versions ----------
+  // /versions is paged (newest first): follow `total` to load the whole history
+  const loadVersionHistory = async () => {
+    const all = [];
+    for (let page = 1; ; page++) {
+      const res = await api.get(`/projects/${projectId}/versions`, { params: { page, limit: 500 } });
+      const items = res.data.versions || [];
+      all.push(...items);
+      if (items.length === 0 || all.length >= (res.data.total ?? all.length)) return all;
+    }
+  };
+
   const fetchVersions = async () => {
     if (!projectId) {
       alert("Save project first to get versions.");
@@ -486,9 +513,7 @@ export default function Editor() {
     }
     setLoadingVersions(true);
     try {
-      const res = await api.get(`/projects/${projectId}/versions`);
-      setVersionsList(res.data.versions ||
-      []);
+      setVersionsList(await loadVersionHistory());
       setVersionsOpen(true);
       setCompareMode(false);
       setCompareLeftId(null);
@@ -569,8 +594,7 @@ export default function Editor() {
       const proj = (await api.get(`/projects/${projectId}`)).data;
       setLayout(proj.layout);
       setPreviewingVersion(null);
-      const list = (await api.get(`/projects/${projectId}/versions`)).data.versions;
-      setVersionsList(list || []);
+      setVersionsList(await loadVersionHistory());
     } catch (err) {
       console.error("Revert failed", err);
       alert(err?.response?.data?.detail || "Revert failed");
@@ -756,7 +780,7 @@ export default function Editor() {
           <div className="flex flex-col gap-1 text-sm overflow-y-auto" style={{maxHeight: "150px"}}>
             {recentOps.length === 0 ? <div className="text-gray-500">No ops yet.</div> : recentOps.map((op, i) => (
                 <div key={i} className="bg-gray-100 p-2 rounded">
-                    <strong>{op.op?.kind || op.type}</strong> by {op.from}
+                    <strong>{recentOpLabel(op)}</strong> by {op.from}
                 </div>
             ))}
           </div>
@@ -3,6 +3,9 @@
 // - Ping/Pong Heartbeat (Client-side)
 // - Op Batching/Buffering
 
+// Snapshots can be sent deflate-compressed as binary frames
+const SUPPORTS_DEFLATE = typeof DecompressionStream !== "undefined";
+
 const DEFAULT_WS_HOST = (() => {
   if (typeof window === "undefined") return "ws://localhost:8000";
   const loc = window.location;
@@ -12,7 +15,7 @@ const DEFAULT_WS_HOST = (() => {
 })();
 
 export default class CollabClient {
-  constructor({ projectId, token = null, onSnapshot, onOp, onPresence, onJoined, onLeft, onOpen, onReconnect, onUndo, onRedo, onCursorBroadcast, onAutosaveConfirm }) {
+  constructor({ projectId, token = null, onSnapshot, onOp, onPresence, onJoined, onLeft, onOpen, onReconnect, onUndo, onRedo, onCursorBroadcast, onAutosaveConfirm, onResume }) {
     this.projectId = projectId;
     this.token = token || localStorage.getItem("token") || null;
     this.onSnapshot = onSnapshot || (() => {});
@@ -27,8 +30,13 @@ export default class CollabClient {
     this.onRedo = onRedo || (() => {});
     this.onCursorBroadcast = onCursorBroadcast || (() => {});
     this.onAutosaveConfirm = onAutosaveConfirm || (() => {});
+    this.onResume = onResume || (() => {});
 
     this.pending = {};
+    this.userId = null;
+    // Last layout-changing frame seen; sent on reconnect to get only missed ops
+    this.epoch = null;
+    this.seq = null;
     this._backoff = 1000;
     this._reconnectTimer = null;
     this._heartbeatTimer = null;
@@ -43,20 +51,33 @@ export default class CollabClient {
 
   _buildUrl() {
     const t = encodeURIComponent(this.token || "");
-    return `${DEFAULT_WS_HOST}/ws/projects/${this.projectId}?token=${t}`;
+    let url = `${DEFAULT_WS_HOST}/ws/projects/${this.projectId}?token=${t}`;
+    if (this.epoch && this.seq !== null) {
+      url += `&since=${this.seq}&epoch=${encodeURIComponent(this.epoch)}`;
+    }
+    if (SUPPORTS_DEFLATE) url += "&compress=deflate";
+    return url;
   }
 
   connect() {
     this.close();
     const url = this._buildUrl();
     this.socket = new WebSocket(url);
+    this.socket.binaryType = "arraybuffer";
     this.socket.onopen = () => {
       this._backoff = 1000;
       this._onopen();
       this._sendPending();
     };
     this.socket.onmessage = (event) => this._onmessage(event);
-    this.socket.onclose = () => this._scheduleReconnect();
+    this.socket.onclose = (e) => {
+      // 4404: the project was deleted, there is nothing to reconnect to
+      if (e && e.code === 4404) {
+        this._stopHeartbeat();
+        return;
+      }
+      this._scheduleReconnect();
+    };
     this.socket.onerror = (e) => {
       console.warn("WS error", e);
       this.socket.close();
@@ -80,13 +101,37 @@ export default class CollabClient {
     this._startHeartbeat();
   }
 
+  async _inflate(buffer) {
+    const stream = new Blob([buffer]).stream().pipeThrough(new DecompressionStream("deflate"));
+    return new Response(stream).text();
+  }
+
   _onmessage(evt) {
+    if (!(evt.data instanceof ArrayBuffer) && !this._inbox) {
+      this._handleMessage(evt.data);
+      return;
+    }
+    // Binary frames are deflated snapshots; frames arriving while one is being
+    // inflated wait behind it so ordering is kept.
+    const data = evt.data;
+    const next = (this._inbox || Promise.resolve())
+      .then(() => (data instanceof ArrayBuffer ? this._inflate(data) : data))
+      .then((text) => this._handleMessage(text))
+      .catch((e) => console.warn("Failed to inflate frame:", e));
+    this._inbox = next;
+    next.then(() => {
+      if (this._inbox === next) this._inbox = null;
+    });
+  }
+
+  _handleMessage(data) {
     let msg;
     try {
-      msg = JSON.parse(evt.data);
+      msg = JSON.parse(data);
     } catch (e) {
       return;
     }
+    if (typeof msg.seq === "number") this.seq = msg.seq;
     
     // Day 21: Handle PING/PONG heartbeat
     if (msg.type === "ping") {
@@ -111,7 +156,14 @@ export default class CollabClient {
         this.onAck(msg);
       }
     } else if (msg.type === "snapshot") {
+      if (msg.you) this.userId = msg.you;
+      if (msg.epoch) this.epoch = msg.epoch;
       this.onSnapshot(msg.layout, msg.clients);
+    } else if (msg.type === "resume") {
+      // Missed frames (if any) follow this message
+      this.userId = msg.you || this.userId;
+      this.epoch = msg.epoch;
+      this.onResume(msg);
     } else if (msg.type === "op") {
       this.onOp(msg);
     } else if (msg.type === "presence") {
@@ -131,6 +183,17 @@ export default class CollabClient {
     } 
     else if (msg.type === "cursor_broadcast") {
       this.onCursorBroadcast(msg);
+    } else if (msg.type === "cursors_batch") {
+      // Latest cursor/presence per user, coalesced by the server each tick
+      (msg.cursors || []).forEach(entry => {
+        if (entry.userId === this.userId) return;
+        if (entry.cursor) {
+          this.onCursorBroadcast({ type: "cursor_broadcast", userId: entry.userId, cursor: entry.cursor, ts: entry.ts });
+        }
+        if (entry.meta) {
+          this.onPresence({ type: "presence", userId: entry.userId, cursor: entry.cursor, meta: entry.meta, ts: entry.ts });
+        }
+      });
     } else if (msg.type === "autosave_confirm") {
       this.onAutosaveConfirm(msg);
     }